@@ -0,0 +1,245 @@
+"""
+Rollups diários de vendas e agendamentos por loja.
+
+As rotas que mudam o estado de reservas chamam as funções registrar_* dentro
+da própria transação, somando (ou subtraindo) nos totais do dia com um
+upsert. O dashboard só lê essas tabelas, então o custo depende do número de
+dias e produtos no período, não do número de reservas.
+
+Para montar os rollups a partir do histórico existente (ou corrigir desvios):
+    python analytics.py --reconstruir
+Com SHARDS os rollups ficam no catálogo e as reservas nos shards; a
+reconstrução lê as reservas de todos eles.
+"""
+import argparse
+import sys
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+import arquivamento
+from models import RollupReservasServicoDiarias, RollupVendasDiarias
+
+UPSERT_VENDAS = text("""
+    INSERT INTO rollup_vendas_diarias (
+        loja_id, dia, produto_id,
+        unidades_reservadas, receita_reservada, unidades_retiradas,
+        receita_retirada, unidades_canceladas, receita_cancelada
+    ) VALUES (
+        :loja_id, :dia, :produto_id,
+        :unidades_reservadas, :receita_reservada, :unidades_retiradas,
+        :receita_retirada, :unidades_canceladas, :receita_cancelada
+    )
+    ON CONFLICT (loja_id, dia, produto_id) DO UPDATE SET
+        unidades_reservadas = unidades_reservadas + excluded.unidades_reservadas,
+        receita_reservada = receita_reservada + excluded.receita_reservada,
+        unidades_retiradas = unidades_retiradas + excluded.unidades_retiradas,
+        receita_retirada = receita_retirada + excluded.receita_retirada,
+        unidades_canceladas = unidades_canceladas + excluded.unidades_canceladas,
+        receita_cancelada = receita_cancelada + excluded.receita_cancelada
+""")
+
+UPSERT_SERVICOS = text("""
+    INSERT INTO rollup_reservas_servico_diarias (loja_id, dia, servico_id, status, quantidade)
+    VALUES (:loja_id, :dia, :servico_id, :status, :quantidade)
+    ON CONFLICT (loja_id, dia, servico_id, status) DO UPDATE SET
+        quantidade = quantidade + excluded.quantidade
+""")
+
+# Colunas do rollup de vendas afetadas por cada status de ReservaProduto
+COLUNAS_STATUS_PRODUTO = {
+    "RESERVADO": ("unidades_reservadas", "receita_reservada"),
+    "RETIRADO": ("unidades_retiradas", "receita_retirada"),
+    "CANCELADO": ("unidades_canceladas", "receita_cancelada"),
+}
+
+
+def _linha_vendas(loja_id, dia, produto_id, status, quantidade, preco):
+    linha = {
+        "loja_id": loja_id, "dia": dia.isoformat(), "produto_id": produto_id,
+        "unidades_reservadas": 0, "receita_reservada": 0.0,
+        "unidades_retiradas": 0, "receita_retirada": 0.0,
+        "unidades_canceladas": 0, "receita_cancelada": 0.0,
+    }
+    unidades, receita = COLUNAS_STATUS_PRODUTO[status]
+    linha[unidades] = quantidade
+    linha[receita] = quantidade * preco
+    return linha
+
+
+def registrar_reserva_produto(db: Session, reserva, itens):
+    """Soma os itens de uma reserva recém-criada (status RESERVADO)."""
+    linhas = [
+        _linha_vendas(reserva.loja_id, reserva.data_reserva.date(), i.produto_id, "RESERVADO",
+                      i.quantidade, i.preco_unitario)
+        for i in itens
+    ]
+    if linhas:
+        db.execute(UPSERT_VENDAS, linhas)
+
+
+def registrar_transicao_produto(db: Session, reserva, novo_status):
+    """Registra a retirada ou o cancelamento dos itens no dia da reserva."""
+    linhas = [
+        _linha_vendas(reserva.loja_id, reserva.data_reserva.date(), i.produto_id, novo_status,
+                      i.quantidade, i.preco_unitario)
+        for i in reserva.itens
+    ]
+    if linhas:
+        db.execute(UPSERT_VENDAS, linhas)
+
+
+def registrar_status_servico(db: Session, reserva, status_anterior, status_novo):
+    """Move uma reserva de serviço de um status para outro no dia do horário."""
+    base = {"loja_id": reserva.loja_id, "dia": reserva.data_horario.date().isoformat(),
+            "servico_id": reserva.servico_id}
+    linhas = [dict(base, status=status_novo, quantidade=1)]
+    if status_anterior:
+        linhas.append(dict(base, status=status_anterior, quantidade=-1))
+    db.execute(UPSERT_SERVICOS, linhas)
+
+
+def dashboard(db: Session, loja_id, de, ate, limite_top=10):
+    """Monta o dashboard da loja para o intervalo [de, ate) de datas."""
+    v = RollupVendasDiarias
+    filtro_vendas = (v.loja_id == loja_id, v.dia >= de, v.dia < ate)
+
+    por_dia = {}
+    for dia, un_res, rec_res, un_ret, rec_ret, un_can, rec_can in db.query(
+        v.dia, func.sum(v.unidades_reservadas), func.sum(v.receita_reservada),
+        func.sum(v.unidades_retiradas), func.sum(v.receita_retirada),
+        func.sum(v.unidades_canceladas), func.sum(v.receita_cancelada)
+    ).filter(*filtro_vendas).group_by(v.dia):
+        por_dia[dia] = {
+            "dia": dia.isoformat(),
+            "unidades_reservadas": un_res, "receita_reservada": round(rec_res, 2),
+            "unidades_retiradas": un_ret, "receita_retirada": round(rec_ret, 2),
+            "unidades_canceladas": un_can, "receita_cancelada": round(rec_can, 2),
+            "reservas_servico": {},
+        }
+
+    s = RollupReservasServicoDiarias
+    totais_servico = {}
+    for dia, status, quantidade in db.query(s.dia, s.status, func.sum(s.quantidade)).filter(
+        s.loja_id == loja_id, s.dia >= de, s.dia < ate
+    ).group_by(s.dia, s.status):
+        if not quantidade:
+            continue
+        entrada = por_dia.setdefault(dia, {"dia": dia.isoformat(), "reservas_servico": {}})
+        entrada["reservas_servico"][status] = quantidade
+        totais_servico[status] = totais_servico.get(status, 0) + quantidade
+
+    top_produtos = [
+        {"produto_id": produto_id, "unidades_retiradas": unidades, "receita_retirada": round(receita, 2)}
+        for produto_id, unidades, receita in db.query(
+            v.produto_id, func.sum(v.unidades_retiradas), func.sum(v.receita_retirada)
+        ).filter(*filtro_vendas).group_by(v.produto_id)
+        .order_by(func.sum(v.receita_retirada).desc()).limit(limite_top)
+    ]
+
+    dias = [por_dia[d] for d in sorted(por_dia)]
+    reservadas = sum(d.get("unidades_reservadas", 0) for d in dias)
+    canceladas = sum(d.get("unidades_canceladas", 0) for d in dias)
+    total_servicos = sum(totais_servico.values())
+    return {
+        "receita_retirada": round(sum(d.get("receita_retirada", 0) for d in dias), 2),
+        "receita_reservada": round(sum(d.get("receita_reservada", 0) for d in dias), 2),
+        # Reserva de produto cancelada só acontece por expiração: o cliente não foi buscar
+        "taxa_nao_retirada": round(canceladas / reservadas, 4) if reservadas else None,
+        "reservas_servico": totais_servico,
+        "taxa_cancelamento_servico": round(
+            (totais_servico.get("CANCELADO", 0) + totais_servico.get("REJEITADA", 0)) / total_servicos, 4
+        ) if total_servicos else None,
+        "top_produtos": top_produtos,
+        "por_dia": dias,
+    }
+
+
+CONSULTA_VENDAS = """
+    SELECT rp.loja_id AS loja_id, date(rp.data_reserva) AS dia, ir.produto_id AS produto_id,
+           SUM(ir.quantidade) AS unidades_reservadas,
+           SUM(ir.quantidade * ir.preco_unitario) AS receita_reservada,
+           SUM(CASE WHEN rp.status = 'RETIRADO' THEN ir.quantidade ELSE 0 END) AS unidades_retiradas,
+           SUM(CASE WHEN rp.status = 'RETIRADO' THEN ir.quantidade * ir.preco_unitario ELSE 0 END) AS receita_retirada,
+           SUM(CASE WHEN rp.status = 'CANCELADO' THEN ir.quantidade ELSE 0 END) AS unidades_canceladas,
+           SUM(CASE WHEN rp.status = 'CANCELADO' THEN ir.quantidade * ir.preco_unitario ELSE 0 END) AS receita_cancelada
+    FROM {rp} rp
+    JOIN {ir} ir ON ir.reserva_id = rp.id
+    {filtro}
+    GROUP BY rp.loja_id, date(rp.data_reserva), ir.produto_id
+"""
+
+CONSULTA_SERVICOS = """
+    SELECT rs.loja_id AS loja_id, date(rs.data_horario) AS dia, rs.servico_id AS servico_id,
+           rs.status AS status, COUNT(*) AS quantidade
+    FROM {rs} rs
+    {filtro}
+    GROUP BY rs.loja_id, date(rs.data_horario), rs.servico_id, rs.status
+"""
+
+
+def _agregar(conn, loja_id):
+    """Linhas dos dois rollups calculadas das reservas do banco de conn (e do arquivo anexado)."""
+    rp, ir, rs = "reservas_produtos", "itens_reserva", "reservas_servicos"
+    # Reservas arquivadas continuam contando nos rollups
+    if arquivamento.arquivo_anexado(conn):
+        def unir(tabela, colunas):
+            return f"(SELECT {colunas} FROM {tabela} UNION ALL SELECT {colunas} FROM arquivo.{tabela})"
+        rp = unir("reservas_produtos", "id, loja_id, data_reserva, status")
+        ir = unir("itens_reserva", "reserva_id, produto_id, quantidade, preco_unitario")
+        rs = unir("reservas_servicos", "loja_id, data_horario, servico_id, status")
+    params = {"loja_id": loja_id}
+    vendas = conn.execute(text(CONSULTA_VENDAS.format(
+        rp=rp, ir=ir, filtro="WHERE rp.loja_id = :loja_id" if loja_id else ""
+    )), params).mappings().all()
+    servicos = conn.execute(text(CONSULTA_SERVICOS.format(
+        rs=rs, filtro="WHERE rs.loja_id = :loja_id" if loja_id else ""
+    )), params).mappings().all()
+    return [dict(v) for v in vendas], [dict(s) for s in servicos]
+
+
+def reconstruir_rollups(engine, loja_id=None, fontes=None):
+    """
+    Recalcula os rollups (todas as lojas ou uma) a partir das tabelas de
+    reservas dos bancos em `fontes` (padrão: só engine; com SHARDS, o
+    catálogo e cada shard). Os rollups ficam sempre em engine; as linhas de
+    cada fonte entram pelo mesmo upsert das rotas, então uma loja no meio de
+    um movimento entre shards soma as duas partes.
+    """
+    filtro_apagar = "WHERE loja_id = :loja_id" if loja_id else ""
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM rollup_vendas_diarias {filtro_apagar}"), {"loja_id": loja_id})
+        conn.execute(text(f"DELETE FROM rollup_reservas_servico_diarias {filtro_apagar}"), {"loja_id": loja_id})
+        for fonte in fontes or [engine]:
+            if fonte is engine:
+                vendas, servicos = _agregar(conn, loja_id)
+            else:
+                with fonte.connect() as conn_fonte:
+                    vendas, servicos = _agregar(conn_fonte, loja_id)
+            if vendas:
+                conn.execute(UPSERT_VENDAS, vendas)
+            if servicos:
+                conn.execute(UPSERT_SERVICOS, servicos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reconstruir", action="store_true", help="recalcula os rollups do zero")
+    parser.add_argument("--loja", type=int, help="restringe a reconstrução a uma loja")
+    args = parser.parse_args()
+
+    import shards
+    from database import Base, engine, migrar_esquema
+    migrar_esquema(engine, Base.metadata)
+    fontes = None
+    if shards.ativo():
+        shards.preparar()
+        fontes = [shards.motor(shard) for shard in shards.todos()]
+    if args.reconstruir:
+        reconstruir_rollups(engine, args.loja, fontes)
+        print("Rollups reconstruídos.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Arquivamento das reservas finalizadas em um SQLite separado (ARQUIVO_DB).
+
+Reservas de produto RETIRADO/CANCELADO (com seus itens) e reservas de
+serviço REJEITADA/CANCELADO/ACEITO mais antigas que o corte saem das tabelas
+quentes em lotes de TAMANHO_LOTE. Cada lote copia e apaga numa mesma
+transação. ACEITO entra porque, passado o corte, o serviço já aconteceu e a
+reserva não muda mais.
+
+O arquivo é anexado como schema "arquivo" em toda conexão (database.py),
+então as rotas de histórico (agendas e exportações) unem as tabelas quentes
+com as arquivadas quando o cliente pede incluir_arquivo=1.
+
+Uso:
+    python arquivamento.py --dias 90
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Index, MetaData, Table, delete, func, insert, literal, select, union_all
+
+from database import ARQUIVO_DB
+from models import ItemReserva, ReservaProduto, ReservaServico
+
+TAMANHO_LOTE = 1000
+STATUS_FINAIS_PRODUTO = ("RETIRADO", "CANCELADO")
+STATUS_FINAIS_SERVICO = ("REJEITADA", "CANCELADO", "ACEITO")
+
+metadata_arquivo = MetaData(schema="arquivo")
+
+
+def _tabela_arquivo(modelo, *indices):
+    colunas = [Column(c.name, c.type, primary_key=c.primary_key) for c in modelo.__table__.columns]
+    return Table(
+        modelo.__tablename__, metadata_arquivo, *colunas,
+        Column("arquivado_em", DateTime, nullable=False),
+        *(Index(f"ix_arquivo_{modelo.__tablename__}_{'_'.join(cs)}", *cs) for cs in indices)
+    )
+
+
+reservas_produtos_arquivo = _tabela_arquivo(ReservaProduto, ("loja_id", "data_reserva"), ("cliente_id", "data_reserva"))
+# produto_id: remover_produto confere se o produto aparece em itens arquivados
+itens_reserva_arquivo = _tabela_arquivo(ItemReserva, ("reserva_id",), ("produto_id",))
+reservas_servicos_arquivo = _tabela_arquivo(ReservaServico, ("loja_id", "data_horario"), ("cliente_id", "data_horario"))
+
+
+def arquivo_anexado(conn):
+    return any(linha[1] == "arquivo" for linha in conn.exec_driver_sql("PRAGMA database_list"))
+
+
+def preparar(engine):
+    """Cria as tabelas do arquivo e os índices que faltam (o create_all pula tabelas que já existem)."""
+    metadata_arquivo.create_all(engine)
+    with engine.begin() as conn:
+        for tabela in metadata_arquivo.sorted_tables:
+            for indice in tabela.indexes:
+                indice.create(conn, checkfirst=True)
+
+
+def consulta_historico(conn, montar, quentes, arquivadas, incluir_arquivo):
+    """
+    montar(*tabelas) devolve o select sobre as tabelas quentes; com
+    incluir_arquivo (e o arquivo anexado) o mesmo select sobre as arquivadas
+    entra num UNION ALL. Os filtros ficam dentro de cada lado, onde os índices
+    são usados.
+    """
+    consulta = montar(*quentes)
+    if incluir_arquivo and arquivo_anexado(conn):
+        consulta = union_all(consulta, montar(*arquivadas))
+    return consulta.subquery()
+
+
+def _mover(conn, origem, destino, condicao, agora):
+    colunas = [c.name for c in origem.columns]
+    conn.execute(insert(destino).from_select(
+        colunas + ["arquivado_em"],
+        select(*origem.columns, literal(agora, DateTime)).where(condicao)
+    ))
+    conn.execute(delete(origem).where(condicao))
+
+
+def arquivar(engine, dias, tamanho_lote=TAMANHO_LOTE):
+    """Move as reservas finalizadas mais antigas que `dias`. Devolve os totais movidos."""
+    if not ARQUIVO_DB:
+        raise RuntimeError("ARQUIVO_DB desligado.")
+    # O arquivo precisa existir antes da conexão para ser anexado (database.anexar_arquivo)
+    open(ARQUIVO_DB, "ab").close()
+    corte = datetime.utcnow() - timedelta(days=dias)
+    preparar(engine)
+    rp, ir, rs = ReservaProduto.__table__, ItemReserva.__table__, ReservaServico.__table__
+    # As linhas de maior id ficam sempre nas tabelas quentes: o SQLite gera o
+    # próximo id como MAX(id) + 1, e um id reaproveitado colidiria com o arquivo
+    reserva_mais_nova = select(func.max(rp.c.id)).scalar_subquery()
+    reserva_do_item_mais_novo = select(ir.c.reserva_id).order_by(ir.c.id.desc()).limit(1).scalar_subquery()
+    servico_mais_novo = select(func.max(rs.c.id)).scalar_subquery()
+    totais = {"reservas_produtos": 0, "itens_reserva": 0, "reservas_servicos": 0}
+
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(select(rp.c.id).where(
+                rp.c.status.in_(STATUS_FINAIS_PRODUTO), rp.c.data_reserva < corte,
+                rp.c.id < reserva_mais_nova, rp.c.id != func.coalesce(reserva_do_item_mais_novo, 0)
+            ).order_by(rp.c.id).limit(tamanho_lote)).scalars().all()
+            if not ids:
+                break
+            agora = datetime.utcnow()
+            itens = conn.execute(select(ir.c.id).where(ir.c.reserva_id.in_(ids))).scalars().all()
+            _mover(conn, ir, itens_reserva_arquivo, ir.c.reserva_id.in_(ids), agora)
+            _mover(conn, rp, reservas_produtos_arquivo, rp.c.id.in_(ids), agora)
+            totais["reservas_produtos"] += len(ids)
+            totais["itens_reserva"] += len(itens)
+
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(select(rs.c.id).where(
+                rs.c.status.in_(STATUS_FINAIS_SERVICO), rs.c.data_horario < corte,
+                rs.c.id < servico_mais_novo
+            ).order_by(rs.c.id).limit(tamanho_lote)).scalars().all()
+            if not ids:
+                break
+            _mover(conn, rs, reservas_servicos_arquivo, rs.c.id.in_(ids), datetime.utcnow())
+            totais["reservas_servicos"] += len(ids)
+    return totais
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dias", type=float, default=90, help="idade mínima das reservas arquivadas")
+    parser.add_argument("--lote", type=int, default=TAMANHO_LOTE)
+    args = parser.parse_args()
+
+    from database import engine
+    if not ARQUIVO_DB:
+        print("ARQUIVO_DB desligado; nada a fazer.", file=sys.stderr)
+        return 1
+    print(arquivar(engine, args.dias, args.lote))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
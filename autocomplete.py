@@ -0,0 +1,269 @@
+"""
+Autocomplete de nomes de produtos e serviços, servido da memória.
+
+Cada nome é normalizado (minúsculas, sem acentos) e entra num array ordenado
+uma vez por palavra, a partir dela ("pneu aro 29" entra como "pneu aro 29",
+"aro 29" e "29"), então o prefixo casa com o começo de qualquer palavra. O
+prefixo digitado vira um intervalo do array por busca binária, e os k de maior
+peso saem de uma sparse table de máximos sobre os pesos: cada sugestão custa
+uma consulta O(1), sem percorrer o intervalo.
+
+Peso = 1 + unidades reservadas (produto) ou reservas (serviço) nos últimos
+AUTOCOMPLETE_DIAS, tirado dos rollups diários; produto sem estoque disponível
+vale FATOR_SEM_ESTOQUE disso.
+
+Inserções, renomeações e remoções feitas pelo ORM neste processo entram no
+índice no commit, numa área pequena percorrida linearmente. O índice inteiro
+é recarregado do banco a cada AUTOCOMPLETE_RECARGA_S (pesos novos e mudanças
+feitas por outros workers), depois de uma importação ou remoção em massa, ou
+quando as mudanças pendentes passam de MAX_PENDENTES. A recarga monta o array
+novo fora da trava e só troca no fim.
+"""
+import heapq
+import math
+import os
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+from models import Produto, RollupReservasServicoDiarias, RollupVendasDiarias, Servico
+
+AUTOCOMPLETE_RECARGA_S = float(os.environ.get("AUTOCOMPLETE_RECARGA_S", "300"))
+AUTOCOMPLETE_DIAS = int(os.environ.get("AUTOCOMPLETE_DIAS", "90"))
+FATOR_SEM_ESTOQUE = 0.2
+MAX_PENDENTES = 512
+MAX_PALAVRAS = 8
+STATUS_SERVICO_VALIDOS = ("PENDENTE", "ACEITO")
+
+
+def normalizar(texto):
+    sem_acento = unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode()
+    return " ".join(sem_acento.lower().split())
+
+
+def chaves(nome):
+    palavras = normalizar(nome).split()[:MAX_PALAVRAS]
+    return [" ".join(palavras[i:]) for i in range(len(palavras))]
+
+
+class IndicePrefixo:
+    """Índice de um tipo (produto ou serviço). Itens: id -> (nome, loja_id, peso)."""
+
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.itens = {}
+        self.pendentes = {}  # id -> chaves de itens novos ou renomeados, fora do array
+        self.obsoletos = set()  # ids cujas entradas no array não valem mais
+        self.chaves, self.ids, self.pesos, self.tabela = self._montar({})
+
+    @staticmethod
+    def _montar(itens):
+        entradas = sorted((chave, id_) for id_, (nome, _, _) in itens.items() for chave in chaves(nome))
+        ids = [id_ for _, id_ in entradas]
+        pesos = np.array([itens[id_][2] for id_ in ids], dtype=np.float64)
+        # tabela[j][i] = posição do maior peso em [i, i + 2**j)
+        tabela = [np.arange(len(ids), dtype=np.int32)]
+        passo = 1
+        while passo * 2 <= len(ids):
+            anterior = tabela[-1]
+            a, b = anterior[:len(anterior) - passo], anterior[passo:]
+            tabela.append(np.where(pesos[a] >= pesos[b], a, b))
+            passo *= 2
+        return [chave for chave, _ in entradas], ids, pesos, tabela
+
+    def _maximo(self, inicio, fim):
+        j = (fim - inicio).bit_length() - 1
+        a, b = self.tabela[j][inicio], self.tabela[j][fim - (1 << j)]
+        return int(a) if self.pesos[a] >= self.pesos[b] else int(b)
+
+    def recarregar(self, itens):
+        # Monta fora da trava: as consultas seguem no índice antigo enquanto isso
+        montado = self._montar(itens)
+        with self.trava:
+            self.itens = dict(itens)
+            self.pendentes, self.obsoletos = {}, set()
+            self.chaves, self.ids, self.pesos, self.tabela = montado
+
+    def inserir(self, id_, nome, loja_id, peso):
+        with self.trava:
+            if id_ in self.itens:
+                self.obsoletos.add(id_)
+            self.itens[id_] = (nome, loja_id, peso)
+            self.pendentes[id_] = chaves(nome)
+        self._recarregar_se_acumulou()
+
+    def remover(self, id_):
+        with self.trava:
+            if self.itens.pop(id_, None) is not None:
+                self.obsoletos.add(id_)
+                self.pendentes.pop(id_, None)
+        self._recarregar_se_acumulou()
+
+    def _recarregar_se_acumulou(self):
+        if len(self.pendentes) + len(self.obsoletos) > MAX_PENDENTES:
+            expirar()
+
+    def sugerir(self, prefixo, limite):
+        """Até `limite` (peso, id, nome, loja_id) com alguma palavra começando por `prefixo`."""
+        with self.trava:
+            inicio = bisect_left(self.chaves, prefixo)
+            fim = bisect_left(self.chaves, prefixo + "\uffff", inicio)
+            extras = sorted(
+                ((self.itens[id_][2], id_) for id_, cs in self.pendentes.items()
+                 if any(c.startswith(prefixo) for c in cs)),
+                reverse=True
+            )
+            fila = [(-self.pesos[p], p, inicio, fim) for p in [self._maximo(inicio, fim)]] if fim > inicio else []
+            resultado, vistos = [], set()
+            while len(resultado) < limite and (fila or extras):
+                if extras and (not fila or extras[0][0] >= -fila[0][0]):
+                    peso, id_ = extras.pop(0)
+                else:
+                    _, posicao, a, b = heapq.heappop(fila)
+                    for c, d in ((a, posicao), (posicao + 1, b)):
+                        if d > c:
+                            p = self._maximo(c, d)
+                            heapq.heappush(fila, (-self.pesos[p], p, c, d))
+                    id_ = self.ids[posicao]
+                    if id_ in self.obsoletos:
+                        continue
+                    peso = self.pesos[posicao]
+                if id_ in vistos:
+                    continue
+                vistos.add(id_)
+                nome, loja_id, _ = self.itens[id_]
+                resultado.append((float(peso), id_, nome, loja_id))
+            return resultado
+
+
+indices = {"produto": IndicePrefixo(), "servico": IndicePrefixo()}
+_estado = {"carregado_em": None, "populares": {}}
+_trava_recarga = threading.Lock()
+
+
+def peso(popularidade, em_estoque=True):
+    return (1.0 + popularidade) * (1.0 if em_estoque else FATOR_SEM_ESTOQUE)
+
+
+def itens_do_banco(sessao):
+    """(tipo, id, nome, loja_id, em_estoque) dos produtos ativos e dos serviços."""
+    produtos = sessao.query(
+        Produto.id, Produto.nome_produto, Produto.loja_id, Produto.quantidade_disponivel > 0
+    ).filter(Produto.removido_em == None).all()
+    servicos = sessao.query(Servico.id, Servico.nome_servico, Servico.loja_id).all()
+    return [("produto", *p) for p in produtos] + [("servico", *s, True) for s in servicos]
+
+
+def popularidade(sessao, dias=AUTOCOMPLETE_DIAS):
+    """(tipo, id) -> unidades reservadas / reservas de serviço no período, dos rollups."""
+    desde = date.today() - timedelta(days=dias)
+    vendas = sessao.query(RollupVendasDiarias.produto_id, func.sum(RollupVendasDiarias.unidades_reservadas)).filter(
+        RollupVendasDiarias.dia >= desde
+    ).group_by(RollupVendasDiarias.produto_id)
+    reservas = sessao.query(
+        RollupReservasServicoDiarias.servico_id, func.sum(RollupReservasServicoDiarias.quantidade)
+    ).filter(
+        RollupReservasServicoDiarias.dia >= desde, RollupReservasServicoDiarias.status.in_(STATUS_SERVICO_VALIDOS)
+    ).group_by(RollupReservasServicoDiarias.servico_id)
+    total = {("produto", i): q or 0 for i, q in vendas}
+    total.update({("servico", i): q or 0 for i, q in reservas})
+    return total
+
+
+def recarregar(itens, populares):
+    por_tipo = {tipo: {} for tipo in indices}
+    for tipo, id_, nome, loja_id, em_estoque in itens:
+        por_tipo[tipo][id_] = (nome, loja_id, peso(max(populares.get((tipo, id_), 0), 0), em_estoque))
+    for tipo, itens_tipo in por_tipo.items():
+        indices[tipo].recarregar(itens_tipo)
+    # Guardada para as mudanças incrementais: renomear não zera a popularidade
+    _estado["populares"] = populares
+    _estado["carregado_em"] = time.monotonic()
+
+
+def garantir_carregado(carregar):
+    """
+    Recarrega o índice se ele venceu, chamando carregar() -> (itens, populares).
+    Só uma thread recarrega; as outras seguem com o índice atual (ou esperam a
+    primeira carga).
+    """
+    carregado_em = _estado["carregado_em"]
+    if carregado_em is not None and time.monotonic() - carregado_em < AUTOCOMPLETE_RECARGA_S:
+        return
+    if not _trava_recarga.acquire(blocking=carregado_em is None):
+        return
+    try:
+        if _estado["carregado_em"] is carregado_em:
+            recarregar(*carregar())
+    finally:
+        _trava_recarga.release()
+
+
+def expirar():
+    """Força a recarga na próxima consulta (importação, remoção em massa)."""
+    if _estado["carregado_em"] is not None:
+        _estado["carregado_em"] = -math.inf
+
+
+def sugerir(prefixo, limite=10, tipos=("produto", "servico")):
+    prefixo = normalizar(prefixo)
+    if not prefixo:
+        return []
+    candidatos = [(p, tipo, id_, nome, loja_id) for tipo in tipos
+                  for p, id_, nome, loja_id in indices[tipo].sugerir(prefixo, limite)]
+    candidatos.sort(key=lambda c: -c[0])
+    return [{"tipo": tipo, "id": id_, "nome": nome, "loja_id": loja_id}
+            for _, tipo, id_, nome, loja_id in candidatos[:limite]]
+
+
+# -------------------------------------------
+#  ATUALIZAÇÃO INCREMENTAL (ORM deste processo)
+# -------------------------------------------
+
+_CAMPOS_NOME = {Produto: ("produto", "nome_produto"), Servico: ("servico", "nome_servico")}
+
+
+@event.listens_for(Session, "after_flush")
+def _registrar_mudancas(sessao, contexto):
+    mudancas = sessao.info.setdefault("autocomplete", [])
+    for obj in sessao.deleted:
+        if type(obj) in _CAMPOS_NOME:
+            mudancas.append(("remover", _CAMPOS_NOME[type(obj)][0], obj.id))
+    for obj in list(sessao.new) + list(sessao.dirty):
+        if type(obj) not in _CAMPOS_NOME:
+            continue
+        tipo, campo = _CAMPOS_NOME[type(obj)]
+        estado = inspect(obj)
+        if tipo == "produto" and obj.removido_em is not None:
+            mudancas.append(("remover", tipo, obj.id))
+        elif obj in sessao.new or estado.attrs[campo].history.has_changes():
+            # Mesmo critério de itens_do_banco (quantidade_disponivel > 0), com os valores já gravados
+            em_estoque = tipo == "servico" or (obj.quantidade_estoque or 0) - (obj.quantidade_retida or 0) > 0
+            vendidos = max(_estado["populares"].get((tipo, obj.id), 0), 0)
+            mudancas.append(("inserir", tipo, obj.id, getattr(obj, campo), obj.loja_id, peso(vendidos, em_estoque)))
+
+
+@event.listens_for(Session, "after_commit")
+def _aplicar_mudancas(sessao):
+    for mudanca in sessao.info.pop("autocomplete", ()):
+        if mudanca[0] == "remover":
+            indices[mudanca[1]].remover(mudanca[2])
+        else:
+            indices[mudanca[1]].inserir(*mudanca[2:])
+
+
+@event.listens_for(Session, "after_rollback")
+def _descartar_mudancas(sessao):
+    sessao.info.pop("autocomplete", None)
+
+
+@event.listens_for(Session, "after_bulk_delete")
+def _remocao_em_massa(contexto):
+    if contexto.mapper.class_ in _CAMPOS_NOME:
+        expirar()
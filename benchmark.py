@@ -0,0 +1,448 @@
+"""
+Benchmark reprodutível dos fluxos principais da API.
+
+Semeia uma base realista num arquivo próprio (nunca no app_ciclismo.db), de
+novo a cada execução para que todas partam dos mesmos dados, e reproduz
+misturas ponderadas de tráfego contra o app, em processo (via
+test_client do Flask) ou por HTTP contra um servidor já rodando. Ao final
+grava um JSON com p50/p95/p99 e vazão por rota, que pode ser comparado com
+uma execução anterior para sinalizar regressões.
+
+Exemplos:
+    python benchmark.py --mix completo --requisicoes 5000
+    python benchmark.py --mix carrinho --comparar bench_results/anterior.json
+
+    # Por HTTP: semeia, (re)inicia o servidor com a base e aponta --url para ele;
+    # cada execução HTTP exige semear e reiniciar de novo
+    python benchmark.py --apenas-semear --banco bench.db
+    DATABASE_URL=sqlite:///./bench.db gunicorn -w 4 main:app   # SSE longo: -k gthread --threads 32 (eventos.py)
+    python benchmark.py --modo http --url http://127.0.0.1:8000 --banco bench.db
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+SENHA_PADRAO = "senha123"
+
+# (lojas, produtos por loja, serviços por loja, horários por serviço, clientes)
+ESCALA_PADRAO = (20, 50, 5, 60, 200)
+# Logins simultâneos de cada rajada do mix login
+RAJADA_LOGINS = 10
+
+NOMES_PRODUTOS = [
+    "Câmara de ar", "Pneu aro 29", "Corrente", "Pastilha de freio", "Selim",
+    "Guidão", "Pedal", "Capacete", "Luva", "Bomba de ar", "Cassete", "Coroa",
+    "Câmbio traseiro", "Manete", "Farol", "Lanterna", "Garrafa", "Suporte",
+]
+NOMES_SERVICOS = ["Revisão completa", "Troca de freio", "Regulagem de câmbio", "Lavagem", "Montagem"]
+
+
+# -------------------------------------------
+#  Base de dados do benchmark
+# -------------------------------------------
+
+def semear(db, escala=ESCALA_PADRAO, seed=42):
+    """Popula a base com dados determinísticos para o seed informado."""
+    import contadores
+    from main import hash_password
+    from models import Cliente, Loja, Produto, Servico, ServicoHorario
+
+    n_lojas, produtos_por_loja, servicos_por_loja, horarios_por_servico, n_clientes = escala
+    rnd = random.Random(seed)
+    senha_hash = hash_password(SENHA_PADRAO)  # bcrypt uma vez só
+
+    lojas = [
+        Loja(
+            nome_loja=f"Bike Shop {i}", cnpj=f"bench-{i:08d}", cep="00000-000",
+            endereco=f"Rua {i}", senha_hash=senha_hash,
+            latitude=-23.55 + rnd.uniform(-0.3, 0.3), longitude=-46.63 + rnd.uniform(-0.3, 0.3),
+        )
+        for i in range(n_lojas)
+    ]
+    db.add_all(lojas)
+    db.flush()
+
+    inicio_agenda = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+    for loja in lojas:
+        db.add_all([
+            Produto(
+                nome_produto=f"{rnd.choice(NOMES_PRODUTOS)} {j}", preco=round(rnd.uniform(10, 900), 2),
+                loja_id=loja.id, quantidade_estoque=1_000_000,
+            )
+            for j in range(produtos_por_loja)
+        ])
+        for j in range(servicos_por_loja):
+            servico = Servico(
+                nome_servico=NOMES_SERVICOS[j % len(NOMES_SERVICOS)], preco=round(rnd.uniform(30, 300), 2),
+                descricao="", loja_id=loja.id,
+            )
+            db.add(servico)
+            db.flush()
+            db.add_all([
+                ServicoHorario(servico_id=servico.id, horario=inicio_agenda + timedelta(hours=h), is_disponivel=True)
+                for h in range(horarios_por_servico)
+            ])
+
+    db.add_all([
+        Cliente(nome=f"Cliente {i}", idade=30, cpf=f"bench-cpf-{i:08d}", senha_hash=senha_hash)
+        for i in range(n_clientes)
+    ])
+    db.commit()
+    # Lojas e produtos entraram direto pelo ORM, sem passar pelas rotas que mantêm os contadores
+    contadores.recalcular(db)
+
+
+# -------------------------------------------
+#  Clientes HTTP (em processo ou rede)
+# -------------------------------------------
+
+class ClienteEmProcesso:
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+
+    def novo(self):
+        return ClienteEmProcesso(self.app)
+
+    def requisitar(self, metodo, caminho, corpo=None):
+        resposta = self.client.open(caminho, method=metodo, json=corpo)
+        return resposta.status_code, resposta.get_json(silent=True)
+
+
+class ClienteRede:
+    def __init__(self, url_base):
+        self.url_base = url_base.rstrip("/")
+
+    def novo(self):
+        return ClienteRede(self.url_base)
+
+    def requisitar(self, metodo, caminho, corpo=None):
+        dados = json.dumps(corpo).encode() if corpo is not None else None
+        req = urllib.request.Request(self.url_base + caminho, data=dados, method=metodo)
+        if dados is not None:
+            req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resposta:
+                return resposta.status, json.loads(resposta.read() or b"null")
+        except urllib.error.HTTPError as erro:
+            return erro.code, None
+
+
+# -------------------------------------------
+#  Misturas de tráfego
+# -------------------------------------------
+
+class Contexto:
+    """Ids descobertos pela própria API antes da execução."""
+
+    def __init__(self, cliente, n_clientes):
+        self.lojas = [l["loja_id"] for l in cliente.requisitar("GET", "/lojas")[1]["lojas"]]
+        self.produtos_por_loja = {}
+        for p in cliente.requisitar("GET", "/produtos")[1]["produtos"]:
+            self.produtos_por_loja.setdefault(p["loja_id"], []).append(p["id"])
+        self.servicos = [s["id"] for s in cliente.requisitar("GET", "/servicos")[1]["servicos"]]
+        self.cpfs = [f"bench-cpf-{i:08d}" for i in range(n_clientes)]
+        self.clientes = {}
+        self._lock = threading.Lock()
+
+    def cliente_id(self, cliente, cpf):
+        with self._lock:
+            if cpf in self.clientes:
+                return self.clientes[cpf]
+        _, corpo = cliente.requisitar("POST", "/cliente/login", {"cpf": cpf, "senha": SENHA_PADRAO})
+        with self._lock:
+            self.clientes[cpf] = corpo["cliente_id"]
+        return corpo["cliente_id"]
+
+
+def op_listar_lojas(ctx, cliente, rnd, cpfs):
+    return "GET /lojas", cliente.requisitar("GET", "/lojas")
+
+def op_buscar_produtos(ctx, cliente, rnd, cpfs):
+    termo = rnd.choice(NOMES_PRODUTOS).split()[0]
+    return "GET /produtos", cliente.requisitar("GET", f"/produtos?nome_produto={urllib.request.quote(termo)}")
+
+def op_produtos_loja(ctx, cliente, rnd, cpfs):
+    return "GET /loja/<id>/produtos", cliente.requisitar("GET", f"/loja/{rnd.choice(ctx.lojas)}/produtos")
+
+def op_fluxo_carrinho(ctx, cliente, rnd, cpfs):
+    """Adiciona itens de uma loja, visualiza e finaliza (cada passo é medido à parte)."""
+    cliente_id = ctx.cliente_id(cliente, rnd.choice(cpfs))
+    loja_id = rnd.choice(list(ctx.produtos_por_loja))
+    passos = []
+    for produto_id in rnd.sample(ctx.produtos_por_loja[loja_id], 3):
+        inicio = time.perf_counter()
+        resultado = cliente.requisitar(
+            "POST", f"/cliente/{cliente_id}/carrinho", {"produto_id": produto_id, "quantidade": 1}
+        )
+        passos.append(("POST /cliente/<id>/carrinho", resultado, time.perf_counter() - inicio))
+    inicio = time.perf_counter()
+    resultado = cliente.requisitar("GET", f"/cliente/{cliente_id}/carrinho")
+    passos.append(("GET /cliente/<id>/carrinho", resultado, time.perf_counter() - inicio))
+    inicio = time.perf_counter()
+    resultado = cliente.requisitar("POST", f"/cliente/{cliente_id}/finalizar_carrinho")
+    passos.append(("POST /cliente/<id>/finalizar_carrinho", resultado, time.perf_counter() - inicio))
+    return passos
+
+def op_horarios_disponiveis(ctx, cliente, rnd, cpfs):
+    return "GET /servico/<id>/horarios_disponiveis", cliente.requisitar(
+        "GET", f"/servico/{rnd.choice(ctx.servicos)}/horarios_disponiveis"
+    )
+
+def op_agendar(ctx, cliente, rnd, cpfs):
+    """Escolhe um horário livre e agenda (400 de mesmo dia conta como erro esperado)."""
+    servico_id = rnd.choice(ctx.servicos)
+    inicio = time.perf_counter()
+    resultado = cliente.requisitar("GET", f"/servico/{servico_id}/horarios_disponiveis")
+    passos = [("GET /servico/<id>/horarios_disponiveis", resultado, time.perf_counter() - inicio)]
+    horarios = (resultado[1] or {}).get("horarios_disponiveis") or []
+    if horarios:
+        cliente_id = ctx.cliente_id(cliente, rnd.choice(cpfs))
+        inicio = time.perf_counter()
+        resultado = cliente.requisitar(
+            "POST", f"/cliente/{cliente_id}/servicos/{servico_id}/agendar",
+            {"horario_id": rnd.choice(horarios)["horario_id"]}
+        )
+        passos.append(("POST /cliente/<id>/servicos/<id>/agendar", resultado, time.perf_counter() - inicio))
+    return passos
+
+def op_login(ctx, cliente, rnd, cpfs):
+    return "POST /cliente/login", cliente.requisitar(
+        "POST", "/cliente/login", {"cpf": rnd.choice(cpfs), "senha": SENHA_PADRAO}
+    )
+
+def op_rajada_login(ctx, cliente, rnd, cpfs):
+    """RAJADA_LOGINS logins disparados juntos, cada um na sua conexão (abertura de promoção, volta de queda)."""
+    escolhidos = [rnd.choice(cpfs) for _ in range(RAJADA_LOGINS)]
+    largada = threading.Barrier(RAJADA_LOGINS)
+    passos, lock = [], threading.Lock()
+
+    def logar(cpf):
+        outro = cliente.novo()
+        largada.wait()
+        inicio = time.perf_counter()
+        resultado = outro.requisitar("POST", "/cliente/login", {"cpf": cpf, "senha": SENHA_PADRAO})
+        with lock:
+            passos.append(("POST /cliente/login (rajada)", resultado, time.perf_counter() - inicio))
+
+    threads = [threading.Thread(target=logar, args=(cpf,)) for cpf in escolhidos]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return passos
+
+
+MIXES = {
+    "catalogo": [(3, op_listar_lojas), (3, op_buscar_produtos), (4, op_produtos_loja)],
+    "carrinho": [(1, op_fluxo_carrinho)],
+    "agenda": [(3, op_horarios_disponiveis), (1, op_agendar)],
+    "login": [(1, op_rajada_login)],
+    "completo": [
+        (15, op_listar_lojas), (15, op_buscar_produtos), (20, op_produtos_loja),
+        (10, op_fluxo_carrinho), (20, op_horarios_disponiveis), (5, op_agendar), (5, op_login),
+        (1, op_rajada_login),
+    ],
+}
+
+
+# -------------------------------------------
+#  Execução e relatório
+# -------------------------------------------
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    indice = max(0, min(len(valores_ordenados) - 1, round(p / 100 * len(valores_ordenados) + 0.5) - 1))
+    return valores_ordenados[indice]
+
+
+def executar(fabrica_cliente, ctx, mix, requisicoes, concorrencia, seed):
+    operacoes = MIXES[mix]
+    pesos = [peso for peso, _ in operacoes]
+    amostras = {}
+    lock = threading.Lock()
+    restantes = [requisicoes]
+
+    def registrar(rota, resultado, duracao):
+        status = resultado[0]
+        with lock:
+            dados = amostras.setdefault(rota, {"latencias": [], "status": {}})
+            dados["latencias"].append(duracao * 1000)
+            dados["status"][status] = dados["status"].get(status, 0) + 1
+
+    def trabalhador(indice):
+        rnd = random.Random(seed * 1000 + indice)
+        cliente = fabrica_cliente()
+        # Cada trabalhador usa clientes próprios para não disputar o mesmo carrinho
+        cpfs = ctx.cpfs[indice::concorrencia]
+        while True:
+            with lock:
+                if restantes[0] <= 0:
+                    return
+                restantes[0] -= 1
+            _, operacao = rnd.choices(operacoes, weights=pesos)[0]
+            inicio = time.perf_counter()
+            resultado = operacao(ctx, cliente, rnd, cpfs)
+            if isinstance(resultado, list):
+                for rota, res, duracao in resultado:
+                    registrar(rota, res, duracao)
+            else:
+                rota, res = resultado
+                registrar(rota, res, time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=trabalhador, args=(i,)) for i in range(concorrencia)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracao_total = time.perf_counter() - inicio
+
+    rotas = {}
+    for rota, dados in sorted(amostras.items()):
+        latencias = sorted(dados["latencias"])
+        erros = sum(n for status, n in dados["status"].items() if status >= 400)
+        rotas[rota] = {
+            "requisicoes": len(latencias),
+            "erros": erros,
+            "status": {str(k): v for k, v in sorted(dados["status"].items())},
+            "vazao_rps": round(len(latencias) / duracao_total, 2),
+            "media_ms": round(sum(latencias) / len(latencias), 3),
+            "p50_ms": round(percentil(latencias, 50), 3),
+            "p95_ms": round(percentil(latencias, 95), 3),
+            "p99_ms": round(percentil(latencias, 99), 3),
+            "max_ms": round(latencias[-1], 3),
+        }
+    total = sum(r["requisicoes"] for r in rotas.values())
+    return {"duracao_s": round(duracao_total, 3), "vazao_total_rps": round(total / duracao_total, 2), "rotas": rotas}
+
+
+def comparar(atual, anterior, tolerancia):
+    """Lista as rotas cujo p95 ou vazão pioraram além da tolerância."""
+    regressoes = []
+    for rota, novo in atual["rotas"].items():
+        antigo = anterior["rotas"].get(rota)
+        if not antigo:
+            continue
+        if novo["p95_ms"] > antigo["p95_ms"] * (1 + tolerancia):
+            regressoes.append(f"{rota}: p95 {antigo['p95_ms']} -> {novo['p95_ms']} ms")
+        if novo["vazao_rps"] < antigo["vazao_rps"] * (1 - tolerancia):
+            regressoes.append(f"{rota}: vazão {antigo['vazao_rps']} -> {novo['vazao_rps']} req/s")
+    return regressoes
+
+
+def _commit_atual():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modo", choices=["processo", "http"], default="processo")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--banco", default="bench_results/bench.db", help="arquivo SQLite do benchmark")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="completo")
+    parser.add_argument("--requisicoes", type=int, default=2000)
+    parser.add_argument("--concorrencia", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--escala", type=int, nargs=5, default=list(ESCALA_PADRAO),
+                        metavar=("LOJAS", "PRODUTOS", "SERVICOS", "HORARIOS", "CLIENTES"))
+    parser.add_argument("--apenas-semear", action="store_true")
+    parser.add_argument("--saida", default="bench_results")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.banco)), exist_ok=True)
+    caminho_semente = args.banco + ".semente.json"
+    semear_agora = args.modo == "processo" or args.apenas_semear
+    if semear_agora:
+        # Base nova a cada execução: as anteriores mudaram estoque, carrinhos e
+        # agendas, e os horários são relativos ao "agora" da semeadura
+        for sufixo in ("", "-wal", "-shm", ".semente.json"):
+            if os.path.exists(args.banco + sufixo):
+                os.remove(args.banco + sufixo)
+    else:
+        # No modo http a base é a do servidor: tem de ter sido semeada com os
+        # mesmos parâmetros e ainda não usada por outra execução
+        try:
+            with open(caminho_semente) as arquivo:
+                semente = json.load(arquivo)
+        except FileNotFoundError:
+            semente = None
+        if not semente or semente["usada"] or (semente["seed"], semente["escala"]) != (args.seed, args.escala):
+            print("Base ausente, já usada ou semeada com outro --seed/--escala: rode --apenas-semear com os "
+                  "mesmos parâmetros e reinicie o servidor.", file=sys.stderr)
+            return 2
+    # Precisa estar definido antes de importar database/main
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.banco)}"
+    # O benchmark mede a aplicação, não o rate limit (logins repetidos do mesmo IP)
+    os.environ.setdefault("RATE_LIMIT_ATIVO", "0")
+
+    import main as app_main
+
+    if semear_agora:
+        db = app_main.SessionLocal()
+        try:
+            semear(db, tuple(args.escala), args.seed)
+        finally:
+            db.close()
+        with open(caminho_semente, "w") as arquivo:
+            json.dump({"seed": args.seed, "escala": args.escala, "usada": False}, arquivo)
+    if args.apenas_semear:
+        print(f"Base semeada em {args.banco}")
+        return 0
+
+    if args.modo == "http":
+        fabrica = lambda: ClienteRede(args.url)
+    else:
+        fabrica = lambda: ClienteEmProcesso(app_main.app)
+
+    ctx = Contexto(fabrica(), args.escala[4])
+    resultado = executar(fabrica, ctx, args.mix, args.requisicoes, args.concorrencia, args.seed)
+    with open(caminho_semente, "w") as arquivo:
+        json.dump({"seed": args.seed, "escala": args.escala, "usada": True}, arquivo)
+    resultado.update({
+        "mix": args.mix,
+        "modo": args.modo,
+        "requisicoes": args.requisicoes,
+        "concorrencia": args.concorrencia,
+        "seed": args.seed,
+        "escala": args.escala,
+        "commit": _commit_atual(),
+        "quando": datetime.utcnow().isoformat(),
+    })
+
+    os.makedirs(args.saida, exist_ok=True)
+    caminho = os.path.join(args.saida, f"{args.mix}_{args.modo}_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(caminho, "w") as arquivo:
+        json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+
+    print(f"{'rota':45} {'n':>6} {'erros':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8}")
+    for rota, r in resultado["rotas"].items():
+        print(f"{rota:45} {r['requisicoes']:6} {r['erros']:6} {r['p50_ms']:9.2f} "
+              f"{r['p95_ms']:9.2f} {r['p99_ms']:9.2f} {r['vazao_rps']:8.1f}")
+    print(f"Total: {resultado['vazao_total_rps']} req/s em {resultado['duracao_s']} s -> {caminho}")
+
+    if args.comparar:
+        with open(args.comparar) as arquivo:
+            regressoes = comparar(resultado, json.load(arquivo), args.tolerancia)
+        for r in regressoes:
+            print(f"REGRESSÃO {r}")
+        return 1 if regressoes else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Cache por processo das linhas de Loja, Cliente e Servico usadas nas
+verificações de existência (o 404 do começo das rotas).
+
+Cada cache é um LRU limitado de registros compactos (__slots__) lido sob
+demanda: um acerto dispensa a ida ao banco. Atualizações e remoções feitas
+pelo ORM neste processo invalidam a entrada na hora (eventos do mapper; os
+delete/update em massa limpam o cache do modelo). Como cada worker tem seu
+próprio cache, as entradas também expiram depois de IDENTIDADE_TTL_S, o que
+limita o tempo em que outro worker enxerga uma linha já alterada.
+
+Só existências confirmadas são guardadas: um id que ainda não existe sempre
+consulta o banco, então uma loja recém-cadastrada nunca recebe 404.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Cliente, Loja, Servico
+
+IDENTIDADE_MAX_ITENS = int(os.environ.get("IDENTIDADE_MAX_ITENS", "10000"))
+IDENTIDADE_TTL_S = float(os.environ.get("IDENTIDADE_TTL_S", "60"))
+
+
+class RegistroLoja:
+    __slots__ = ("id",)
+
+
+class RegistroCliente:
+    __slots__ = ("id",)
+
+
+class RegistroServico:
+    __slots__ = ("id", "loja_id")
+
+
+class CacheIdentidade:
+    def __init__(self, modelo, registro, maximo=IDENTIDADE_MAX_ITENS, ttl=IDENTIDADE_TTL_S):
+        self.modelo = modelo
+        self.registro = registro
+        self.colunas = [getattr(modelo, c) for c in registro.__slots__]
+        self.maximo = maximo
+        self.ttl = ttl
+        self.itens = OrderedDict()  # id -> (expira_em, registro)
+        self.trava = threading.Lock()
+
+    def obter(self, db: Session, id_):
+        """Devolve o registro do id, ou None se a linha não existe."""
+        agora = time.monotonic()
+        with self.trava:
+            entrada = self.itens.get(id_)
+            if entrada is not None and entrada[0] > agora:
+                self.itens.move_to_end(id_)
+                return entrada[1]
+
+        linha = db.query(*self.colunas).filter(self.modelo.id == id_).first()
+        if linha is None:
+            self.invalidar(id_)
+            return None
+        registro = self.registro()
+        for nome, valor in zip(self.registro.__slots__, linha):
+            setattr(registro, nome, valor)
+        with self.trava:
+            self.itens[id_] = (agora + self.ttl, registro)
+            self.itens.move_to_end(id_)
+            while len(self.itens) > self.maximo:
+                self.itens.popitem(last=False)
+        return registro
+
+    def invalidar(self, id_):
+        with self.trava:
+            self.itens.pop(id_, None)
+
+    def limpar(self):
+        with self.trava:
+            self.itens.clear()
+
+
+lojas = CacheIdentidade(Loja, RegistroLoja)
+clientes = CacheIdentidade(Cliente, RegistroCliente)
+servicos = CacheIdentidade(Servico, RegistroServico)
+
+_POR_MODELO = {Loja: lojas, Cliente: clientes, Servico: servicos}
+
+
+def _instalar_invalidacao(modelo, cache):
+    def invalidar(mapper, connection, alvo):
+        cache.invalidar(alvo.id)
+    event.listen(modelo, "after_update", invalidar)
+    event.listen(modelo, "after_delete", invalidar)
+
+
+for _modelo, _cache in _POR_MODELO.items():
+    _instalar_invalidacao(_modelo, _cache)
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _limpar_em_massa(contexto):
+    cache = _POR_MODELO.get(contexto.mapper.class_)
+    if cache is not None:
+        cache.limpar()
@@ -0,0 +1,381 @@
+"""
+Snapshots colunares das vendas para relatórios da rede inteira.
+
+Os itens de reserva são copiados para arquivos binários por coluna
+(um np.memmap por coluna) e atualizados incrementalmente pelo id do último
+item copiado. Os relatórios (percentis de receita por loja, distribuição do
+tamanho das cestas e elasticidade-preço por região) rodam vetorizados sobre
+esses arrays, sem iterar objetos do ORM.
+
+O status da reserva muda depois da criação (RESERVADO -> RETIRADO/CANCELADO),
+então ele fica num array à parte indexado por reserva_id, relido a partir da
+reserva mais antiga que ainda estava RESERVADO na última atualização.
+Produtos (loja, preço atual, estoque, removido) e coordenadas das lojas mudam
+em qualquer linha e são relidos inteiros, num array denso por id.
+
+Com SHARDS ligado os itens das lojas dos shards não estão no banco principal;
+o snapshot não os cobre e o relatório da rede fica indisponível.
+
+Uso:
+    python colunar.py --atualizar
+    python colunar.py --relatorio --de 2025-01-01 --ate 2025-12-31
+"""
+import argparse
+import fcntl
+import json
+import os
+import sys
+from contextlib import contextmanager
+from datetime import date
+
+import numpy as np
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+TAMANHO_BLOCO = 100_000
+
+COLUNAS_ITENS = {
+    "item_id": np.int64,
+    "reserva_id": np.int64,
+    "produto_id": np.int64,
+    "loja_id": np.int32,
+    "quantidade": np.int32,
+    "preco_unitario": np.float64,
+    "dia": np.int32,  # dias desde 1970-01-01 da data da reserva
+}
+
+STATUS = {"RESERVADO": 1, "RETIRADO": 2, "CANCELADO": 3}
+
+# Um registro por produto_id (ids sem produto ficam com loja_id 0)
+TIPO_PRODUTO = np.dtype([
+    ("loja_id", np.int32),
+    ("preco", np.float64),
+    ("quantidade_estoque", np.int32),
+    ("removido", np.bool_),
+])
+
+CONSULTA_ITENS = """
+    SELECT ir.id, ir.reserva_id, ir.produto_id, rp.loja_id, ir.quantidade, ir.preco_unitario,
+           CAST(julianday(rp.data_reserva) - 2440587.5 AS INTEGER)
+    FROM {itens} ir
+    JOIN {reservas} rp ON rp.id = ir.reserva_id
+    WHERE ir.id > ?
+    ORDER BY ir.id
+"""
+
+
+def _fontes(cursor):
+    """Tabelas de itens e reservas, unidas às arquivadas quando o arquivo está anexado."""
+    anexado = any(linha[1] == "arquivo" for linha in cursor.execute("PRAGMA database_list").fetchall())
+    if not anexado:
+        return "itens_reserva", "reservas_produtos"
+    return (
+        "(SELECT id, reserva_id, produto_id, quantidade, preco_unitario FROM itens_reserva"
+        " UNION ALL SELECT id, reserva_id, produto_id, quantidade, preco_unitario FROM arquivo.itens_reserva)",
+        "(SELECT id, loja_id, data_reserva, status FROM reservas_produtos"
+        " UNION ALL SELECT id, loja_id, data_reserva, status FROM arquivo.reservas_produtos)",
+    )
+
+
+def _caminho(nome):
+    return os.path.join(SNAPSHOT_DIR, nome)
+
+
+def _ler_meta():
+    try:
+        with open(_caminho("meta.json")) as arquivo:
+            return json.load(arquivo)
+    except FileNotFoundError:
+        return {"watermark_item": 0, "linhas": 0, "primeira_reserva_aberta": 0}
+
+
+@contextmanager
+def _trava():
+    """Evita que dois workers atualizem o snapshot ao mesmo tempo."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(_caminho(".lock"), "w") as trava:
+        fcntl.flock(trava, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(trava, fcntl.LOCK_UN)
+
+
+def atualizar(engine):
+    """Anexa os itens novos e relê os status que ainda podem mudar."""
+    with _trava():
+        meta = _ler_meta()
+        conexao = engine.raw_connection()
+        try:
+            cursor = conexao.cursor()
+            itens, reservas = _fontes(cursor)
+
+            cursor.execute(CONSULTA_ITENS.format(itens=itens, reservas=reservas), (meta["watermark_item"],))
+            arquivos = {c: open(_caminho(f"itens_{c}.bin"), "ab") for c in COLUNAS_ITENS}
+            try:
+                # Linhas além de meta["linhas"] são de uma atualização que falhou
+                # antes de gravar o meta.json; o watermark antigo as busca de novo
+                for nome, tipo in COLUNAS_ITENS.items():
+                    arquivos[nome].truncate(meta["linhas"] * np.dtype(tipo).itemsize)
+                while True:
+                    linhas = cursor.fetchmany(TAMANHO_BLOCO)
+                    if not linhas:
+                        break
+                    colunas = list(zip(*linhas))
+                    for (nome, tipo), valores in zip(COLUNAS_ITENS.items(), colunas):
+                        np.asarray(valores, dtype=tipo).tofile(arquivos[nome])
+                    meta["watermark_item"] = int(linhas[-1][0])
+                    meta["linhas"] += len(linhas)
+            finally:
+                for arquivo in arquivos.values():
+                    arquivo.close()
+
+            # Status: array denso por reserva_id; só o trecho a partir da
+            # reserva aberta mais antiga precisa ser relido
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {reservas}")
+            maior_id = cursor.fetchone()[0]
+            status = _carregar_status(maior_id + 1)
+            inicio = meta["primeira_reserva_aberta"]
+            cursor.execute(f"SELECT id, status FROM {reservas} WHERE id >= ?", (inicio,))
+            primeira_aberta = None
+            while True:
+                linhas = cursor.fetchmany(TAMANHO_BLOCO)
+                if not linhas:
+                    break
+                ids = np.fromiter((l[0] for l in linhas), dtype=np.int64, count=len(linhas))
+                codigos = np.fromiter((STATUS.get(l[1], 0) for l in linhas), dtype=np.int8, count=len(linhas))
+                # Reservas criadas depois do MAX(id) (leituras separadas) aumentam o array
+                if ids.max() >= len(status):
+                    maior_id = int(ids.max())
+                    status.flush()
+                    del status
+                    status = _carregar_status(maior_id + 1)
+                status[ids] = codigos
+                abertas = ids[codigos == STATUS["RESERVADO"]]
+                if primeira_aberta is None and abertas.size:
+                    primeira_aberta = int(abertas.min())
+            meta["primeira_reserva_aberta"] = primeira_aberta if primeira_aberta is not None else maior_id + 1
+            status.flush()
+            del status
+
+            # Coordenadas das lojas (tabela pequena, relida inteira)
+            cursor.execute("SELECT id, latitude, longitude FROM lojas")
+            lojas = cursor.fetchall()
+            coordenadas = np.full((max((l[0] for l in lojas), default=0) + 1, 2), np.nan)
+            for loja_id, latitude, longitude in lojas:
+                if latitude is not None and longitude is not None:
+                    coordenadas[loja_id] = (latitude, longitude)
+            np.save(_caminho("lojas_coordenadas.npy"), coordenadas)
+
+            # Produtos (relidos inteiros: preço e estoque mudam em qualquer linha)
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM produtos")
+            produtos = np.zeros(cursor.fetchone()[0] + 1, dtype=TIPO_PRODUTO)
+            cursor.execute(
+                "SELECT id, loja_id, preco, quantidade_estoque, removido_em IS NOT NULL FROM produtos ORDER BY id"
+            )
+            while True:
+                linhas = cursor.fetchmany(TAMANHO_BLOCO)
+                if not linhas:
+                    break
+                bloco = np.array([tuple(l[1:]) for l in linhas], dtype=TIPO_PRODUTO)
+                ids = np.fromiter((l[0] for l in linhas), dtype=np.int64, count=len(linhas))
+                if ids.max() >= produtos.shape[0]:
+                    produtos = np.resize(produtos, int(ids.max()) + 1)
+                produtos[ids] = bloco
+            np.save(_caminho("produtos.npy"), produtos)
+        finally:
+            conexao.close()
+
+        with open(_caminho("meta.json.tmp"), "w") as arquivo:
+            json.dump(meta, arquivo)
+        os.replace(_caminho("meta.json.tmp"), _caminho("meta.json"))
+        return meta
+
+
+def _carregar_status(tamanho):
+    """Abre (e aumenta, se preciso) o array de status por reserva_id."""
+    caminho = _caminho("reservas_status.bin")
+    atual = os.path.getsize(caminho) if os.path.exists(caminho) else 0
+    if tamanho > atual:
+        with open(caminho, "ab") as arquivo:
+            arquivo.truncate(tamanho)
+    return np.memmap(caminho, dtype=np.int8, mode="r+", shape=(max(tamanho, atual),))
+
+
+def carregar():
+    """Abre as colunas em modo somente leitura (sem copiar para a memória)."""
+    meta = _ler_meta()
+    n = meta["linhas"]
+    colunas = {
+        nome: np.memmap(_caminho(f"itens_{nome}.bin"), dtype=tipo, mode="r", shape=(n,)) if n else np.empty(0, tipo)
+        for nome, tipo in COLUNAS_ITENS.items()
+    }
+    caminho_status = _caminho("reservas_status.bin")
+    colunas["status_reserva"] = (
+        np.memmap(caminho_status, dtype=np.int8, mode="r") if os.path.exists(caminho_status) and os.path.getsize(caminho_status)
+        else np.zeros(1, np.int8)
+    )
+    caminho_lojas = _caminho("lojas_coordenadas.npy")
+    colunas["lojas_coordenadas"] = np.load(caminho_lojas) if os.path.exists(caminho_lojas) else np.empty((0, 2))
+    caminho_produtos = _caminho("produtos.npy")
+    colunas["produtos"] = (
+        np.load(caminho_produtos, mmap_mode="r") if os.path.exists(caminho_produtos) else np.zeros(0, TIPO_PRODUTO)
+    )
+    return colunas
+
+
+def _percentis(valores, ps=(10, 25, 50, 75, 90, 99)):
+    if not valores.size:
+        return {}
+    return {f"p{p}": round(float(v), 2) for p, v in zip(ps, np.percentile(valores, ps))}
+
+
+def relatorio_rede(colunas, de=None, ate=None, status="RETIRADO"):
+    """
+    Relatórios da rede sobre os itens com data em [de, ate) e com o status
+    informado (None = todos).
+    """
+    dia = colunas["dia"]
+    mascara = np.ones(dia.shape[0], dtype=bool)
+    if de is not None:
+        mascara &= dia >= (de - date(1970, 1, 1)).days
+    if ate is not None:
+        mascara &= dia < (ate - date(1970, 1, 1)).days
+    reserva_id = np.asarray(colunas["reserva_id"][mascara])
+    if status:
+        status_reserva = colunas["status_reserva"]
+        codigos = np.zeros(reserva_id.shape[0], dtype=np.int8)
+        conhecidos = reserva_id < status_reserva.shape[0]
+        codigos[conhecidos] = status_reserva[reserva_id[conhecidos]]
+        filtro_status = codigos == STATUS[status]
+        mascara[mascara] = filtro_status
+        reserva_id = reserva_id[filtro_status]
+
+    loja_id = np.asarray(colunas["loja_id"][mascara])
+    produto_id = np.asarray(colunas["produto_id"][mascara])
+    quantidade = np.asarray(colunas["quantidade"][mascara], dtype=np.float64)
+    preco = np.asarray(colunas["preco_unitario"][mascara])
+    receita = quantidade * preco
+
+    # Receita por loja
+    receita_lojas = np.bincount(loja_id, weights=receita) if loja_id.size else np.empty(0)
+    lojas_com_venda = np.flatnonzero(receita_lojas)
+    top = lojas_com_venda[np.argsort(receita_lojas[lojas_com_venda])[::-1][:10]]
+
+    # Tamanho das cestas (unidades por reserva)
+    _, por_reserva = np.unique(reserva_id, return_inverse=True)
+    unidades_cesta = np.bincount(por_reserva, weights=quantidade) if reserva_id.size else np.empty(0)
+    histograma = np.bincount(np.minimum(unidades_cesta.astype(np.int64), 20)) if unidades_cesta.size else []
+
+    # Receita por produto, com os atributos atuais do produto
+    produtos_vendidos, por_produto = np.unique(produto_id, return_inverse=True)
+    receita_produtos = np.bincount(por_produto, weights=receita) if produto_id.size else np.empty(0)
+    unidades_produtos = np.bincount(por_produto, weights=quantidade) if produto_id.size else np.empty(0)
+    top_produtos = np.argsort(receita_produtos)[::-1][:10]
+
+    return {
+        "itens": int(loja_id.size),
+        "receita_total": round(float(receita.sum()), 2),
+        "receita_por_loja": {
+            "lojas_com_venda": int(lojas_com_venda.size),
+            "percentis": _percentis(receita_lojas[lojas_com_venda]),
+            "top_lojas": [{"loja_id": int(l), "receita": round(float(receita_lojas[l]), 2)} for l in top],
+        },
+        "cestas": {
+            "reservas": int(unidades_cesta.size),
+            "media_unidades": round(float(unidades_cesta.mean()), 3) if unidades_cesta.size else None,
+            "percentis_unidades": _percentis(unidades_cesta),
+            # índice = unidades na cesta (o último agrega 20 ou mais)
+            "histograma_unidades": [int(n) for n in histograma],
+        },
+        "top_produtos": [
+            _resumo_produto(colunas["produtos"], int(produtos_vendidos[i]), receita_produtos[i], unidades_produtos[i])
+            for i in top_produtos
+        ],
+        "elasticidade_por_regiao": _elasticidade_por_regiao(
+            colunas["lojas_coordenadas"], loja_id, produto_id, quantidade, preco
+        ),
+    }
+
+
+def _resumo_produto(produtos, produto_id, receita, unidades):
+    resumo = {
+        "produto_id": produto_id,
+        "receita": round(float(receita), 2),
+        "preco_medio_vendido": round(float(receita / unidades), 2) if unidades else None,
+    }
+    if produto_id < produtos.shape[0] and produtos[produto_id]["loja_id"]:
+        atual = produtos[produto_id]
+        resumo.update({
+            "loja_id": int(atual["loja_id"]),
+            "preco_atual": round(float(atual["preco"]), 2),
+            "quantidade_estoque": int(atual["quantidade_estoque"]),
+            "removido": bool(atual["removido"]),
+        })
+    return resumo
+
+
+def _elasticidade_por_regiao(coordenadas, loja_id, produto_id, quantidade, preco, grau=1.0):
+    """
+    Elasticidade-preço por região (grade de `grau` graus de lat/long), estimada
+    com efeito fixo por produto e região: regressão de log(quantidade) em
+    log(preço) após subtrair as médias de cada par (região, produto).
+    """
+    if not loja_id.size or not coordenadas.size:
+        return []
+    validos = (loja_id < coordenadas.shape[0]) & (quantidade > 0) & (preco > 0)
+    coords = coordenadas[loja_id[validos]]
+    validos_coord = ~np.isnan(coords).any(axis=1)
+    coords = coords[validos_coord]
+    produto = produto_id[validos][validos_coord]
+    log_q = np.log(quantidade[validos][validos_coord])
+    log_p = np.log(preco[validos][validos_coord])
+    if not log_q.size:
+        return []
+
+    celulas = np.floor(coords / grau).astype(np.int64)
+    _, regiao = np.unique(celulas, axis=0, return_inverse=True)
+    regiao = regiao.ravel()
+    celulas_regiao = np.zeros((regiao.max() + 1, 2), dtype=np.int64)
+    celulas_regiao[regiao] = celulas
+
+    _, grupo = np.unique(regiao.astype(np.int64) << 40 | produto, return_inverse=True)
+    contagem = np.bincount(grupo)
+    x = log_p - (np.bincount(grupo, weights=log_p) / contagem)[grupo]
+    y = log_q - (np.bincount(grupo, weights=log_q) / contagem)[grupo]
+
+    sxy = np.bincount(regiao, weights=x * y)
+    sxx = np.bincount(regiao, weights=x * x)
+    n = np.bincount(regiao)
+    resultado = []
+    for r in np.flatnonzero(sxx > 1e-9):
+        resultado.append({
+            "latitude": float(celulas_regiao[r][0] * grau),
+            "longitude": float(celulas_regiao[r][1] * grau),
+            "itens": int(n[r]),
+            "elasticidade": round(float(sxy[r] / sxx[r]), 4),
+        })
+    return sorted(resultado, key=lambda e: e["itens"], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--atualizar", action="store_true")
+    parser.add_argument("--relatorio", action="store_true")
+    parser.add_argument("--de", type=date.fromisoformat)
+    parser.add_argument("--ate", type=date.fromisoformat)
+    args = parser.parse_args()
+
+    import shards
+    if shards.ativo():
+        print("Com SHARDS ligado o snapshot não cobre as lojas dos shards.", file=sys.stderr)
+        return 1
+    from database import engine
+    if args.atualizar:
+        print(json.dumps(atualizar(engine)))
+    if args.relatorio:
+        print(json.dumps(relatorio_rede(carregar(), args.de, args.ate), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Compressão negociada das respostas (gzip, e br/zstd quando os pacotes
+brotli/zstandard estão instalados).
+
+Só são comprimidas respostas de texto/JSON com pelo menos
+COMPRESSAO_MIN_BYTES. O nível de cada algoritmo vem de
+COMPRESSAO_NIVEL_GZIP, COMPRESSAO_NIVEL_BR e COMPRESSAO_NIVEL_ZSTD.
+
+As listagens (catálogo, lojas, horários) se repetem byte a byte entre
+requisições, então o resultado comprimido fica num LRU indexado pelo hash do
+corpo e pelo algoritmo: um corpo que volta é servido sem recomprimir.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSAO_MIN_BYTES = int(os.environ.get("COMPRESSAO_MIN_BYTES", "1024"))
+COMPRESSAO_CACHE_ITENS = int(os.environ.get("COMPRESSAO_CACHE_ITENS", "256"))
+NIVEL_GZIP = int(os.environ.get("COMPRESSAO_NIVEL_GZIP", "6"))
+NIVEL_BR = int(os.environ.get("COMPRESSAO_NIVEL_BR", "5"))
+NIVEL_ZSTD = int(os.environ.get("COMPRESSAO_NIVEL_ZSTD", "3"))
+
+TIPOS_COMPRIMIVEIS = ("application/json", "text/", "application/javascript", "application/x-ndjson")
+
+
+def _gzip(dados):
+    # mtime=0 deixa a saída determinística (mesmo corpo -> mesmos bytes)
+    return gzip.compress(dados, compresslevel=NIVEL_GZIP, mtime=0)
+
+
+# Ordem de preferência do servidor quando o cliente aceita mais de um
+COMPRESSORES = []
+if zstandard is not None:
+    COMPRESSORES.append(("zstd", lambda dados: zstandard.ZstdCompressor(level=NIVEL_ZSTD).compress(dados)))
+if brotli is not None:
+    COMPRESSORES.append(("br", lambda dados: brotli.compress(dados, quality=NIVEL_BR)))
+COMPRESSORES.append(("gzip", _gzip))
+
+
+class CacheComprimido:
+    """LRU de corpos já comprimidos, indexado por (algoritmo, hash do corpo)."""
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self.itens = OrderedDict()
+        self.trava = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, chave, comprimir):
+        with self.trava:
+            comprimido = self.itens.get(chave)
+            if comprimido is not None:
+                self.itens.move_to_end(chave)
+                self.acertos += 1
+                return comprimido
+            self.falhas += 1
+        comprimido = comprimir()
+        with self.trava:
+            self.itens[chave] = comprimido
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.maximo:
+                self.itens.popitem(last=False)
+        return comprimido
+
+
+cache = CacheComprimido(COMPRESSAO_CACHE_ITENS)
+
+
+def escolher_codificacao(accept_encodings):
+    for nome, funcao in COMPRESSORES:
+        if accept_encodings[nome] > 0:
+            return nome, funcao
+    return None, None
+
+
+def comprimir_resposta(response):
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or not (response.mimetype or "").startswith(TIPOS_COMPRIMIVEIS)
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    codificacao, funcao = escolher_codificacao(request.accept_encodings)
+    if codificacao is None:
+        return response
+    dados = response.get_data()
+    if len(dados) < COMPRESSAO_MIN_BYTES:
+        return response
+
+    chave = (codificacao, hashlib.blake2b(dados, digest_size=16).digest())
+    comprimido = cache.obter(chave, lambda: funcao(dados)) if COMPRESSAO_CACHE_ITENS else funcao(dados)
+    response.set_data(comprimido)
+    response.headers["Content-Encoding"] = codificacao
+    return response
+
+
+def instalar_compressao(app):
+    app.after_request(comprimir_resposta)
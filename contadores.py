@@ -0,0 +1,132 @@
+"""
+Contadores por loja guardados na própria linha da loja: produtos ativos,
+produtos em estoque, serviços e reservas de serviço pendentes. /lojas e a
+página da loja leem esses números junto com a loja, sem COUNT(*) por loja.
+
+As rotas que mudam esses números chamam ajustar() na mesma transação da
+mudança. Produto em estoque é quantidade_estoque > 0 (retenções de carrinho
+não contam). A importação em massa (rota e linha de comando) e a semeadura
+do benchmark recontam as lojas que criaram. O UPDATE é
+feito direto na tabela, sem passar pelo mapper, para não limpar o cache de
+identidade das lojas a cada reserva.
+
+A recontagem refaz tudo a partir das tabelas e corrige o que tiver desviado
+(edições manuais no banco, falhas entre catálogo e shard com SHARDS):
+    python contadores.py --recalcular
+Lojas de bancos anteriores aos contadores (colunas NULL) são contadas na
+subida da aplicação.
+"""
+import argparse
+import sys
+
+from sqlalchemy import bindparam, func, update
+
+from models import Loja, Produto, ReservaServico, Servico
+
+CAMPOS = ("total_produtos", "produtos_em_estoque", "total_servicos", "reservas_pendentes")
+
+
+def ajustar(db, loja_id, **deltas):
+    """ajustar(db, loja_id, total_produtos=1, produtos_em_estoque=-1, ...)"""
+    colunas = Loja.__table__.c
+    valores = {campo: colunas[campo] + delta for campo, delta in deltas.items() if delta}
+    if valores:
+        db.execute(update(Loja.__table__).where(colunas.id == loja_id).values(valores))
+
+
+def em_estoque(quantidade):
+    return 1 if (quantidade or 0) > 0 else 0
+
+
+def estoque_mudou(db, produto, quantidade_anterior):
+    """Depois de mudar produto.quantidade_estoque: acerta produtos_em_estoque se o produto cruzou o zero."""
+    if produto.removido_em is None:
+        ajustar(db, produto.loja_id, produtos_em_estoque=em_estoque(produto.quantidade_estoque) - em_estoque(quantidade_anterior))
+
+
+def status_servico_mudou(db, reserva, status_anterior=None):
+    """Depois de criar a reserva de serviço (status_anterior None) ou mudar o status dela."""
+    delta = (reserva.status == "PENDENTE") - (status_anterior == "PENDENTE")
+    ajustar(db, reserva.loja_id, reservas_pendentes=delta)
+
+
+def contar(sessao, loja_ids=None):
+    """loja_id -> [total_produtos, produtos_em_estoque, total_servicos, reservas_pendentes]."""
+    def agrupado(modelo, colunas, *filtros):
+        query = sessao.query(modelo.loja_id, *colunas).filter(*filtros)
+        if loja_ids is not None:
+            query = query.filter(modelo.loja_id.in_(loja_ids))
+        return query.group_by(modelo.loja_id).all()
+
+    total = {}
+    produtos = agrupado(
+        Produto, (func.count(), func.count().filter(Produto.quantidade_estoque > 0)), Produto.removido_em == None
+    )
+    for loja_id, n, n_estoque in produtos:
+        total.setdefault(loja_id, [0, 0, 0, 0])[0:2] = [n, n_estoque]
+    for loja_id, n in agrupado(Servico, (func.count(),)):
+        total.setdefault(loja_id, [0, 0, 0, 0])[2] = n
+    for loja_id, n in agrupado(ReservaServico, (func.count(),), ReservaServico.status == "PENDENTE"):
+        total.setdefault(loja_id, [0, 0, 0, 0])[3] = n
+    return total
+
+
+def recalcular(db, loja_ids=None, somente_sem_contagem=False, coletar=None):
+    """
+    Reconta as lojas (todas ou loja_ids) e grava as que mudaram; devolve
+    quantas foram corrigidas. Com somente_sem_contagem, só as de contadores
+    NULL. coletar(consulta) junta as contagens dos shards quando ativos.
+    """
+    query = db.query(Loja.id, *(getattr(Loja, c) for c in CAMPOS))
+    if loja_ids is not None:
+        query = query.filter(Loja.id.in_(loja_ids))
+    if somente_sem_contagem:
+        query = query.filter(Loja.total_produtos == None)
+    atuais = {linha[0]: list(linha[1:]) for linha in query}
+    if not atuais:
+        return 0
+
+    if coletar:
+        contagens = {}
+        for loja_id, valores in coletar(lambda sessao: list(contar(sessao, list(atuais)).items())):
+            somados = contagens.setdefault(loja_id, [0, 0, 0, 0])
+            contagens[loja_id] = [a + b for a, b in zip(somados, valores)]
+    else:
+        contagens = contar(db, list(atuais))
+
+    corrigidas = []
+    for loja_id, valores in atuais.items():
+        novos = contagens.get(loja_id, [0, 0, 0, 0])
+        if valores != novos:
+            corrigidas.append({"loja": loja_id, **dict(zip(CAMPOS, novos))})
+    if corrigidas:
+        colunas = Loja.__table__.c
+        db.execute(
+            update(Loja.__table__).where(colunas.id == bindparam("loja")).values(
+                {campo: bindparam(campo) for campo in CAMPOS}
+            ),
+            corrigidas
+        )
+    db.commit()
+    return len(corrigidas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recalcular", action="store_true", required=True, help="reconta todas as lojas")
+    parser.parse_args()
+
+    import shards
+    if shards.ativo():
+        shards.preparar()
+        with shards.SessaoShards() as db:
+            print(f"{recalcular(db, coletar=shards.coletar)} lojas corrigidas.")
+    else:
+        from database import SessionLocal
+        with SessionLocal() as db:
+            print(f"{recalcular(db)} lojas corrigidas.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,66 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from slow_queries import instalar_log_consultas_lentas
+
 # Aqui você configura sua URL de conexão (SQLite, no seu caso)
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app_ciclismo.db"
+# DATABASE_URL permite apontar para outro arquivo (benchmarks, testes de carga)
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./app_ciclismo.db")
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False}
 )
 
+# Registra consultas acima de SLOW_QUERY_MS com o EXPLAIN QUERY PLAN
+instalar_log_consultas_lentas(engine)
+
+
+def caminho_arquivo_padrao(url):
+    """Arquivo SQLite do histórico arquivado: <banco>_arquivo.db ao lado do principal."""
+    if not url.startswith("sqlite:///") or url.endswith(":memory:"):
+        return None
+    return os.path.splitext(url[len("sqlite:///"):])[0] + "_arquivo.db"
+
+
+# Quantidade de shards dos dados das lojas (shards.py); 0 deixa tudo neste banco
+SHARDS = int(os.environ.get("SHARDS", "0"))
+
+# Reservas finalizadas movidas por arquivamento.py; ARQUIVO_DB="" desliga.
+# Com SHARDS o histórico arquivado não é anexado aos shards, então fica desligado
+ARQUIVO_DB = "" if SHARDS else os.environ.get("ARQUIVO_DB", caminho_arquivo_padrao(SQLALCHEMY_DATABASE_URL) or "")
+
+
+@event.listens_for(engine, "connect")
+def anexar_arquivo(dbapi_conn, connection_record):
+    # Só anexa se o arquivo já existe (criado na primeira execução do arquivamento)
+    if ARQUIVO_DB and os.path.exists(ARQUIVO_DB):
+        dbapi_conn.execute("ATTACH DATABASE ? AS arquivo", (ARQUIVO_DB,))
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+
+def migrar_esquema(engine, metadata):
+    """
+    Cria tabelas e índices que faltam e adiciona colunas novas às tabelas
+    existentes (o create_all sozinho não altera tabelas que já existem).
+    """
+    metadata.create_all(bind=engine)
+    inspetor = inspect(engine)
+    with engine.begin() as conn:
+        for tabela in metadata.sorted_tables:
+            existentes = {c["name"] for c in inspetor.get_columns(tabela.name)}
+            for coluna in tabela.columns:
+                if coluna.name in existentes:
+                    continue
+                ddl = f"ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {coluna.type.compile(engine.dialect)}"
+                if coluna.server_default is not None:
+                    ddl += f" DEFAULT {coluna.server_default.arg}"
+                conn.exec_driver_sql(ddl)
+            for indice in tabela.indexes:
+                indice.create(conn, checkfirst=True)
@@ -0,0 +1,113 @@
+"""
+Feed de mudanças da agenda e dos horários, entregue por Server-Sent Events.
+
+As rotas que mudam reservas de serviço, horários ou criam reservas de
+produto gravam um EventoMudanca na mesma transação da mudança. Os endpoints
+SSE leem o log a partir do último id recebido pelo cliente (header
+Last-Event-ID, que o EventSource reenvia sozinho ao reconectar) e só mandam
+o que mudou desde então.
+
+No SQLite as escritas são serializadas, então os ids ficam visíveis em ordem
+crescente e "id > último" não perde eventos.
+
+Cada stream aberto ocupa uma thread do servidor. Por padrão ele funciona como
+long-poll curto: fecha depois de entregar eventos ou de SSE_DURACAO_MAX_S sem
+nenhum, e o EventSource reconecta continuando do último id. Assim os workers
+síncronos (gunicorn -w 4) não ficam presos por telas de agenda abertas.
+Streams longos (SSE_ENCERRAR_APOS_ENVIO=0, SSE_DURACAO_MAX_S maior) exigem
+worker com threads, como gunicorn -k gthread --threads 32.
+
+Para apagar eventos antigos:
+    python eventos.py --limpar-dias 7
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from models import EventoMudanca
+
+SSE_INTERVALO_S = float(os.environ.get("SSE_INTERVALO_S", "1"))
+SSE_HEARTBEAT_S = float(os.environ.get("SSE_HEARTBEAT_S", "15"))
+# Conexões longas prendem um worker; o cliente reconecta e continua do último id
+SSE_DURACAO_MAX_S = float(os.environ.get("SSE_DURACAO_MAX_S", "20"))
+SSE_ENCERRAR_APOS_ENVIO = os.environ.get("SSE_ENCERRAR_APOS_ENVIO", "1") == "1"
+TAMANHO_LOTE = 500
+
+
+def _serializar(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+
+def registrar(db, loja_id, tipo, dados, servico_id=None):
+    db.add(EventoMudanca(
+        loja_id=loja_id, servico_id=servico_id, tipo=tipo,
+        dados=json.dumps({k: _serializar(v) for k, v in dados.items()}, ensure_ascii=False)
+    ))
+
+
+def reserva_servico(db, reserva, tipo, status_anterior=None):
+    registrar(db, reserva.loja_id, tipo, {
+        "reserva_id": reserva.id, "cliente_id": reserva.cliente_id, "servico_id": reserva.servico_id,
+        "data_horario": reserva.data_horario, "status_anterior": status_anterior, "status": reserva.status,
+    })
+
+
+def horarios(db, loja_id, servico_id, tipo, lista):
+    """lista: ServicoHorario afetados (tipo horarios_criados, horario_ocupado ou horario_liberado)."""
+    registrar(db, loja_id, tipo, {
+        "horarios": [{"horario_id": h.id, "datahora": h.horario.isoformat()} for h in lista]
+    }, servico_id=servico_id)
+
+
+def ultimo_id(db):
+    return db.query(EventoMudanca.id).order_by(EventoMudanca.id.desc()).limit(1).scalar() or 0
+
+
+def gerar_sse(fabrica_sessao, filtro, desde):
+    """
+    Gera o stream SSE a partir do id `desde`, consultando o log a cada
+    SSE_INTERVALO_S com uma sessão curta (a conexão não fica presa entre
+    consultas).
+    """
+    yield f"retry: {int(SSE_INTERVALO_S * 2000)}\n\n"
+    inicio = ultimo_envio = time.monotonic()
+    while time.monotonic() - inicio < SSE_DURACAO_MAX_S:
+        with fabrica_sessao() as db:
+            eventos = db.query(EventoMudanca.id, EventoMudanca.tipo, EventoMudanca.dados).filter(
+                filtro, EventoMudanca.id > desde
+            ).order_by(EventoMudanca.id).limit(TAMANHO_LOTE).all()
+        if eventos:
+            desde = eventos[-1][0]
+            ultimo_envio = time.monotonic()
+            yield "".join(f"id: {i}\nevent: {tipo}\ndata: {dados}\n\n" for i, tipo, dados in eventos)
+            if len(eventos) == TAMANHO_LOTE:
+                continue
+            if SSE_ENCERRAR_APOS_ENVIO:
+                return
+        elif time.monotonic() - ultimo_envio >= SSE_HEARTBEAT_S:
+            ultimo_envio = time.monotonic()
+            yield ": ping\n\n"
+        time.sleep(SSE_INTERVALO_S)
+
+
+def limpar(engine, dias):
+    limite = datetime.utcnow() - timedelta(days=dias)
+    with engine.begin() as conn:
+        return conn.execute(EventoMudanca.__table__.delete().where(EventoMudanca.criado_em < limite)).rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limpar-dias", type=float, required=True, help="apaga eventos mais antigos que isso")
+    args = parser.parse_args()
+
+    from database import engine
+    print(f"{limpar(engine, args.limpar_dias)} eventos apagados.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
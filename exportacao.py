@@ -0,0 +1,100 @@
+"""
+Exportação em streaming do histórico das lojas (NDJSON ou CSV).
+
+As consultas usam yield_per, então as linhas saem do cursor em blocos e
+são serializadas conforme chegam: a memória não cresce com o histórico e o
+primeiro byte sai assim que a resposta começa.
+"""
+import csv
+import io
+import json
+from datetime import date, datetime
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import arquivamento
+from models import ItemReserva, ReservaProduto, ReservaServico
+
+TAMANHO_BLOCO = 1000
+
+COLUNAS_AGENDA = ["reserva_id", "cliente_id", "servico_id", "data_horario", "status"]
+COLUNAS_RESERVAS_PRODUTOS = [
+    "reserva_id", "cliente_id", "data_reserva", "data_limite", "status",
+    "item_id", "produto_id", "quantidade", "preco_unitario",
+]
+
+
+def linhas_agenda(db: Session, loja_id, de=None, ate=None, status=None, incluir_arquivo=False):
+    def montar(t):
+        consulta = select(t.c.id, t.c.cliente_id, t.c.servico_id, t.c.data_horario, t.c.status).where(
+            t.c.loja_id == loja_id
+        )
+        if de:
+            consulta = consulta.where(t.c.data_horario >= de)
+        if ate:
+            consulta = consulta.where(t.c.data_horario < ate)
+        if status:
+            consulta = consulta.where(t.c.status.in_(status))
+        return consulta
+    r = arquivamento.consulta_historico(
+        db.connection(), montar, [ReservaServico.__table__], [arquivamento.reservas_servicos_arquivo], incluir_arquivo
+    )
+    return db.query(*r.c).order_by(r.c.data_horario).yield_per(TAMANHO_BLOCO)
+
+
+def linhas_reservas_produtos(db: Session, loja_id, de=None, ate=None, status=None, incluir_arquivo=False):
+    """Uma linha por item, com os dados da reserva repetidos (formato de planilha)."""
+    def montar(rp, ir):
+        consulta = select(
+            rp.c.id, rp.c.cliente_id, rp.c.data_reserva, rp.c.data_limite, rp.c.status,
+            ir.c.id.label("item_id"), ir.c.produto_id, ir.c.quantidade, ir.c.preco_unitario
+        ).join_from(rp, ir, ir.c.reserva_id == rp.c.id).where(rp.c.loja_id == loja_id)
+        if de:
+            consulta = consulta.where(rp.c.data_reserva >= de)
+        if ate:
+            consulta = consulta.where(rp.c.data_reserva < ate)
+        if status:
+            consulta = consulta.where(rp.c.status.in_(status))
+        return consulta
+    r = arquivamento.consulta_historico(
+        db.connection(), montar, [ReservaProduto.__table__, ItemReserva.__table__],
+        [arquivamento.reservas_produtos_arquivo, arquivamento.itens_reserva_arquivo], incluir_arquivo
+    )
+    return db.query(*r.c).order_by(r.c.data_reserva, r.c.id).yield_per(TAMANHO_BLOCO)
+
+
+def _valor(v):
+    return v.isoformat() if isinstance(v, (datetime, date)) else v
+
+
+def gerar_ndjson(colunas, linhas):
+    bloco, primeira = [], True
+    for linha in linhas:
+        bloco.append(json.dumps(dict(zip(colunas, map(_valor, linha))), ensure_ascii=False))
+        # A primeira linha sai sozinha, assim que a consulta devolve; depois, em blocos
+        if len(bloco) >= TAMANHO_BLOCO or primeira:
+            primeira = False
+            yield "\n".join(bloco) + "\n"
+            bloco.clear()
+    if bloco:
+        yield "\n".join(bloco) + "\n"
+
+
+def gerar_csv(colunas, linhas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(colunas)
+    yield buffer.getvalue()  # cabeçalho sai antes mesmo da consulta rodar
+    buffer.seek(0)
+    buffer.truncate()
+    contador = 0
+    for linha in linhas:
+        escritor.writerow([_valor(v) for v in linha])
+        contador += 1
+        if contador % TAMANHO_BLOCO == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,40 @@
+"""
+Distâncias por coordenadas e busca de lojas próximas.
+
+A busca filtra primeiro por uma caixa de latitude/longitude em volta do ponto
+(que usa o índice ix_lojas_lat_lon) e só então calcula a distância real
+(haversine) das lojas que sobraram.
+"""
+import math
+
+from models import Loja
+
+RAIO_TERRA_KM = 6371.0
+KM_POR_GRAU = 111.32
+
+
+def distancia_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAIO_TERRA_KM * math.asin(math.sqrt(a))
+
+
+def caixa(lat, lon, raio_km):
+    """(lat_min, lat_max, lon_min, lon_max) que contém o círculo do raio."""
+    dlat = raio_km / KM_POR_GRAU
+    dlon = raio_km / (KM_POR_GRAU * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def lojas_proximas(db, lat, lon, raio_km):
+    """loja_id -> distância em km das lojas a até raio_km do ponto."""
+    lat_min, lat_max, lon_min, lon_max = caixa(lat, lon, raio_km)
+    linhas = db.query(Loja.id, Loja.latitude, Loja.longitude).filter(
+        Loja.latitude.between(lat_min, lat_max), Loja.longitude.between(lon_min, lon_max)
+    )
+    proximas = {}
+    for loja_id, lat_loja, lon_loja in linhas:
+        distancia = distancia_km(lat, lon, lat_loja, lon_loja)
+        if distancia <= raio_km:
+            proximas[loja_id] = distancia
+    return proximas
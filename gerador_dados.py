@@ -0,0 +1,408 @@
+"""
+Gerador de dados sintéticos em escala de produção.
+
+Popula todas as tabelas do app (lojas, produtos, serviços, horários,
+clientes, carrinho, reservas de produto com itens e reservas de serviço)
+com distribuição realista: popularidade das lojas segue uma lei de Zipf,
+as lojas se concentram em torno de capitais e os produtos e horários mais
+procurados recebem mais reservas.
+
+A carga usa o sqlite3 direto com executemany em lotes grandes, uma transação
+por tabela e pragmas relaxados (journal_mode=OFF, synchronous=OFF) durante a
+carga, restaurados ao final. O mesmo --seed sempre gera a mesma base.
+
+Exemplos:
+    python gerador_dados.py --banco carga.db --escala producao
+    python gerador_dados.py --banco carga.db --lojas 500 --produtos 100000 --horarios 1000000
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta
+
+# Hash bcrypt fixo de "senha123": mantém a base determinística e evita
+# milhões de chamadas ao bcrypt durante a carga.
+SENHA_HASH_PADRAO = "$2b$12$tsleN406dYA0zVWMpZ/V8e2PQDhIe6zkIC8Fq9x0HnCdMGmZOeXJq"
+
+ESCALAS = {
+    #            lojas  produtos  servicos  horarios    clientes  carrinhos  res_produto  res_servico
+    "pequena":  (50,    5_000,    200,      20_000,     2_000,    200,       5_000,       4_000),
+    "media":    (500,   200_000,  2_000,    1_000_000,  50_000,   5_000,     100_000,     150_000),
+    "producao": (5_000, 2_000_000, 20_000,  20_000_000, 500_000,  50_000,    1_000_000,   2_000_000),
+}
+
+# (cidade, latitude, longitude, peso)
+CIDADES = [
+    ("São Paulo", -23.55, -46.63, 30), ("Rio de Janeiro", -22.91, -43.17, 15),
+    ("Belo Horizonte", -19.92, -43.94, 8), ("Curitiba", -25.43, -49.27, 8),
+    ("Porto Alegre", -30.03, -51.23, 7), ("Brasília", -15.79, -47.88, 6),
+    ("Florianópolis", -27.59, -48.55, 5), ("Salvador", -12.97, -38.50, 5),
+    ("Recife", -8.05, -34.88, 4), ("Fortaleza", -3.73, -38.52, 4),
+    ("Campinas", -22.91, -47.06, 4), ("Goiânia", -16.69, -49.25, 3),
+]
+
+# (categoria, preço mediano)
+CATEGORIAS = [
+    ("Câmara de ar", 35), ("Pneu", 180), ("Corrente", 120), ("Pastilha de freio", 60),
+    ("Selim", 150), ("Guidão", 200), ("Pedal", 140), ("Capacete", 250), ("Luva", 80),
+    ("Bomba de ar", 110), ("Cassete", 350), ("Câmbio traseiro", 600), ("Manete", 160),
+    ("Farol", 130), ("Bicicleta aro 29", 3500), ("Roda", 900), ("Suspensão", 2200),
+]
+MARCAS = ["Shimano", "SRAM", "Caloi", "Specialized", "Pirelli", "Maxxis", "Absolute", "Oggi", "Sense", "Elleven"]
+SERVICOS = ["Revisão completa", "Troca de freio", "Regulagem de câmbio", "Lavagem", "Montagem",
+            "Troca de pneu", "Sangria de freio hidráulico", "Bike fit", "Manutenção de suspensão"]
+
+TAMANHO_LOTE = 50_000
+
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S.000000"  # mesmo formato gravado pelo SQLAlchemy no SQLite
+
+
+def pesos_zipf(n, s=1.1):
+    """Pesos acumulados de uma distribuição de Zipf para sorteio com bisect."""
+    acumulado = list(itertools.accumulate(1 / (k ** s) for k in range(1, n + 1)))
+    total = acumulado[-1]
+    return [a / total for a in acumulado]
+
+
+def sortear(rnd, acumulado):
+    return min(bisect.bisect(acumulado, rnd.random()), len(acumulado) - 1)
+
+
+def repartir(total, acumulado, minimo=0):
+    """Divide `total` entre os índices proporcionalmente aos pesos (determinístico)."""
+    partes = []
+    anterior = 0.0
+    for a in acumulado:
+        partes.append(max(minimo, int(round(total * (a - anterior)))))
+        anterior = a
+    return partes
+
+
+def inserir_em_lotes(conn, sql, linhas):
+    lote = []
+    total = 0
+    for linha in linhas:
+        lote.append(linha)
+        if len(lote) >= TAMANHO_LOTE:
+            conn.executemany(sql, lote)
+            total += len(lote)
+            lote.clear()
+    if lote:
+        conn.executemany(sql, lote)
+        total += len(lote)
+    conn.commit()
+    return total
+
+
+def proximo_id(conn, tabela):
+    return (conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {tabela}").fetchone()[0]) + 1
+
+
+class Gerador:
+    def __init__(self, conn, seed, lojas, produtos, servicos, horarios, clientes,
+                 carrinhos, reservas_produto, reservas_servico, inicio):
+        self.conn = conn
+        self.seed = seed
+        self.n_lojas = lojas
+        self.n_produtos = produtos
+        self.n_servicos = servicos
+        self.n_horarios = horarios
+        self.n_clientes = clientes
+        self.n_carrinhos = carrinhos
+        self.n_reservas_produto = reservas_produto
+        self.n_reservas_servico = reservas_servico
+        self.inicio = inicio
+
+    def _rnd(self, tabela):
+        # Um gerador por tabela: alterar a escala de uma não muda as outras
+        return random.Random(f"{self.seed}:{tabela}")
+
+    def gerar(self):
+        for etapa in (self.lojas, self.clientes, self.produtos, self.servicos,
+                      self.horarios_e_reservas_servico, self.reservas_produto, self.carrinho):
+            inicio = time.perf_counter()
+            total = etapa()
+            print(f"{etapa.__name__:32} {total:>12,} linhas em {time.perf_counter() - inicio:7.1f} s")
+
+    def lojas(self):
+        rnd = self._rnd("lojas")
+        self.loja_base = proximo_id(self.conn, "lojas")
+        self.popularidade_lojas = pesos_zipf(self.n_lojas)
+        cidades_acumulado = list(itertools.accumulate(c[3] for c in CIDADES))
+
+        def linhas():
+            for i in range(self.n_lojas):
+                cidade, lat, lon, _ = CIDADES[bisect.bisect(cidades_acumulado, rnd.random() * cidades_acumulado[-1])]
+                loja_id = self.loja_base + i
+                yield (
+                    loja_id, f"Bike {cidade} {loja_id}", f"9{loja_id:013d}", f"{rnd.randint(1000, 99999):05d}-000",
+                    f"Rua {rnd.randint(1, 3000)}, {cidade}", None, None, SENHA_HASH_PADRAO, None, None,
+                    round(rnd.gauss(lat, 0.12), 6), round(rnd.gauss(lon, 0.12), 6),
+                )
+
+        return inserir_em_lotes(
+            self.conn,
+            "INSERT INTO lojas (id, nome_loja, cnpj, cep, endereco, complemento, lote, senha_hash, "
+            "descricao, foto_path, latitude, longitude) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+            linhas(),
+        )
+
+    def clientes(self):
+        rnd = self._rnd("clientes")
+        self.cliente_base = proximo_id(self.conn, "clientes")
+        self.popularidade_clientes = pesos_zipf(self.n_clientes, s=0.8)
+
+        def linhas():
+            for i in range(self.n_clientes):
+                cliente_id = self.cliente_base + i
+                yield (cliente_id, f"Cliente {cliente_id}", rnd.randint(16, 70), f"9{cliente_id:010d}",
+                       SENHA_HASH_PADRAO, None)
+
+        return inserir_em_lotes(
+            self.conn,
+            "INSERT INTO clientes (id, nome, idade, cpf, senha_hash, foto_path) VALUES (?,?,?,?,?,?)",
+            linhas(),
+        )
+
+    def produtos(self):
+        rnd = self._rnd("produtos")
+        self.produto_base = proximo_id(self.conn, "produtos")
+        # Produtos contíguos por loja: a loja i tem [inicio[i], inicio[i] + qtd[i])
+        self.produtos_por_loja = repartir(self.n_produtos, self.popularidade_lojas, minimo=1)
+        self.produtos_inicio = list(itertools.accumulate([0] + self.produtos_por_loja[:-1]))
+        self.precos = array("d")
+
+        def linhas():
+            produto_id = self.produto_base
+            for i, quantidade in enumerate(self.produtos_por_loja):
+                loja_id = self.loja_base + i
+                for _ in range(quantidade):
+                    categoria, mediana = CATEGORIAS[rnd.randrange(len(CATEGORIAS))]
+                    preco = round(mediana * rnd.lognormvariate(0, 0.35), 2)
+                    self.precos.append(preco)
+                    estoque = 0 if rnd.random() < 0.15 else int(rnd.paretovariate(1.5) * 3)
+                    yield (produto_id, f"{categoria} {rnd.choice(MARCAS)} {produto_id}", preco, loja_id,
+                           None, estoque)
+                    produto_id += 1
+
+        return inserir_em_lotes(
+            self.conn,
+            "INSERT INTO produtos (id, nome_produto, preco, loja_id, image_path, quantidade_estoque) "
+            "VALUES (?,?,?,?,?,?)",
+            linhas(),
+        )
+
+    def servicos(self):
+        rnd = self._rnd("servicos")
+        self.servico_base = proximo_id(self.conn, "servicos")
+        self.servicos_por_loja = repartir(self.n_servicos, self.popularidade_lojas)
+        self.servico_loja = array("l")
+
+        def linhas():
+            servico_id = self.servico_base
+            for i, quantidade in enumerate(self.servicos_por_loja):
+                for _ in range(quantidade):
+                    self.servico_loja.append(self.loja_base + i)
+                    yield (servico_id, rnd.choice(SERVICOS), None, round(rnd.uniform(40, 400), 2), self.loja_base + i)
+                    servico_id += 1
+
+        return inserir_em_lotes(
+            self.conn,
+            "INSERT INTO servicos (id, nome_servico, descricao, preco, loja_id) VALUES (?,?,?,?,?)",
+            linhas(),
+        )
+
+    def horarios_e_reservas_servico(self):
+        """Gera a grade de horários e, na mesma passada, as reservas que ocupam parte dela."""
+        rnd = self._rnd("horarios")
+        total_servicos = len(self.servico_loja)
+        if not total_servicos:
+            return 0
+        horario_base = proximo_id(self.conn, "servicos_horarios")
+        reserva_base = proximo_id(self.conn, "reservas_servicos")
+        por_servico = max(1, self.n_horarios // total_servicos)
+
+        # Grade comercial (seg-sáb, 8h-18h) compartilhada por todos os serviços
+        grade = []
+        dia = self.inicio
+        while len(grade) < por_servico:
+            if dia.weekday() != 6:
+                for hora in range(8, 18):
+                    grade.append((dia + timedelta(hours=hora)).strftime(FORMATO_DATA))
+            dia += timedelta(days=1)
+        grade = grade[:por_servico]
+
+        # Peso relativo de cada loja, normalizado para a média por serviço ficar em 1
+        pesos_loja = [b - a for a, b in zip([0.0] + self.popularidade_lojas[:-1], self.popularidade_lojas)]
+        media_pesos = sum(pesos_loja[loja_id - self.loja_base] for loja_id in self.servico_loja) / total_servicos
+        ocupacao_media = self.n_reservas_servico / max(1, total_servicos * por_servico)
+        status_reserva = (["ACEITO"] * 50 + ["PENDENTE"] * 25 + ["CANCELADO"] * 15 + ["REJEITADA"] * 10)
+        reservas = []
+        reserva_id = [reserva_base]
+
+        def linhas_horarios():
+            horario_id = horario_base
+            for s in range(total_servicos):
+                servico_id = self.servico_base + s
+                loja_id = self.servico_loja[s]
+                # Serviços de lojas populares lotam mais
+                ocupacao = min(0.95, ocupacao_media * pesos_loja[loja_id - self.loja_base] / media_pesos)
+                for horario in grade:
+                    disponivel = 1
+                    if rnd.random() < ocupacao:
+                        status = status_reserva[rnd.randrange(len(status_reserva))]
+                        disponivel = 1 if status in ("CANCELADO", "REJEITADA") else 0
+                        cliente_id = self.cliente_base + sortear(rnd, self.popularidade_clientes)
+                        reservas.append((reserva_id[0], cliente_id, loja_id, servico_id, horario, status))
+                        reserva_id[0] += 1
+                    yield (horario_id, servico_id, horario, disponivel)
+                    horario_id += 1
+                if len(reservas) >= TAMANHO_LOTE:
+                    self._gravar_reservas_servico(reservas)
+
+        total = inserir_em_lotes(
+            self.conn,
+            "INSERT INTO servicos_horarios (id, servico_id, horario, is_disponivel) VALUES (?,?,?,?)",
+            linhas_horarios(),
+        )
+        self._gravar_reservas_servico(reservas)
+        self.conn.commit()
+        return total + (reserva_id[0] - reserva_base)
+
+    def _gravar_reservas_servico(self, reservas):
+        self.conn.executemany(
+            "INSERT INTO reservas_servicos (id, cliente_id, loja_id, servico_id, data_horario, status) "
+            "VALUES (?,?,?,?,?,?)",
+            reservas,
+        )
+        reservas.clear()
+
+    def reservas_produto(self):
+        rnd = self._rnd("reservas_produtos")
+        reserva_base = proximo_id(self.conn, "reservas_produtos")
+        item_base = proximo_id(self.conn, "itens_reserva")
+        status_reserva = ["RETIRADO"] * 70 + ["CANCELADO"] * 20 + ["RESERVADO"] * 10
+        itens = []
+        item_id = [item_base]
+
+        def linhas():
+            for r in range(self.n_reservas_produto):
+                reserva_id = reserva_base + r
+                indice_loja = sortear(rnd, self.popularidade_lojas)
+                data = self.inicio - timedelta(minutes=rnd.randrange(365 * 24 * 60))
+                for _ in range(1 + int(rnd.expovariate(0.8))):
+                    # Dentro da loja, os primeiros produtos são os mais vendidos
+                    indice = self.produtos_inicio[indice_loja] + int(self.produtos_por_loja[indice_loja] * rnd.random() ** 3)
+                    itens.append((item_id[0], reserva_id, self.produto_base + indice,
+                                  1 + int(rnd.expovariate(1.2)), self.precos[indice]))
+                    item_id[0] += 1
+                yield (
+                    reserva_id, self.cliente_base + sortear(rnd, self.popularidade_clientes),
+                    self.loja_base + indice_loja, data.strftime(FORMATO_DATA),
+                    status_reserva[rnd.randrange(len(status_reserva))],
+                    (data + timedelta(days=2)).strftime(FORMATO_DATA),
+                )
+                if len(itens) >= TAMANHO_LOTE:
+                    self._gravar_itens(itens)
+
+        total = inserir_em_lotes(
+            self.conn,
+            "INSERT INTO reservas_produtos (id, cliente_id, loja_id, data_reserva, status, data_limite) "
+            "VALUES (?,?,?,?,?,?)",
+            linhas(),
+        )
+        self._gravar_itens(itens)
+        self.conn.commit()
+        return total + (item_id[0] - item_base)
+
+    def _gravar_itens(self, itens):
+        self.conn.executemany(
+            "INSERT INTO itens_reserva (id, reserva_id, produto_id, quantidade, preco_unitario) VALUES (?,?,?,?,?)",
+            itens,
+        )
+        itens.clear()
+
+    def carrinho(self):
+        rnd = self._rnd("carrinho")
+        carrinho_base = proximo_id(self.conn, "carrinho")
+        clientes = rnd.sample(range(self.n_clientes), min(self.n_carrinhos, self.n_clientes))
+
+        def linhas():
+            item_id = carrinho_base
+            for c in clientes:
+                # Carrinho sempre de uma loja só, como exige adicionar_item_carrinho
+                indice_loja = sortear(rnd, self.popularidade_lojas)
+                inicio, quantidade = self.produtos_inicio[indice_loja], self.produtos_por_loja[indice_loja]
+                for indice in rnd.sample(range(inicio, inicio + quantidade), min(quantidade, rnd.randint(1, 4))):
+                    yield (item_id, self.cliente_base + c, self.produto_base + indice, rnd.randint(1, 3))
+                    item_id += 1
+
+        return inserir_em_lotes(
+            self.conn,
+            "INSERT INTO carrinho (id, cliente_id, produto_id, quantidade) VALUES (?,?,?,?)",
+            linhas(),
+        )
+
+
+def relaxar_pragmas(conn):
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")  # 256 MB
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+
+
+def restaurar_pragmas(conn):
+    conn.execute("PRAGMA locking_mode=NORMAL")
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--banco", required=True, help="arquivo SQLite de destino")
+    parser.add_argument("--escala", choices=sorted(ESCALAS), default="pequena")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--inicio", default="2025-01-06", help="primeiro dia da grade de horários (AAAA-MM-DD)")
+    for nome in ("lojas", "produtos", "servicos", "horarios", "clientes",
+                 "carrinhos", "reservas-produto", "reservas-servico"):
+        parser.add_argument(f"--{nome}", type=int, help="sobrescreve o valor da escala")
+    args = parser.parse_args()
+
+    escala = dict(zip(
+        ("lojas", "produtos", "servicos", "horarios", "clientes", "carrinhos", "reservas_produto", "reservas_servico"),
+        ESCALAS[args.escala],
+    ))
+    for chave in escala:
+        valor = getattr(args, chave)
+        if valor is not None:
+            escala[chave] = valor
+
+    # As tabelas são criadas pelos próprios modelos, com o mesmo esquema do app
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.banco)}"
+    from database import Base, engine, migrar_esquema
+    import models  # noqa: F401 - registra os modelos no metadata
+    migrar_esquema(engine, Base.metadata)
+
+    conexao = engine.raw_connection()
+    conn = conexao.connection  # sqlite3 puro, sem o custo do ORM
+    relaxar_pragmas(conn)
+    inicio = time.perf_counter()
+    try:
+        Gerador(conn, args.seed, inicio=datetime.strptime(args.inicio, "%Y-%m-%d"), **escala).gerar()
+    finally:
+        restaurar_pragmas(conn)
+        conexao.close()
+    print(f"Base gerada em {args.banco} em {time.perf_counter() - inicio:.1f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
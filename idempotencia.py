@@ -0,0 +1,157 @@
+"""
+Suporte ao header Idempotency-Key nas rotas que criam reservas.
+
+A primeira requisição com uma chave grava um registro EM_ANDAMENTO (a chave
+primária garante que só uma ganha), executa a rota e guarda a resposta. As
+repetições recebem a resposta guardada sem executar a rota de novo; as que
+chegam enquanto a primeira ainda roda esperam até IDEMPOTENCIA_ESPERA_S pelo
+resultado. Erros 5xx e exceções liberam a chave para uma nova tentativa.
+
+A chave vale por cliente/loja da URL e por rota. Reusar a chave com outro corpo
+devolve 422. Os registros expiram em IDEMPOTENCIA_TTL_HORAS e são apagados aos
+poucos, conforme chegam chaves novas.
+"""
+import functools
+import hashlib
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from flask import jsonify, make_response, request
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal
+from models import ChaveIdempotencia
+
+IDEMPOTENCIA_TTL_HORAS = float(os.environ.get("IDEMPOTENCIA_TTL_HORAS", "24"))
+IDEMPOTENCIA_ESPERA_S = float(os.environ.get("IDEMPOTENCIA_ESPERA_S", "10"))
+# Um registro EM_ANDAMENTO mais velho que isso é de um worker que morreu
+IDEMPOTENCIA_ABANDONO_S = float(os.environ.get("IDEMPOTENCIA_ABANDONO_S", "120"))
+INTERVALO_ESPERA_S = 0.05
+TAMANHO_MAXIMO_CHAVE = 255
+
+
+def _reservar(chave, hash_requisicao):
+    """
+    Devolve ("nova", None) quando esta requisição deve executar a rota,
+    ("concluida", registro), ("conflito", None) ou ("ocupada", None).
+    """
+    limite = time.monotonic() + IDEMPOTENCIA_ESPERA_S
+    while True:
+        with SessionLocal() as db:
+            agora = datetime.utcnow()
+            registro = db.get(ChaveIdempotencia, chave)
+            if registro is not None and registro.expira_em < agora:
+                # Reaproveita a chave vencida num UPDATE condicional: de duas
+                # requisições que a viram vencida, só uma muda a linha
+                assumiu = db.query(ChaveIdempotencia).filter(
+                    ChaveIdempotencia.chave == chave,
+                    ChaveIdempotencia.expira_em < agora
+                ).update({
+                    "hash_requisicao": hash_requisicao, "status": "EM_ANDAMENTO",
+                    "criado_em": agora, "expira_em": agora + timedelta(hours=IDEMPOTENCIA_TTL_HORAS),
+                    "codigo_resposta": None, "tipo_resposta": None, "corpo_resposta": None,
+                }, synchronize_session=False)
+                db.commit()
+                if assumiu:
+                    return "nova", None
+                continue
+
+            if registro is None:
+                db.add(ChaveIdempotencia(
+                    chave=chave, hash_requisicao=hash_requisicao, status="EM_ANDAMENTO",
+                    criado_em=agora, expira_em=agora + timedelta(hours=IDEMPOTENCIA_TTL_HORAS)
+                ))
+                try:
+                    db.commit()
+                except IntegrityError:
+                    # Outra requisição gravou a mesma chave primeiro
+                    db.rollback()
+                    continue
+                if random.random() < 0.01:
+                    db.query(ChaveIdempotencia).filter(ChaveIdempotencia.expira_em < agora).delete()
+                    db.commit()
+                return "nova", None
+
+            if registro.hash_requisicao != hash_requisicao:
+                return "conflito", None
+            if registro.status == "CONCLUIDA":
+                db.expunge(registro)
+                return "concluida", registro
+
+            if registro.criado_em < agora - timedelta(seconds=IDEMPOTENCIA_ABANDONO_S):
+                # Assume a chave abandonada; o UPDATE condicional impede que dois assumam
+                assumiu = db.query(ChaveIdempotencia).filter(
+                    ChaveIdempotencia.chave == chave,
+                    ChaveIdempotencia.status == "EM_ANDAMENTO",
+                    ChaveIdempotencia.criado_em == registro.criado_em
+                ).update({"criado_em": agora}, synchronize_session=False)
+                db.commit()
+                if assumiu:
+                    return "nova", None
+                continue
+
+        if time.monotonic() >= limite:
+            return "ocupada", None
+        time.sleep(INTERVALO_ESPERA_S)
+
+
+def _concluir(chave, response):
+    with SessionLocal() as db:
+        db.query(ChaveIdempotencia).filter(ChaveIdempotencia.chave == chave).update({
+            "status": "CONCLUIDA",
+            "codigo_resposta": response.status_code,
+            "tipo_resposta": response.mimetype,
+            "corpo_resposta": response.get_data(),
+        }, synchronize_session=False)
+        db.commit()
+
+
+def _liberar(chave):
+    with SessionLocal() as db:
+        db.query(ChaveIdempotencia).filter(
+            ChaveIdempotencia.chave == chave, ChaveIdempotencia.status == "EM_ANDAMENTO"
+        ).delete(synchronize_session=False)
+        db.commit()
+
+
+def idempotente(view):
+    """Decorator para rotas POST: aplica o Idempotency-Key quando o header vem."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        chave_cliente = request.headers.get("Idempotency-Key")
+        if not chave_cliente:
+            return view(*args, **kwargs)
+        if len(chave_cliente) > TAMANHO_MAXIMO_CHAVE:
+            return jsonify(detail="Idempotency-Key muito longa."), 400
+
+        dono = kwargs.get("cliente_id") or kwargs.get("loja_id") or "-"
+        chave = f"{request.endpoint}|{dono}|{chave_cliente}"
+        hash_requisicao = hashlib.sha256(request.get_data()).hexdigest()
+
+        situacao, registro = _reservar(chave, hash_requisicao)
+        if situacao == "conflito":
+            return jsonify(detail="Idempotency-Key já usada com outra requisição."), 422
+        if situacao == "ocupada":
+            resposta = jsonify(detail="Requisição com esta Idempotency-Key ainda em processamento.")
+            resposta.status_code = 409
+            resposta.headers["Retry-After"] = "1"
+            return resposta
+        if situacao == "concluida":
+            resposta = make_response(registro.corpo_resposta, registro.codigo_resposta)
+            resposta.mimetype = registro.tipo_resposta
+            resposta.headers["Idempotency-Replayed"] = "true"
+            return resposta
+
+        try:
+            resposta = make_response(view(*args, **kwargs))
+        except Exception:
+            _liberar(chave)
+            raise
+        if resposta.status_code >= 500:
+            _liberar(chave)
+        else:
+            _concluir(chave, resposta)
+        return resposta
+    return wrapper
@@ -0,0 +1,223 @@
+"""
+Importação em massa de produtos de uma loja.
+
+Lê um CSV ou NDJSON em streaming (uma linha por vez), valida cada linha,
+e grava em lotes com executemany fazendo upsert pela chave (loja_id, sku).
+Imagens opcionais vêm de um .zip e são referenciadas pela coluna `imagem`;
+só as imagens usadas são extraídas, direto do zip para o disco. Se o lote
+falhar, as imagens extraídas para ele são apagadas; se o upsert trocar a
+imagem de um produto, o arquivo antigo é apagado depois do commit.
+
+Colunas: sku, nome_produto, preco, quantidade_estoque (padrão 0), imagem.
+
+Uso pela linha de comando:
+    python importacao.py --loja 1 produtos.csv --imagens fotos.zip
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+import uuid
+import zipfile
+
+from sqlalchemy import bindparam, text
+
+import shards
+
+TAMANHO_LOTE = 1000
+MAX_ERROS_DETALHADOS = 100
+
+UPSERT_PRODUTO = text("""
+    INSERT INTO produtos (id, loja_id, sku, nome_produto, preco, quantidade_estoque, image_path)
+    VALUES (:id, :loja_id, :sku, :nome_produto, :preco, :quantidade_estoque, :image_path)
+    ON CONFLICT (loja_id, sku) DO UPDATE SET
+        nome_produto = excluded.nome_produto,
+        preco = excluded.preco,
+        quantidade_estoque = excluded.quantidade_estoque,
+        image_path = COALESCE(excluded.image_path, produtos.image_path),
+        removido_em = NULL
+""")
+
+IMAGENS_DOS_SKUS = text(
+    "SELECT image_path FROM produtos WHERE loja_id = :loja_id AND sku IN :skus AND image_path IS NOT NULL"
+).bindparams(bindparam("skus", expanding=True))
+
+
+class ErroLinha(ValueError):
+    pass
+
+
+def detectar_formato(nome_arquivo):
+    return "ndjson" if nome_arquivo.lower().endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+
+def ler_linhas(arquivo_binario, formato):
+    """Gera (numero_linha, dict) sem carregar o arquivo inteiro na memória."""
+    texto = io.TextIOWrapper(arquivo_binario, encoding="utf-8-sig", newline="")
+    if formato == "ndjson":
+        for numero, linha in enumerate(texto, start=1):
+            if not linha.strip():
+                continue
+            try:
+                dados = json.loads(linha)
+            except ValueError as exc:
+                yield numero, ErroLinha(f"JSON inválido: {exc}")
+                continue
+            yield numero, dados if isinstance(dados, dict) else ErroLinha("A linha não é um objeto JSON.")
+    else:
+        # A linha 1 é o cabeçalho
+        for numero, dados in enumerate(csv.DictReader(texto), start=2):
+            yield numero, dados
+
+
+def validar_linha(dados):
+    sku = str(dados.get("sku") or "").strip()
+    nome_produto = str(dados.get("nome_produto") or "").strip()
+    if not sku:
+        raise ErroLinha("sku é obrigatório.")
+    if not nome_produto:
+        raise ErroLinha("nome_produto é obrigatório.")
+    try:
+        preco = float(dados.get("preco"))
+    except (TypeError, ValueError):
+        raise ErroLinha("preco inválido.")
+    try:
+        quantidade_estoque = int(dados.get("quantidade_estoque") or 0)
+    except (TypeError, ValueError):
+        raise ErroLinha("quantidade_estoque inválida.")
+    if preco < 0 or quantidade_estoque < 0:
+        raise ErroLinha("preco e quantidade_estoque não podem ser negativos.")
+    return {
+        "sku": sku,
+        "nome_produto": nome_produto,
+        "preco": preco,
+        "quantidade_estoque": quantidade_estoque,
+        "imagem": (dados.get("imagem") or "").strip() or None,
+    }
+
+
+def extrair_imagem(zip_imagens, nome, loja_id):
+    """Copia uma imagem do zip para /images, no mesmo padrão de nome do cadastro."""
+    if zip_imagens is None:
+        raise ErroLinha(f"Imagem {nome} referenciada, mas nenhum zip foi enviado.")
+    try:
+        info = zip_imagens.getinfo(nome)
+    except KeyError:
+        raise ErroLinha(f"Imagem {nome} não encontrada no zip.")
+    ext = nome.rsplit(".", 1)[-1].lower()
+    if ext not in ("jpg", "jpeg", "png", "gif", "webp"):
+        raise ErroLinha(f"Imagem {nome} não é uma imagem válida.")
+    caminho_arquivo = os.path.join("images", f"loja_{loja_id}_{uuid.uuid4()}.{ext}")
+    with zip_imagens.open(info) as origem, open(caminho_arquivo, "wb") as destino:
+        shutil.copyfileobj(origem, destino)
+    return caminho_arquivo
+
+
+def remover_imagens(caminhos):
+    for caminho in caminhos:
+        if caminho and os.path.exists(caminho):
+            os.remove(caminho)
+
+
+def importar_produtos(engine, loja_id, arquivo_binario, formato, arquivo_zip=None):
+    """
+    Importa os produtos para a loja e devolve um relatório com os totais e
+    os erros por linha (os primeiros MAX_ERROS_DETALHADOS são detalhados).
+    `engine` é o banco da loja (shards.motor com SHARDS ligado).
+    """
+    zip_imagens = zipfile.ZipFile(arquivo_zip) if arquivo_zip is not None else None
+    relatorio = {"linhas": 0, "importadas": 0, "com_erro": 0, "erros": []}
+    lote = []
+
+    def gravar():
+        novas = {r["image_path"] for r in lote if r["image_path"]}
+        with engine.begin() as conn:
+            # Com SHARDS os ids vêm do contador do banco (id NULL = rowid do SQLite)
+            primeiro = shards.alocar_ids(conn, "produtos", len(lote)) if shards.ativo() else None
+            for i, registro in enumerate(lote):
+                registro["id"] = primeiro + i if primeiro is not None else None
+            skus = sorted({r["sku"] for r in lote if r["image_path"]})
+            parametros = {"loja_id": loja_id, "skus": skus}
+            antigas = set(conn.execute(IMAGENS_DOS_SKUS, parametros).scalars()) if skus else set()
+            conn.execute(UPSERT_PRODUTO, lote)
+            # Sobra o que o upsert substituiu (inclusive SKU repetido com imagem no mesmo lote)
+            usadas = set(conn.execute(IMAGENS_DOS_SKUS, parametros).scalars()) if skus else set()
+        remover_imagens((antigas | novas) - usadas)
+        relatorio["importadas"] += len(lote)
+        lote.clear()
+
+    try:
+        for numero, dados in ler_linhas(arquivo_binario, formato):
+            relatorio["linhas"] += 1
+            try:
+                if isinstance(dados, ErroLinha):
+                    raise dados
+                registro = validar_linha(dados)
+                imagem = registro.pop("imagem")
+                registro["image_path"] = extrair_imagem(zip_imagens, imagem, loja_id) if imagem else None
+            except ErroLinha as erro:
+                relatorio["com_erro"] += 1
+                if len(relatorio["erros"]) < MAX_ERROS_DETALHADOS:
+                    relatorio["erros"].append({"linha": numero, "erro": str(erro)})
+                continue
+            registro["loja_id"] = loja_id
+            lote.append(registro)
+            if len(lote) >= TAMANHO_LOTE:
+                gravar()
+        if lote:
+            gravar()
+    except BaseException:
+        # Lote não gravado: as imagens extraídas para ele ficariam órfãs
+        remover_imagens(r["image_path"] for r in lote)
+        raise
+    finally:
+        if zip_imagens is not None:
+            zip_imagens.close()
+    return relatorio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("arquivo", help="CSV ou NDJSON com os produtos")
+    parser.add_argument("--loja", type=int, required=True)
+    parser.add_argument("--imagens", help="zip com as imagens referenciadas")
+    parser.add_argument("--formato", choices=["csv", "ndjson"])
+    args = parser.parse_args()
+
+    from database import engine
+    from models import Loja
+    from sqlalchemy.orm import Session
+
+    import contadores
+
+    with Session(engine) as db:
+        if not db.query(Loja.id).filter(Loja.id == args.loja).first():
+            print("Loja não encontrada.", file=sys.stderr)
+            return 1
+    catalogo = engine
+    if shards.ativo():
+        shards.preparar()
+        engine = shards.motor(shards.shard_da_loja(args.loja))
+
+    os.makedirs("images", exist_ok=True)
+    zip_imagens = open(args.imagens, "rb") if args.imagens else None
+    try:
+        with open(args.arquivo, "rb") as arquivo:
+            relatorio = importar_produtos(
+                engine, args.loja, arquivo, args.formato or detectar_formato(args.arquivo), zip_imagens
+            )
+    finally:
+        if zip_imagens is not None:
+            zip_imagens.close()
+    # O upsert não passa pelas rotas: reconta a loja importada
+    with (shards.SessaoShards() if shards.ativo() else Session(catalogo)) as db:
+        contadores.recalcular(db, [args.loja], coletar=shards.coletar if shards.ativo() else None)
+    print(json.dumps(relatorio, indent=2, ensure_ascii=False))
+    return 0 if not relatorio["com_erro"] else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
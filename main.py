@@ -1,20 +1,42 @@
 import os
+import hmac
 import uuid
 import shutil
-from datetime import datetime, timedelta
+import zipfile
+from datetime import date, datetime, timedelta
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from passlib.context import CryptContext
+from sqlalchemy import case, func, literal, select
 from sqlalchemy.orm import Session
 from flasgger import Swagger
 from flask_cors import CORS
 
 # Importar nossa configuração de DB e modelos
-from database import Base, engine, SessionLocal
+from database import Base, engine, SessionLocal, migrar_esquema
 from models import (
     Cliente, Loja, Produto, Servico, ReservaServico, ReservaProduto,
-    Carrinho, ServicoHorario, ItemReserva, ItemReserva, ReservaProduto
+    Carrinho, ServicoHorario, ItemReserva, ItemReserva, ReservaProduto, EventoMudanca
 )
+import slow_queries
+import importacao
+import exportacao
+import analytics
+import colunar
+import eventos
+import arquivamento
+import cache_identidade
+import retencao
+import shards
+import replicas
+import autocomplete
+import contadores
+import geo
+from profiling import instalar_profiler
+from compressao import instalar_compressao
+from rate_limit import instalar_rate_limit
+from replicas import instalar_replicas
+from idempotencia import idempotente
 
 # Garantir que o diretório de imagens exista
 if not os.path.exists("images"):
@@ -23,14 +45,31 @@ if not os.path.exists("images"):
 app = Flask(__name__)
 swagger = Swagger(app)  # Inicializa o Flasgger
 CORS(app)
+instalar_profiler(app)  # X-Profile / PROFILE_SAMPLE_RATE -> profiles/*.collapsed
+instalar_compressao(app)  # gzip/br/zstd conforme Accept-Encoding
+instalar_rate_limit(app)  # token bucket por rota/cliente/IP (rate_limit.db)
+instalar_replicas(app)  # marca as escritas para o leia-o-que-escreveu das réplicas
+
+@app.errorhandler(shards.LojaEmMovimento)
+def loja_em_movimento(exc):
+    resposta = jsonify(detail="Loja em manutenção. Tente novamente em instantes.")
+    resposta.status_code = 503
+    resposta.headers["Retry-After"] = str(int(shards.SHARD_DIRETORIO_TTL_S) + 1)
+    return resposta
 
 @app.route("/images/<path:filename>")
 def serve_image(filename):
     """Serve arquivos de imagem do diretório /images."""
     return send_from_directory("images", filename)
 
-# Criar as tabelas no banco
-Base.metadata.create_all(bind=engine)
+# Criar as tabelas no banco (e colunas/índices novos em bancos já existentes)
+migrar_esquema(engine, Base.metadata)
+if shards.ativo():
+    shards.preparar()  # tabelas dos shards e contadores de id
+with engine.connect() as _conn:
+    _arquivo_anexado = arquivamento.arquivo_anexado(_conn)
+if _arquivo_anexado:
+    arquivamento.preparar(engine)  # índices novos em arquivos já existentes
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -40,14 +79,33 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+def fabrica_sessao():
+    """
+    Fábrica de sessões para a requisição atual: roteada entre shards com
+    SHARDS; numa réplica (REPLICAS) para leituras de quem não escreveu há pouco.
+    """
+    if shards.ativo():
+        return shards.SessaoShards
+    if replicas.ler_em_replica():
+        return replicas.sessao_leitura
+    return SessionLocal
+
 def get_db():
     """Função utilitária para obter sessão do banco de dados."""
-    db = SessionLocal()
+    db = fabrica_sessao()()
     try:
         yield db
     finally:
         db.close()
 
+def sessao_escrita():
+    """Sessão no banco principal (ou nos shards) fora da sessão da requisição, que pode ser de réplica."""
+    return (shards.SessaoShards if shards.ativo() else SessionLocal)()
+
+# Lojas de bancos anteriores aos contadores são contadas uma vez, na subida
+with sessao_escrita() as _db:
+    contadores.recalcular(_db, somente_sem_contagem=True, coletar=shards.coletar if shards.ativo() else None)
+
 # -------------------------------------------
 #  ROTAS DE CLIENTE (Registro / Login)
 # -------------------------------------------
@@ -230,6 +288,8 @@ def registrar_loja():
         latitude=float(latitude) if latitude else None,
         longitude=float(longitude) if longitude else None
     )
+    if shards.ativo():
+        nova_loja.shard = shards.shard_para_loja_nova()
     db.add(nova_loja)
     db.commit()
     db.refresh(nova_loja)
@@ -308,6 +368,10 @@ def obter_detalhes_loja(loja_id):
             lote: { type: string }
             latitude: { type: number }
             longitude: { type: number }
+            total_produtos: { type: integer }
+            produtos_em_estoque: { type: integer }
+            total_servicos: { type: integer }
+            reservas_pendentes: { type: integer }
       404:
         description: Loja não encontrada
     """
@@ -317,7 +381,141 @@ def obter_detalhes_loja(loja_id):
         return jsonify(detail="Loja não encontrada."), 404
     return jsonify(
         id=loja.id, nome_loja=loja.nome_loja, cnpj=loja.cnpj, cep=loja.cep, endereco=loja.endereco, complemento=loja.complemento, lote=loja.lote, latitude=loja.latitude, longitude=loja.longitude,
-        foto_path = loja.foto_path, descricao = loja.descricao
+        foto_path = loja.foto_path, descricao = loja.descricao,
+        **{campo: getattr(loja, campo) for campo in contadores.CAMPOS}
+    )
+
+# Campos que cada seção da página da loja aceita em `fields`
+CAMPOS_PAGINA_LOJA = {
+    "loja": {c: getattr(Loja, c) for c in (
+        "id", "nome_loja", "cnpj", "cep", "endereco", "complemento", "lote",
+        "latitude", "longitude", "foto_path", "descricao", *contadores.CAMPOS
+    )},
+    "produtos": {c: getattr(Produto, c) for c in (
+        "id", "nome_produto", "preco", "image_path", "quantidade_estoque", "quantidade_disponivel"
+    )},
+    "servicos": {c: getattr(Servico, c) for c in ("id", "nome_servico", "preco", "descricao")},
+}
+MAX_POR_PAGINA = 100
+
+def ler_campos_pagina(fields):
+    """
+    Interpreta `fields=loja.nome_loja,produtos.id,produtos.preco,...`.
+    Seções não citadas voltam completas; proximo_horario é um campo de servicos.
+    """
+    escolhidos = {secao: list(campos) for secao, campos in CAMPOS_PAGINA_LOJA.items()}
+    escolhidos["servicos"].append("proximo_horario")
+    if not fields:
+        return escolhidos
+    pedidos = {}
+    for item in fields.split(","):
+        secao, _, campo = item.strip().partition(".")
+        validos = escolhidos.get(secao, ())
+        if campo not in validos:
+            raise ValueError(item.strip())
+        pedidos.setdefault(secao, []).append(campo)
+    escolhidos.update(pedidos)
+    return escolhidos
+
+@app.route("/loja/<int:loja_id>/pagina", methods=["GET"])
+def pagina_loja(loja_id):
+    """
+    Página da loja em uma só chamada: perfil, produtos e serviços paginados e
+    o próximo horário livre de cada serviço.
+    ---
+    tags:
+      - Loja
+    parameters:
+      - name: loja_id
+        in: path
+        type: integer
+        required: true
+      - name: pagina
+        in: query
+        type: integer
+        default: 1
+      - name: por_pagina
+        in: query
+        type: integer
+        default: 20
+        description: Máximo 100 (vale para produtos e serviços)
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: "Campos a devolver, como secao.campo separados por vírgula (ex.: loja.nome_loja,produtos.id,produtos.preco,servicos.proximo_horario)"
+    responses:
+      200:
+        description: Perfil da loja, páginas de produtos e serviços e totais
+      400:
+        description: Parâmetros inválidos
+      404:
+        description: Loja não encontrada
+    """
+    db: Session = next(get_db())
+    retencao.varrer_antes_de_ler(sessao_escrita)
+    try:
+        pagina = max(int(request.args.get("pagina", 1)), 1)
+        por_pagina = min(max(int(request.args.get("por_pagina", 20)), 1), MAX_POR_PAGINA)
+    except ValueError:
+        return jsonify(detail="pagina e por_pagina devem ser inteiros."), 400
+    try:
+        campos = ler_campos_pagina(request.args.get("fields"))
+    except ValueError as exc:
+        return jsonify(detail=f"Campo inválido em fields: {exc}"), 400
+    offset = (pagina - 1) * por_pagina
+
+    # Perfil e totais numa consulta só (os totais são os contadores da loja, contadores.py)
+    colunas_loja = [CAMPOS_PAGINA_LOJA["loja"][c] for c in campos["loja"]]
+    linha = db.query(Loja.id, *colunas_loja, Loja.total_produtos, Loja.total_servicos).filter(Loja.id == loja_id).first()
+    if not linha:
+        return jsonify(detail="Loja não encontrada."), 404
+    valores_loja = linha[1:-2]
+
+    produtos = db.query(*(CAMPOS_PAGINA_LOJA["produtos"][c] for c in campos["produtos"])).filter(
+        Produto.loja_id == loja_id, Produto.removido_em == None
+    ).order_by(Produto.id).limit(por_pagina).offset(offset).all()
+
+    # O id do serviço é sempre buscado para casar com o próximo horário
+    campos_servico = [c for c in campos["servicos"] if c != "proximo_horario"]
+    servicos = db.query(Servico.id, *(CAMPOS_PAGINA_LOJA["servicos"][c] for c in campos_servico)).filter(
+        Servico.loja_id == loja_id
+    ).order_by(Servico.id).limit(por_pagina).offset(offset).all()
+
+    proximos = {}
+    if "proximo_horario" in campos["servicos"] and servicos:
+        # Horários em hora local (mesma comparação de cancelar_reserva)
+        agora = datetime.now()
+        ids = [s[0] for s in servicos]
+        primeiro = db.query(
+            ServicoHorario.servico_id, func.min(ServicoHorario.horario).label("horario")
+        ).filter(
+            ServicoHorario.servico_id.in_(ids),
+            ServicoHorario.is_disponivel == True,
+            ServicoHorario.horario >= agora
+        ).group_by(ServicoHorario.servico_id).subquery()
+        for servico_id, horario_id, horario in db.query(
+            ServicoHorario.servico_id, ServicoHorario.id, ServicoHorario.horario
+        ).join(primeiro, (primeiro.c.servico_id == ServicoHorario.servico_id) & (primeiro.c.horario == ServicoHorario.horario)).filter(
+            ServicoHorario.is_disponivel == True
+        ):
+            proximos.setdefault(servico_id, {"horario_id": horario_id, "datahora": horario})
+
+    resultado_servicos = []
+    for s in servicos:
+        item = dict(zip(campos_servico, s[1:]))
+        if "proximo_horario" in campos["servicos"]:
+            item["proximo_horario"] = proximos.get(s[0])
+        resultado_servicos.append(item)
+
+    return jsonify(
+        loja=dict(zip(campos["loja"], valores_loja)),
+        produtos=[dict(zip(campos["produtos"], p)) for p in produtos],
+        servicos=resultado_servicos,
+        pagina=pagina,
+        por_pagina=por_pagina,
+        total_produtos=linha[-2],
+        total_servicos=linha[-1],
     )
 
 
@@ -366,7 +564,7 @@ def cadastrar_produto_com_imagem(loja_id):
     """
     db: Session = next(get_db())
 
-    loja = db.query(Loja).filter(Loja.id == loja_id).first()
+    loja = cache_identidade.lojas.obter(db, loja_id)
     if not loja:
         return jsonify(detail="Loja não encontrada."), 404
 
@@ -399,6 +597,9 @@ def cadastrar_produto_com_imagem(loja_id):
         quantidade_estoque=int(quantidade_estoque),
     )
     db.add(novo_produto)
+    contadores.ajustar(
+        db, loja_id, total_produtos=1, produtos_em_estoque=contadores.em_estoque(novo_produto.quantidade_estoque)
+    )
     db.commit()
     db.refresh(novo_produto)
 
@@ -408,6 +609,65 @@ def cadastrar_produto_com_imagem(loja_id):
         image_path=novo_produto.image_path
     )
 
+@app.route("/loja/<int:loja_id>/produtos/importar", methods=["POST"])
+def importar_produtos_loja(loja_id):
+    """
+    Importa produtos em massa a partir de um CSV ou NDJSON (upsert por SKU).
+    ---
+    tags:
+      - Produtos
+    consumes:
+      - multipart/form-data
+    parameters:
+      - name: loja_id
+        in: path
+        type: integer
+        required: true
+      - name: arquivo
+        in: formData
+        type: file
+        required: true
+        description: CSV ou NDJSON com sku, nome_produto, preco, quantidade_estoque e imagem
+      - name: imagens
+        in: formData
+        type: file
+        required: false
+        description: Zip com as imagens referenciadas na coluna imagem
+      - name: formato
+        in: formData
+        type: string
+        enum: [csv, ndjson]
+        required: false
+    responses:
+      200:
+        description: Relatório da importação com os erros por linha
+      400:
+        description: Arquivo não enviado ou zip inválido
+      404:
+        description: Loja não encontrada
+    """
+    db: Session = next(get_db())
+    loja = cache_identidade.lojas.obter(db, loja_id)
+    if not loja:
+        return jsonify(detail="Loja não encontrada."), 404
+
+    arquivo = request.files.get("arquivo")
+    if not arquivo:
+        return jsonify(detail="Arquivo de produtos não foi enviado."), 400
+    formato = request.form.get("formato") or importacao.detectar_formato(arquivo.filename or "")
+    imagens = request.files.get("imagens")
+
+    try:
+        relatorio = importacao.importar_produtos(
+            shards.motor(shards.shard_da_loja(loja_id)) if shards.ativo() else engine, loja_id, arquivo.stream, formato, imagens.stream if imagens else None
+        )
+    except zipfile.BadZipFile:
+        return jsonify(detail="O arquivo de imagens não é um zip válido."), 400
+    autocomplete.expirar()  # o upsert em massa não passa pelo ORM
+    contadores.recalcular(db, [loja_id], coletar=shards.coletar if shards.ativo() else None)
+
+    return jsonify(mensagem="Importação concluída.", **relatorio)
+
 @app.route("/loja/<int:loja_id>/produtos", methods=["GET"])
 def listar_produtos_loja(loja_id):
     """
@@ -432,16 +692,20 @@ def listar_produtos_loja(loja_id):
               nome_produto: { type: string }
               preco: { type: number }
               image_path: { type: string }
+              quantidade_estoque: { type: integer }
+              quantidade_disponivel: { type: integer, description: Estoque menos o retido em carrinhos }
       404:
         description: Loja não encontrada
     """
     db: Session = next(get_db())
-    loja = db.query(Loja).filter(Loja.id == loja_id).first()
+    retencao.varrer_antes_de_ler(sessao_escrita)
+    loja = cache_identidade.lojas.obter(db, loja_id)
     if not loja:
         return jsonify(detail="Loja não encontrada."), 404
-    produtos = db.query(Produto).filter(Produto.loja_id == loja_id).all()
+    produtos = db.query(Produto).filter(Produto.loja_id == loja_id, Produto.removido_em == None).all()
     return jsonify([
-    {"id": p.id, "nome_produto": p.nome_produto, "preco": p.preco, "image_path": p.image_path, "quantidade_estoque": p.quantidade_estoque}
+    {"id": p.id, "nome_produto": p.nome_produto, "preco": p.preco, "image_path": p.image_path,
+     "quantidade_estoque": p.quantidade_estoque, "quantidade_disponivel": p.quantidade_disponivel}
     for p in produtos
 ])
 
@@ -464,7 +728,7 @@ def remover_produto(loja_id, produto_id):
         required: true
     responses:
       200:
-        description: Produto removido com sucesso
+        description: Produto removido com sucesso (ou desativado, se já foi reservado)
       404:
         description: Produto não encontrado ou não pertence à loja
     """
@@ -473,12 +737,30 @@ def remover_produto(loja_id, produto_id):
 
  # Check if the product exists and belongs to the specified store
         Produto.id == produto_id,
-        Produto.loja_id == loja_id
+        Produto.loja_id == loja_id,
+        Produto.removido_em == None
     ).first()
 
     if not produto:
         return jsonify(detail="Produto não encontrado ou não pertence à loja informada."), 404
 
+    db.query(Carrinho).filter(Carrinho.produto_id == produto_id).delete(synchronize_session=False)
+
+    # Produto que aparece em reservas (mesmo arquivadas) só é desativado: o
+    # histórico e a devolução de estoque de cancelar_expiradas dependem dele
+    contadores.ajustar(
+        db, loja_id, total_produtos=-1, produtos_em_estoque=-contadores.em_estoque(produto.quantidade_estoque)
+    )
+    referenciado = db.query(ItemReserva.id).filter(ItemReserva.produto_id == produto_id).first()
+    if not referenciado and arquivamento.arquivo_anexado(db.connection()):
+        itens_arquivados = arquivamento.itens_reserva_arquivo
+        referenciado = db.query(itens_arquivados.c.id).filter(itens_arquivados.c.produto_id == produto_id).first()
+    if referenciado:
+        produto.removido_em = datetime.utcnow()
+        produto.quantidade_retida = 0  # as retenções saíram com os itens de carrinho
+        db.commit()
+        return jsonify(mensagem="Produto removido com sucesso.")
+
     db.delete(produto)
     db.commit()
 
@@ -530,6 +812,7 @@ def marcar_retirada(loja_id, reserva_id):
         return jsonify(detail=f"Não é possível marcar retirada com status {reserva.status}."), 400
 
     reserva.status = "RETIRADO"
+    analytics.registrar_transicao_produto(db, reserva, "RETIRADO")
     db.commit()
     db.refresh(reserva)
     return jsonify(mensagem="Reserva marcada como RETIRADA.")
@@ -564,7 +847,10 @@ def cancelar_expiradas(loja_id):
         reserva.status = "CANCELADO"
         for item in reserva.itens:
             produto = db.query(Produto).filter(Produto.id == item.produto_id).first()
+            quantidade_anterior = produto.quantidade_estoque
             produto.quantidade_estoque += item.quantidade
+            contadores.estoque_mudou(db, produto, quantidade_anterior)
+        analytics.registrar_transicao_produto(db, reserva, "CANCELADO")
         db.commit()
 
     # Reservas não retiradas até 4 dias
@@ -578,7 +864,10 @@ def cancelar_expiradas(loja_id):
         reserva.status = "CANCELADO"
         for item in reserva.itens:
             produto = db.query(Produto).filter(Produto.id == item.produto_id).first()
+            quantidade_anterior = produto.quantidade_estoque
             produto.quantidade_estoque += item.quantidade
+            contadores.estoque_mudou(db, produto, quantidade_anterior)
+        analytics.registrar_transicao_produto(db, reserva, "CANCELADO")
         db.commit()
 
     return jsonify(mensagem="Reservas expiradas foram canceladas e estoque devolvido.")
@@ -616,7 +905,7 @@ def listar_servicos_loja(loja_id):
         description: Loja não encontrada
     """
     db: Session = next(get_db())
-    loja = db.query(Loja).filter(Loja.id == loja_id).first()
+    loja = cache_identidade.lojas.obter(db, loja_id)
     if not loja:
         return jsonify(detail="Loja não encontrada."), 404
     
@@ -666,7 +955,7 @@ def cadastrar_servico(loja_id):
     preco = data.get("preco")
     descricao = data.get("descricao") or ""
 
-    loja = db.query(Loja).filter(Loja.id == loja_id).first()
+    loja = cache_identidade.lojas.obter(db, loja_id)
     if not loja:
         return jsonify(detail="Loja não encontrada."), 404
     
@@ -680,6 +969,7 @@ def cadastrar_servico(loja_id):
         loja_id=loja_id
     )
     db.add(novo_servico)
+    contadores.ajustar(db, loja_id, total_servicos=1)
     db.commit()
     db.refresh(novo_servico)
     return jsonify(mensagem="Serviço cadastrado com sucesso", servico_id=novo_servico.id)
@@ -688,15 +978,17 @@ def cadastrar_servico(loja_id):
 def remover_servico(loja_id, servico_id):
     db: Session = next(get_db())
     servico = (
-        db.query(Servico)
+        db.query(Servico.id)
           .filter(Servico.id == servico_id, Servico.loja_id == loja_id)
           .first()
     )
     if not servico:
         return jsonify(detail="Serviço não encontrado ou não pertence à loja informada."), 404
 
-    # Só isso já é suficiente:
-    db.delete(servico)
+    # Dois DELETEs em massa: os horários não são carregados na sessão
+    db.query(ServicoHorario).filter(ServicoHorario.servico_id == servico_id).delete(synchronize_session=False)
+    db.query(Servico).filter(Servico.id == servico_id).delete(synchronize_session=False)
+    contadores.ajustar(db, loja_id, total_servicos=-1)
     db.commit()
     return jsonify(mensagem="Serviço removido com sucesso."), 200
 
@@ -789,6 +1081,7 @@ def criar_horarios_servico(loja_id, servico_id):
     if not servico:
         return jsonify(detail="Serviço não encontrado para esta loja."), 404
 
+    criados = []
     for h_str in horarios:
         try:
             h = datetime.fromisoformat(h_str)
@@ -808,10 +1101,76 @@ def criar_horarios_servico(loja_id, servico_id):
             is_disponivel=True
         )
         db.add(novo_horario)
+        criados.append(novo_horario)
 
+    if criados:
+        db.flush()
+        eventos.horarios(db, loja_id, servico_id, "horarios_criados", criados)
     db.commit()
     return jsonify(mensagem="Horários adicionados ao serviço com sucesso.")
 
+def incluir_arquivo_pedido():
+    return request.args.get("incluir_arquivo", "").lower() in ("1", "true", "sim")
+
+def consultar_agenda(db, coluna_dono, dono_id):
+    """
+    Agenda filtrada por de/ate/status (índices dono + data_horario), já com os
+    nomes de serviço e loja, ou agrupada por dia/semana se vier `agrupar`.
+    Com incluir_arquivo=1 as reservas arquivadas entram também.
+    Levanta ValueError com a mensagem para parâmetros inválidos.
+    """
+    try:
+        de, ate, status = ler_filtros_periodo()
+    except ValueError:
+        raise ValueError("Datas devem estar no formato ISO (AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS).")
+    agrupar = request.args.get("agrupar")
+    if agrupar not in (None, "dia", "semana"):
+        raise ValueError("agrupar deve ser dia ou semana.")
+
+    def montar(t):
+        consulta = select(
+            t.c.id, t.c.cliente_id, t.c.loja_id, t.c.servico_id, t.c.data_horario, t.c.status
+        ).where(t.c[coluna_dono] == dono_id)
+        if de:
+            consulta = consulta.where(t.c.data_horario >= de)
+        if ate:
+            consulta = consulta.where(t.c.data_horario < ate)
+        if status:
+            consulta = consulta.where(t.c.status.in_(status))
+        return consulta
+    r = arquivamento.consulta_historico(
+        db.connection(), montar, [ReservaServico.__table__], [arquivamento.reservas_servicos_arquivo],
+        incluir_arquivo_pedido()
+    )
+
+    if agrupar:
+        inicio = func.date(r.c.data_horario)
+        if agrupar == "semana":
+            inicio = func.date(r.c.data_horario, "weekday 0", "-6 days")
+        grupos = {}
+        for dia, st, quantidade in db.query(inicio, r.c.status, func.count()).group_by(
+            inicio, r.c.status
+        ).order_by(inicio):
+            grupo = grupos.setdefault(dia, {"inicio": dia, "total": 0, "por_status": {}})
+            grupo["total"] += quantidade
+            # Com SHARDS a agenda do cliente chega em uma parte por shard
+            grupo["por_status"][st] = grupo["por_status"].get(st, 0) + quantidade
+        return {"agrupar": agrupar, "grupos": sorted(grupos.values(), key=lambda g: g["inicio"])}
+
+    linhas = db.query(
+        r.c.id, r.c.cliente_id, r.c.loja_id, r.c.servico_id, r.c.data_horario, r.c.status,
+        Servico.nome_servico, Servico.preco, Loja.nome_loja
+    ).select_from(r).outerjoin(Servico, Servico.id == r.c.servico_id).outerjoin(
+        Loja, Loja.id == r.c.loja_id
+    ).order_by(r.c.data_horario)
+    if shards.ativo():
+        linhas = sorted(linhas, key=lambda linha: linha.data_horario)
+    return [{
+        "reserva_id": r_id, "cliente_id": cliente_id, "loja_id": loja_id, "servico_id": servico_id,
+        "data_horario": data_horario, "status": st,
+        "nome_servico": nome_servico, "preco": preco, "nome_loja": nome_loja,
+    } for r_id, cliente_id, loja_id, servico_id, data_horario, st, nome_servico, preco, nome_loja in linhas]
+
 @app.route("/loja/<int:loja_id>/agenda", methods=["GET"])
 def ver_agenda_reservas(loja_id):
     """
@@ -824,28 +1183,108 @@ def ver_agenda_reservas(loja_id):
         in: path
         type: integer
         required: true
+      - name: de
+        in: query
+        type: string
+        required: false
+        description: Início do período (AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS)
+      - name: ate
+        in: query
+        type: string
+        required: false
+        description: Fim do período (exclusivo; só a data inclui o dia inteiro)
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Status separados por vírgula (PENDENTE,ACEITO,...)
+      - name: agrupar
+        in: query
+        type: string
+        enum: [dia, semana]
+        required: false
+        description: Devolve só a contagem por dia/semana (início na segunda) e status
+      - name: incluir_arquivo
+        in: query
+        type: boolean
+        required: false
+        description: Inclui as reservas já arquivadas (arquivamento.py)
     responses:
       200:
-        description: Retorna a lista de reservas de serviço
+        description: Lista de reservas com nome_servico, preco e nome_loja (ou grupos, com agrupar)
+      400:
+        description: Filtros inválidos
       404:
         description: Loja não encontrada
     """
     db: Session = next(get_db())
-    loja = db.query(Loja).filter(Loja.id == loja_id).first()
+    loja = cache_identidade.lojas.obter(db, loja_id)
     if not loja:
         return jsonify(detail="Loja não encontrada."), 404
 
-    reservas = db.query(ReservaServico).filter(ReservaServico.loja_id == loja_id).all()
-    retorno = []
-    for r in reservas:
-        retorno.append({
-            "reserva_id": r.id,
-            "cliente_id": r.cliente_id,
-            "servico_id": r.servico_id,
-            "data_horario": r.data_horario,
-            "status": r.status
-        })
-    return jsonify(agenda_loja=retorno)
+    try:
+        agenda = consultar_agenda(db, "loja_id", loja_id)
+    except ValueError as exc:
+        return jsonify(detail=str(exc)), 400
+    if isinstance(agenda, dict):
+        return jsonify(**agenda)
+    return jsonify(agenda_loja=agenda)
+
+def ler_ultimo_evento(db):
+    """Id a partir do qual o feed começa: Last-Event-ID, ?ultimo_id= ou o evento mais recente."""
+    valor = request.headers.get("Last-Event-ID") or request.args.get("ultimo_id")
+    if valor is None:
+        return eventos.ultimo_id(db)
+    return int(valor)
+
+def resposta_sse(filtro, desde):
+    return Response(
+        eventos.gerar_sse(fabrica_sessao(), filtro, desde),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route("/loja/<int:loja_id>/agenda/eventos", methods=["GET"])
+def eventos_agenda_loja(loja_id):
+    """
+    Feed SSE das mudanças da loja: reservas de serviço criadas ou com status
+    alterado, reservas de produto criadas e horários criados, ocupados ou liberados.
+    ---
+    tags:
+      - Serviços
+    produces:
+      - text/event-stream
+    parameters:
+      - name: loja_id
+        in: path
+        type: integer
+        required: true
+      - name: Last-Event-ID
+        in: header
+        type: integer
+        required: false
+        description: Continua a partir deste evento (enviado pelo EventSource ao reconectar)
+      - name: ultimo_id
+        in: query
+        type: integer
+        required: false
+        description: Igual ao Last-Event-ID, para clientes que não mandam o header
+    responses:
+      200:
+        description: Stream de eventos (event = tipo, data = JSON)
+      400:
+        description: Id de evento inválido
+      404:
+        description: Loja não encontrada
+    """
+    db: Session = next(get_db())
+    if not cache_identidade.lojas.obter(db, loja_id):
+        return jsonify(detail="Loja não encontrada."), 404
+    try:
+        desde = ler_ultimo_evento(db)
+    except ValueError:
+        return jsonify(detail="Last-Event-ID inválido."), 400
+    return resposta_sse(EventoMudanca.loja_id == loja_id, desde)
 
 @app.route("/loja/reserva/<int:reserva_id>/aceitar", methods=["PUT"])
 def aceitar_reserva(reserva_id):
@@ -875,7 +1314,11 @@ def aceitar_reserva(reserva_id):
     if reserva.status == "ACEITO":
         return jsonify(detail="Reserva já está aceita."), 400
 
+    analytics.registrar_status_servico(db, reserva, reserva.status, "ACEITO")
+    status_anterior = reserva.status
     reserva.status = "ACEITO"
+    contadores.status_servico_mudou(db, reserva, status_anterior)
+    eventos.reserva_servico(db, reserva, "reserva_servico_status", status_anterior)
     db.commit()
     db.refresh(reserva)
     return jsonify(mensagem="Reserva aceita com sucesso!")
@@ -908,7 +1351,11 @@ def rejeitar_reserva(reserva_id):
     if reserva.status == "REJEITADA":
         return jsonify(detail="Reserva já está rejeitada."), 400
 
+    analytics.registrar_status_servico(db, reserva, reserva.status, "REJEITADA")
+    status_anterior = reserva.status
     reserva.status = "REJEITADA"
+    contadores.status_servico_mudou(db, reserva, status_anterior)
+    eventos.reserva_servico(db, reserva, "reserva_servico_status", status_anterior)
     db.commit()
     db.refresh(reserva)
     return jsonify(mensagem="Reserva rejeitada com sucesso!")
@@ -1013,7 +1460,8 @@ def atualizar_perfil_loja(loja_id):
 @app.route("/lojas", methods=["GET"])
 def listar_lojas():
     """
-    Lista todas as lojas cadastradas.
+    Lista todas as lojas cadastradas, com os contadores de produtos, serviços
+    e reservas pendentes lidos da própria linha da loja.
     ---
     tags:
       - Loja
@@ -1031,14 +1479,65 @@ def listar_lojas():
             "cnpj": l.cnpj,
             "endereco": l.endereco,
             "latitude": l.latitude,
-            "longitude": l.longitude
+            "longitude": l.longitude,
+            **{campo: getattr(l, campo) for campo in contadores.CAMPOS}
         })
     return jsonify(lojas=retorno)
 
+# Limites superiores das faixas de preço da faceta; a última faixa fica aberta
+FAIXAS_PRECO = (50, 100, 250, 500, 1000)
+ORDENS_PRODUTOS = {
+    "preco": ((Produto.preco, Produto.id), lambda p: (p.preco, p.id)),
+    "-preco": ((Produto.preco.desc(), Produto.id), lambda p: (-p.preco, p.id)),
+    "nome": ((Produto.nome_produto, Produto.id), lambda p: (p.nome_produto, p.id)),
+    # Sem data de cadastro: o id crescente já é a ordem de inserção
+    "recentes": ((Produto.id.desc(),), lambda p: -p.id),
+}
+RAIO_PADRAO_KM = 10.0
+
+def ler_filtros_produtos(args):
+    """
+    Lê os filtros, a ordem e a paginação de /produtos.
+    Levanta ValueError com a mensagem para parâmetros inválidos.
+    """
+    filtros = {}
+    try:
+        filtros["loja_id"] = int(args["loja_id"]) if args.get("loja_id") else None
+        filtros["preco_min"] = float(args["preco_min"]) if args.get("preco_min") else None
+        filtros["preco_max"] = float(args["preco_max"]) if args.get("preco_max") else None
+    except ValueError:
+        raise ValueError("loja_id, preco_min e preco_max devem ser números.")
+    filtros["em_estoque"] = args.get("em_estoque") in ("1", "true")
+    filtros["lat"], filtros["lon"] = args.get("lat"), args.get("lon")
+    if (filtros["lat"] is None) != (filtros["lon"] is None):
+        raise ValueError("lat e lon devem ser informados juntos.")
+    if filtros["lat"] is not None:
+        try:
+            filtros["lat"], filtros["lon"] = float(filtros["lat"]), float(filtros["lon"])
+            filtros["raio_km"] = float(args.get("raio_km", RAIO_PADRAO_KM))
+        except ValueError:
+            raise ValueError("lat, lon e raio_km devem ser números.")
+    ordenar = args.get("ordenar")
+    if ordenar not in (None, "distancia", *ORDENS_PRODUTOS):
+        raise ValueError(f"ordenar deve ser um de: {', '.join((*ORDENS_PRODUTOS, 'distancia'))}.")
+    if ordenar == "distancia" and filtros["lat"] is None:
+        raise ValueError("ordenar=distancia exige lat e lon.")
+    filtros["ordenar"] = ordenar
+    filtros["paginar"] = "pagina" in args or "por_pagina" in args
+    try:
+        filtros["pagina"] = max(int(args.get("pagina", 1)), 1)
+        filtros["por_pagina"] = min(max(int(args.get("por_pagina", 20)), 1), MAX_POR_PAGINA)
+    except ValueError:
+        raise ValueError("pagina e por_pagina devem ser inteiros.")
+    return filtros
+
 @app.route("/produtos", methods=["GET"])
 def buscar_produtos():
     """
-    Busca produtos, opcionalmente filtrando por loja_id e nome_produto.
+    Busca produtos com filtros, ordenação, paginação e facetas.
+    Cada combinação de filtros cai num dos índices parciais de produtos
+    (ix_produtos_ativos_*, ix_produtos_em_estoque_preco). As facetas saem de uma
+    só consulta agrupada por loja e faixa de preço, com os mesmos filtros.
     ---
     tags:
       - Produtos
@@ -1051,31 +1550,158 @@ def buscar_produtos():
         in: query
         type: string
         required: false
+      - name: preco_min
+        in: query
+        type: number
+        required: false
+      - name: preco_max
+        in: query
+        type: number
+        required: false
+      - name: em_estoque
+        in: query
+        type: integer
+        required: false
+        description: 1 para só produtos com quantidade disponível
+      - name: lat
+        in: query
+        type: number
+        required: false
+        description: Com lon, só produtos de lojas a até raio_km do ponto
+      - name: lon
+        in: query
+        type: number
+        required: false
+      - name: raio_km
+        in: query
+        type: number
+        required: false
+        default: 10
+      - name: ordenar
+        in: query
+        type: string
+        enum: [preco, -preco, nome, recentes, distancia]
+        required: false
+      - name: pagina
+        in: query
+        type: integer
+        required: false
+        description: Sem pagina e por_pagina a lista vem inteira
+      - name: por_pagina
+        in: query
+        type: integer
+        required: false
+        default: 20
+      - name: facetas
+        in: query
+        type: integer
+        required: false
+        description: 1 para incluir contagens por faixa de preço e por loja
     responses:
       200:
         description: Retorna lista de produtos
+      400:
+        description: Parâmetros inválidos
     """
     db: Session = next(get_db())
+    retencao.varrer_antes_de_ler(sessao_escrita)
 
-    loja_id = request.args.get("loja_id")
+    try:
+        filtros = ler_filtros_produtos(request.args)
+    except ValueError as exc:
+        return jsonify(detail=str(exc)), 400
     nome_produto = request.args.get("nome_produto")
+    com_facetas = request.args.get("facetas") in ("1", "true")
+    loja_id = filtros["loja_id"]
+
+    distancias = None
+    if filtros["lat"] is not None:
+        distancias = geo.lojas_proximas(db, filtros["lat"], filtros["lon"], filtros["raio_km"])
 
-    query = db.query(Produto)
+    condicoes = [Produto.removido_em == None]
     if loja_id:
-        query = query.filter(Produto.loja_id == int(loja_id))
+        condicoes.append(Produto.loja_id == loja_id)
+    if distancias is not None:
+        condicoes.append(Produto.loja_id.in_(distancias))
     if nome_produto:
-        query = query.filter(Produto.nome_produto.ilike(f"%{nome_produto}%"))
-    produtos = query.all()
+        condicoes.append(Produto.nome_produto.ilike(f"%{nome_produto}%"))
+    if filtros["preco_min"] is not None:
+        condicoes.append(Produto.preco >= filtros["preco_min"])
+    if filtros["preco_max"] is not None:
+        condicoes.append(Produto.preco <= filtros["preco_max"])
+    if filtros["em_estoque"]:
+        # Mesma expressão do índice parcial ix_produtos_em_estoque_preco
+        condicoes.append(Produto.quantidade_estoque > Produto.quantidade_retida)
+
+    if filtros["ordenar"] == "distancia":
+        distancia = case(distancias, value=Produto.loja_id) if distancias else literal(0)
+        ordem = (distancia, Produto.id)
+        chave = lambda p: (distancias[p.loja_id], p.id)
+    else:
+        ordem, chave = ORDENS_PRODUTOS.get(filtros["ordenar"], ((Produto.id,), lambda p: p.id))
+    faixa = case(
+        *((Produto.preco < limite, i) for i, limite in enumerate(FAIXAS_PRECO)), else_=len(FAIXAS_PRECO)
+    )
+    offset = (filtros["pagina"] - 1) * filtros["por_pagina"]
+
+    def consultar(sessao, deslocamento):
+        query = sessao.query(
+            Produto.id, Produto.nome_produto, Produto.preco, Produto.loja_id, Produto.quantidade_disponivel
+        ).filter(*condicoes).order_by(*ordem)
+        if filtros["paginar"]:
+            query = query.limit(filtros["por_pagina"] + offset - deslocamento).offset(deslocamento)
+        agregado = []
+        if com_facetas or filtros["paginar"]:
+            agregado = sessao.query(Produto.loja_id, faixa, func.count()).filter(
+                *condicoes
+            ).group_by(Produto.loja_id, faixa).all()
+        return query.all(), agregado
+
+    if shards.ativo() and not loja_id:
+        # Cada shard devolve o começo da sua lista até o fim da página; a
+        # página sai da junção ordenada, e as facetas somam as dos shards
+        partes = shards.coletar(lambda sessao: [consultar(sessao, 0)])
+        produtos = sorted((p for linhas, _ in partes for p in linhas), key=chave)
+        if filtros["paginar"]:
+            produtos = produtos[offset:offset + filtros["por_pagina"]]
+        agregado = [a for _, linhas in partes for a in linhas]
+    else:
+        produtos, agregado = consultar(db, offset)
 
     resultado = []
     for p in produtos:
-        resultado.append({
+        item = {
             "id": p.id,
             "nome_produto": p.nome_produto,
             "preco": p.preco,
-            "loja_id": p.loja_id
-        })
-    return jsonify(produtos=resultado)
+            "loja_id": p.loja_id,
+            "quantidade_disponivel": p.quantidade_disponivel
+        }
+        if distancias is not None:
+            item["distancia_km"] = round(distancias[p.loja_id], 3)
+        resultado.append(item)
+
+    retorno = {"produtos": resultado}
+    if filtros["paginar"]:
+        retorno.update(
+            total=sum(n for _, _, n in agregado), pagina=filtros["pagina"], por_pagina=filtros["por_pagina"]
+        )
+    if com_facetas:
+        por_loja, por_faixa = {}, [0] * (len(FAIXAS_PRECO) + 1)
+        for loja, indice_faixa, n in agregado:
+            por_loja[loja] = por_loja.get(loja, 0) + n
+            por_faixa[indice_faixa] += n
+        limites = (0, *FAIXAS_PRECO, None)
+        retorno["facetas"] = {
+            "faixas_preco": [
+                {"de": limites[i], "ate": limites[i + 1], "quantidade": n} for i, n in enumerate(por_faixa)
+            ],
+            "lojas": [
+                {"loja_id": loja, "quantidade": n}
+                for loja, n in sorted(por_loja.items(), key=lambda item: (-item[1], item[0]))
+            ],
+        }
+    return jsonify(**retorno)
 
 @app.route("/servicos", methods=["GET"])
 def buscar_servicos():
@@ -1101,12 +1727,14 @@ def buscar_servicos():
     loja_id = request.args.get("loja_id")
     nome_servico = request.args.get("nome_servico")
 
-    query = db.query(Servico)
-    if loja_id:
-        query = query.filter(Servico.loja_id == int(loja_id))
-    if nome_servico:
-        query = query.filter(Servico.nome_servico.ilike(f"%{nome_servico}%"))
-    servicos = query.all()
+    def consultar(sessao):
+        query = sessao.query(Servico)
+        if loja_id:
+            query = query.filter(Servico.loja_id == int(loja_id))
+        if nome_servico:
+            query = query.filter(Servico.nome_servico.ilike(f"%{nome_servico}%"))
+        return query.all()
+    servicos = shards.coletar(consultar) if shards.ativo() and not loja_id else consultar(db)
 
     resultado = []
     for s in servicos:
@@ -1119,6 +1747,167 @@ def buscar_servicos():
         })
     return jsonify(servicos=resultado)
 
+MAX_PROXIMOS = 100
+
+@app.route("/servicos/proximo_horario", methods=["GET"])
+def buscar_proximo_horario():
+    """
+    Próximo horário livre dos serviços de lojas perto do cliente ("o conserto
+    de freio mais cedo a até 5 km"), em uma chamada. As lojas saem da caixa de
+    latitude/longitude (ix_lojas_lat_lon); para cada serviço delas o primeiro
+    horário livre depois de `apos` é uma busca no índice parcial
+    ix_servicos_horarios_livres, sem ler os demais horários.
+    ---
+    tags:
+      - Serviços
+    parameters:
+      - name: lat
+        in: query
+        type: number
+        required: true
+      - name: lon
+        in: query
+        type: number
+        required: true
+      - name: raio_km
+        in: query
+        type: number
+        required: false
+        default: 10
+      - name: nome_servico
+        in: query
+        type: string
+        required: false
+      - name: apos
+        in: query
+        type: string
+        required: false
+        description: Data/hora ISO local a partir da qual buscar (padrão agora)
+      - name: ordenar
+        in: query
+        type: string
+        enum: [horario, distancia]
+        required: false
+        default: horario
+        description: Critério principal; o outro desempata
+      - name: limite
+        in: query
+        type: integer
+        required: false
+        default: 20
+    responses:
+      200:
+        description: Serviços com o próximo horário livre, do mais cedo (ou mais perto)
+      400:
+        description: Parâmetros inválidos
+    """
+    db: Session = next(get_db())
+    try:
+        lat, lon = float(request.args["lat"]), float(request.args["lon"])
+        raio_km = float(request.args.get("raio_km", RAIO_PADRAO_KM))
+    except (KeyError, ValueError):
+        return jsonify(detail="lat e lon são obrigatórios e, com raio_km, devem ser números."), 400
+    try:
+        # Os horários são gravados na hora local, como em cancelar_reserva
+        apos = datetime.fromisoformat(request.args["apos"]) if request.args.get("apos") else datetime.now()
+        limite = min(max(int(request.args.get("limite", 20)), 1), MAX_PROXIMOS)
+    except ValueError:
+        return jsonify(detail="apos deve ser data/hora ISO e limite inteiro."), 400
+    ordenar = request.args.get("ordenar", "horario")
+    if ordenar not in ("horario", "distancia"):
+        return jsonify(detail="ordenar deve ser horario ou distancia."), 400
+    nome_servico = request.args.get("nome_servico")
+
+    distancias = geo.lojas_proximas(db, lat, lon, raio_km)
+    if not distancias:
+        return jsonify(servicos=[])
+
+    def consultar(sessao):
+        primeiro_livre = select(ServicoHorario.id).where(
+            ServicoHorario.servico_id == Servico.id,
+            ServicoHorario.is_disponivel == True,
+            ServicoHorario.horario >= apos
+        ).order_by(ServicoHorario.horario).limit(1).correlate(Servico).scalar_subquery()
+        query = sessao.query(
+            Servico.id, Servico.nome_servico, Servico.preco, Servico.loja_id,
+            ServicoHorario.id.label("horario_id"), ServicoHorario.horario
+        ).join(ServicoHorario, ServicoHorario.id == primeiro_livre).filter(Servico.loja_id.in_(distancias))
+        if nome_servico:
+            query = query.filter(Servico.nome_servico.ilike(f"%{nome_servico}%"))
+        return query.all()
+    linhas = shards.coletar(consultar) if shards.ativo() else consultar(db)
+
+    if ordenar == "horario":
+        chave = lambda s: (s.horario, distancias[s.loja_id], s.id)
+    else:
+        chave = lambda s: (distancias[s.loja_id], s.horario, s.id)
+    linhas = sorted(linhas, key=chave)[:limite]
+    nomes = dict(db.query(Loja.id, Loja.nome_loja).filter(Loja.id.in_({s.loja_id for s in linhas})).all())
+
+    resultado = []
+    for s in linhas:
+        resultado.append({
+            "servico_id": s.id,
+            "nome_servico": s.nome_servico,
+            "preco": s.preco,
+            "loja_id": s.loja_id,
+            "nome_loja": nomes.get(s.loja_id),
+            "distancia_km": round(distancias[s.loja_id], 3),
+            "horario_id": s.horario_id,
+            "datahora": s.horario
+        })
+    return jsonify(servicos=resultado)
+
+MAX_SUGESTOES = 50
+
+def carregar_autocomplete(db):
+    itens = shards.coletar(autocomplete.itens_do_banco) if shards.ativo() else autocomplete.itens_do_banco(db)
+    return itens, autocomplete.popularidade(db)
+
+@app.route("/autocomplete", methods=["GET"])
+def autocompletar():
+    """
+    Sugestões para a caixa de busca: produtos e serviços com alguma palavra
+    começando pelo texto digitado, os mais reservados primeiro.
+    ---
+    tags:
+      - Produtos
+      - Serviços
+    parameters:
+      - name: q
+        in: query
+        type: string
+        required: true
+      - name: tipo
+        in: query
+        type: string
+        enum: [produto, servico]
+        required: false
+      - name: limite
+        in: query
+        type: integer
+        default: 10
+        description: Máximo 50
+    responses:
+      200:
+        description: Lista de sugestões (tipo, id, nome, loja_id)
+      400:
+        description: Parâmetros inválidos
+    """
+    db: Session = next(get_db())
+    tipo = request.args.get("tipo")
+    if tipo not in (None, "produto", "servico"):
+        return jsonify(detail="tipo deve ser produto ou servico."), 400
+    try:
+        limite = min(max(int(request.args.get("limite", 10)), 1), MAX_SUGESTOES)
+    except ValueError:
+        return jsonify(detail="limite deve ser inteiro."), 400
+
+    autocomplete.garantir_carregado(lambda: carregar_autocomplete(db))
+    return jsonify(sugestoes=autocomplete.sugerir(
+        request.args.get("q", ""), limite, (tipo,) if tipo else ("produto", "servico")
+    ))
+
 # -------------------------------------------
 #  CARRINHO DE COMPRAS
 # -------------------------------------------
@@ -1150,13 +1939,14 @@ def adicionar_item_carrinho(cliente_id):
               default: 1
     responses:
       200:
-        description: Produto adicionado ou quantidade atualizada
+        description: Produto adicionado ou quantidade atualizada (com retenção ativa, o estoque fica retido até retido_ate)
       400:
-        description: Dados incompletos ou produtos de outra loja
+        description: Dados incompletos, produtos de outra loja ou estoque disponível insuficiente
       404:
         description: Cliente ou produto não encontrado
     """
     db: Session = next(get_db())
+    retencao.varrer_se_preciso(db)
 
     data = request.get_json()
     if not data:
@@ -1167,12 +1957,15 @@ def adicionar_item_carrinho(cliente_id):
 
     if not produto_id:
         return jsonify(detail="É necessário informar produto_id."), 400
+    # Quantidade negativa viraria retenção negativa e aumentaria o disponível dos outros clientes
+    if not isinstance(quantidade, int) or isinstance(quantidade, bool) or quantidade <= 0:
+        return jsonify(detail="quantidade deve ser um inteiro positivo."), 400
     
-    cliente = db.query(Cliente).filter(Cliente.id == cliente_id).first()
+    cliente = cache_identidade.clientes.obter(db, cliente_id)
     if not cliente:
         return jsonify(detail="Cliente não encontrado."), 404
     
-    produto = db.query(Produto).filter(Produto.id == produto_id).first()
+    produto = db.query(Produto).filter(Produto.id == produto_id, Produto.removido_em == None).first()
     if not produto:
         return jsonify(detail="Produto não encontrado."), 404
 
@@ -1189,20 +1982,149 @@ def adicionar_item_carrinho(cliente_id):
     ).first()
 
     if item_existente:
-        item_existente.quantidade += int(quantidade)
+        item_existente.quantidade += quantidade
+        if not retencao.reter(db, item_existente, item_existente.quantidade):
+            db.rollback()
+            return jsonify(detail=f"Estoque insuficiente para o produto {produto.nome_produto}."), 400
         db.commit()
         db.refresh(item_existente)
-        return jsonify(mensagem="Quantidade atualizada no carrinho.")
+        return jsonify(mensagem="Quantidade atualizada no carrinho.", retido_ate=item_existente.retido_ate)
     else:
         novo_item = Carrinho(
             cliente_id=cliente_id,
             produto_id=int(produto_id),
-            quantidade=int(quantidade)
+            quantidade=quantidade,
+            quantidade_retida=0
         )
+        if not retencao.reter(db, novo_item, novo_item.quantidade):
+            db.rollback()
+            return jsonify(detail=f"Estoque insuficiente para o produto {produto.nome_produto}."), 400
         db.add(novo_item)
         db.commit()
         db.refresh(novo_item)
-        return jsonify(mensagem="Produto adicionado ao carrinho.")
+        return jsonify(mensagem="Produto adicionado ao carrinho.", retido_ate=novo_item.retido_ate)
+
+@app.route("/cliente/<int:cliente_id>/carrinho/lote", methods=["POST"])
+def operacoes_carrinho_lote(cliente_id):
+    """
+    Aplica várias operações no carrinho numa única transação.
+    ---
+    tags:
+      - Carrinho
+    consumes:
+      - application/json
+    parameters:
+      - name: cliente_id
+        in: path
+        type: integer
+        required: true
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            operacoes:
+              type: array
+              items:
+                type: object
+                properties:
+                  acao:
+                    type: string
+                    enum: [adicionar, atualizar, remover]
+                  produto_id:
+                    type: integer
+                  quantidade:
+                    type: integer
+              example: [{"acao": "adicionar", "produto_id": 1, "quantidade": 2}, {"acao": "remover", "produto_id": 3}]
+    responses:
+      200:
+        description: Operações aplicadas; retorna o carrinho resultante
+      400:
+        description: Operação inválida, produtos de lojas diferentes ou estoque disponível insuficiente
+      404:
+        description: Cliente ou produto não encontrado
+    """
+    db: Session = next(get_db())
+    retencao.varrer_se_preciso(db)
+
+    data = request.get_json()
+    operacoes = (data or {}).get("operacoes")
+    if not isinstance(operacoes, list) or not operacoes:
+        return jsonify(detail="É necessário informar uma lista de operações."), 400
+
+    normalizadas = []
+    for op in operacoes:
+        acao = op.get("acao") if isinstance(op, dict) else None
+        if acao not in ("adicionar", "atualizar", "remover"):
+            return jsonify(detail=f"Ação inválida: {acao}."), 400
+        try:
+            produto_id = int(op.get("produto_id"))
+            quantidade = int(op.get("quantidade", 1))
+        except (TypeError, ValueError):
+            return jsonify(detail="produto_id e quantidade devem ser inteiros."), 400
+        if acao == "adicionar" and quantidade <= 0:
+            return jsonify(detail="A quantidade a adicionar deve ser positiva."), 400
+        normalizadas.append((acao, produto_id, quantidade))
+
+    cliente = cache_identidade.clientes.obter(db, cliente_id)
+    if not cliente:
+        return jsonify(detail="Cliente não encontrado."), 404
+
+    itens = {i.produto_id: i for i in db.query(Carrinho).filter(Carrinho.cliente_id == cliente_id).all()}
+
+    # Uma única consulta traz loja, nome e preço de tudo que está ou vai entrar no carrinho
+    ids = set(itens) | {produto_id for _, produto_id, _ in normalizadas}
+    produtos = {
+        p.id: p for p in db.query(
+            Produto.id, Produto.loja_id, Produto.nome_produto, Produto.preco
+        ).filter(Produto.id.in_(ids), Produto.removido_em == None).all()
+    }
+
+    for acao, produto_id, quantidade in normalizadas:
+        if acao != "remover" and produto_id not in produtos:
+            db.rollback()
+            return jsonify(detail=f"Produto {produto_id} não encontrado."), 404
+
+        item = itens.get(produto_id)
+        if acao == "remover" or (acao == "atualizar" and quantidade <= 0):
+            if item:
+                retencao.soltar(db, item)
+                db.delete(item)
+                del itens[produto_id]
+            continue
+        if item:
+            item.quantidade = item.quantidade + quantidade if acao == "adicionar" else quantidade
+        else:
+            item = itens[produto_id] = Carrinho(
+                cliente_id=cliente_id, produto_id=produto_id, quantidade=quantidade, quantidade_retida=0
+            )
+            db.add(item)
+        if not retencao.reter(db, item, item.quantidade):
+            db.rollback()
+            return jsonify(detail=f"Estoque insuficiente para o produto {produtos[produto_id].nome_produto}."), 400
+
+    lojas = {produtos[pid].loja_id for pid in itens if pid in produtos}
+    if len(lojas) > 1:
+        db.rollback()
+        return jsonify(detail="Carrinho conteria produtos de lojas diferentes."), 400
+
+    # flush atribui os ids; o resultado é montado antes do commit expirar os objetos
+    db.flush()
+    resultado = []
+    for produto_id, i in itens.items():
+        produto = produtos.get(produto_id)
+        resultado.append({
+            "carrinho_item_id": i.id,
+            "produto_id": produto_id,
+            "nome_produto": produto.nome_produto if produto else None,
+            "quantidade": i.quantidade,
+            "preco_unitario": produto.preco if produto else None,
+            "subtotal": (produto.preco * i.quantidade) if produto else None,
+            "retido_ate": i.retido_ate
+        })
+    db.commit()
+    return jsonify(mensagem="Carrinho atualizado.", itens_carrinho=resultado)
 
 @app.route("/cliente/<int:cliente_id>/carrinho", methods=["DELETE"])
 def remover_item_carrinho(cliente_id):
@@ -1234,7 +2156,7 @@ def remover_item_carrinho(cliente_id):
     if not produto_id:
         return jsonify(detail="É necessário informar produto_id para remoção."), 400
 
-    cliente = db.query(Cliente).filter(Cliente.id == cliente_id).first()
+    cliente = cache_identidade.clientes.obter(db, cliente_id)
     if not cliente:
         return jsonify(detail="Cliente não encontrado."), 404
 
@@ -1246,6 +2168,7 @@ def remover_item_carrinho(cliente_id):
     if not item:
         return jsonify(detail="Item não está no carrinho."), 404
 
+    retencao.soltar(db, item)
     db.delete(item)
     db.commit()
     return jsonify(mensagem="Item removido do carrinho.")
@@ -1279,11 +2202,13 @@ def visualizar_carrinho(cliente_id):
             "nome_produto": produto.nome_produto if produto else None,
             "quantidade": i.quantidade,
             "preco_unitario": produto.preco if produto else None,
-            "subtotal": (produto.preco * i.quantidade) if produto else None
+            "subtotal": (produto.preco * i.quantidade) if produto else None,
+            "retido_ate": i.retido_ate
         })
     return jsonify(itens_carrinho=resultado)
 
 @app.route("/cliente/<int:cliente_id>/finalizar_carrinho", methods=["POST"])
+@idempotente
 def finalizar_carrinho(cliente_id):
     """
     Finaliza o carrinho de compras, criando uma reserva de produtos.
@@ -1291,6 +2216,11 @@ def finalizar_carrinho(cliente_id):
     tags:
       - Carrinho
     parameters:
+      - name: Idempotency-Key
+        in: header
+        type: string
+        required: false
+        description: Repetições com a mesma chave recebem a resposta original
       - name: cliente_id
         in: path
         type: integer
@@ -1304,6 +2234,7 @@ def finalizar_carrinho(cliente_id):
         description: Produto no carrinho não existe
     """
     db: Session = next(get_db())
+    retencao.varrer_se_preciso(db)
     itens_carrinho = db.query(Carrinho).filter(Carrinho.cliente_id == cliente_id).all()
 
     if not itens_carrinho:
@@ -1322,14 +2253,29 @@ def finalizar_carrinho(cliente_id):
             if produto.loja_id != loja_id:
                 return jsonify(detail="Carrinho possui produtos de lojas diferentes."), 400
 
-        if produto.quantidade_estoque < item.quantidade:
+        # O que o próprio item retém já está descontado do disponível
+        if produto.quantidade_disponivel + item.quantidade_retida < item.quantidade:
             return jsonify(detail=f"Estoque insuficiente para o produto {produto.nome_produto}."), 400
 
-    # Abater estoque
+    # Abater estoque e soltar a retenção na mesma transação que apaga o
+    # carrinho. A retenção é lida da linha do carrinho dentro do próprio
+    # UPDATE: se uma varredura já a liberou, não é descontada duas vezes
     for item in itens_carrinho:
-        produto = db.query(Produto).filter(Produto.id == item.produto_id).first()
-        produto.quantidade_estoque -= item.quantidade
-        db.commit()
+        retida_item = func.coalesce(
+            select(Carrinho.quantidade_retida).where(Carrinho.id == item.id).scalar_subquery(), 0
+        )
+        abatido = db.query(Produto).filter(
+            Produto.id == item.produto_id,
+            Produto.quantidade_estoque - Produto.quantidade_retida + retida_item >= item.quantidade
+        ).update({
+            Produto.quantidade_estoque: Produto.quantidade_estoque - item.quantidade,
+            Produto.quantidade_retida: Produto.quantidade_retida - retida_item,
+        }, synchronize_session=False)
+        if not abatido:
+            db.rollback()
+            return jsonify(detail="Estoque insuficiente para um dos produtos do carrinho."), 400
+        produto = db.query(Produto).filter(Produto.id == item.produto_id).populate_existing().first()
+        contadores.estoque_mudou(db, produto, produto.quantidade_estoque + item.quantidade)
 
     # Criar reserva
     reserva = ReservaProduto(
@@ -1340,10 +2286,10 @@ def finalizar_carrinho(cliente_id):
     )
     reserva.data_limite = reserva.data_reserva + timedelta(days=2)
     db.add(reserva)
-    db.commit()
-    db.refresh(reserva)
+    db.flush()
 
     # Criar itens de reserva
+    novos_itens = []
     for item in itens_carrinho:
         produto = db.query(Produto).filter(Produto.id == item.produto_id).first()
         novo_item = ItemReserva(
@@ -1353,8 +2299,13 @@ def finalizar_carrinho(cliente_id):
             preco_unitario=produto.preco
         )
         db.add(novo_item)
+        novos_itens.append(novo_item)
 
-    db.commit()
+    analytics.registrar_reserva_produto(db, reserva, novos_itens)
+    eventos.registrar(db, loja_id, "reserva_produto_criada", {
+        "reserva_id": reserva.id, "cliente_id": cliente_id,
+        "data_limite": reserva.data_limite, "itens": len(novos_itens),
+    })
 
     # Limpar carrinho
     for item in itens_carrinho:
@@ -1408,6 +2359,7 @@ def cliente_marcar_retirada(cliente_id, reserva_id):
         return jsonify(detail="Já se passaram 4 dias, não é mais possível marcar como retirada."), 400
 
     reserva.status = "RETIRADO"
+    analytics.registrar_transicao_produto(db, reserva, "RETIRADO")
     db.commit()
     db.refresh(reserva)
 
@@ -1447,7 +2399,47 @@ def listar_horarios_disponiveis(servico_id):
         })
     return jsonify(horarios_disponiveis=resultado)
 
+@app.route("/servico/<int:servico_id>/horarios_disponiveis/eventos", methods=["GET"])
+def eventos_horarios_servico(servico_id):
+    """
+    Feed SSE dos horários do serviço (horarios_criados, horario_ocupado, horario_liberado).
+    ---
+    tags:
+      - Serviços
+    produces:
+      - text/event-stream
+    parameters:
+      - name: servico_id
+        in: path
+        type: integer
+        required: true
+      - name: Last-Event-ID
+        in: header
+        type: integer
+        required: false
+      - name: ultimo_id
+        in: query
+        type: integer
+        required: false
+    responses:
+      200:
+        description: Stream de eventos de horário
+      400:
+        description: Id de evento inválido
+      404:
+        description: Serviço não encontrado
+    """
+    db: Session = next(get_db())
+    if not cache_identidade.servicos.obter(db, servico_id):
+        return jsonify(detail="Serviço não encontrado."), 404
+    try:
+        desde = ler_ultimo_evento(db)
+    except ValueError:
+        return jsonify(detail="Last-Event-ID inválido."), 400
+    return resposta_sse(EventoMudanca.servico_id == servico_id, desde)
+
 @app.route("/cliente/<int:cliente_id>/servicos/<int:servico_id>/agendar", methods=["POST"])
+@idempotente
 def agendar_servico(cliente_id, servico_id):
     """
     Agenda um serviço para um determinado horário.
@@ -1457,6 +2449,11 @@ def agendar_servico(cliente_id, servico_id):
     consumes:
       - application/json
     parameters:
+      - name: Idempotency-Key
+        in: header
+        type: string
+        required: false
+        description: Repetições com a mesma chave recebem a resposta original
       - name: cliente_id
         in: path
         type: integer
@@ -1488,11 +2485,11 @@ def agendar_servico(cliente_id, servico_id):
     if not horario_id:
         return jsonify(detail="É necessário informar horario_id."), 400
 
-    cliente = db.query(Cliente).filter(Cliente.id == cliente_id).first()
+    cliente = cache_identidade.clientes.obter(db, cliente_id)
     if not cliente:
         return jsonify(detail="Cliente não encontrado."), 404
 
-    servico = db.query(Servico).filter(Servico.id == servico_id).first()
+    servico = cache_identidade.servicos.obter(db, servico_id)
     if not servico:
         return jsonify(detail="Serviço não encontrado."), 404
 
@@ -1525,8 +2522,13 @@ def agendar_servico(cliente_id, servico_id):
         status="PENDENTE"
     )
     db.add(nova_reserva)
+    analytics.registrar_status_servico(db, nova_reserva, None, "PENDENTE")
+    contadores.status_servico_mudou(db, nova_reserva)
 
     horario_disponivel.is_disponivel = False
+    db.flush()
+    eventos.reserva_servico(db, nova_reserva, "reserva_servico_criada")
+    eventos.horarios(db, servico.loja_id, servico_id, "horario_ocupado", [horario_disponivel])
     db.commit()
     db.refresh(nova_reserva)
     return jsonify(mensagem="Serviço agendado com sucesso.", reserva_id=nova_reserva.id)
@@ -1575,7 +2577,11 @@ def cancelar_reserva(cliente_id, reserva_id):
     if reserva.status not in ["PENDENTE", "ACEITO"]:
         return jsonify(detail="Não é possível cancelar neste status."), 400
 
+    analytics.registrar_status_servico(db, reserva, reserva.status, "CANCELADO")
+    status_anterior = reserva.status
     reserva.status = "CANCELADO"
+    contadores.status_servico_mudou(db, reserva, status_anterior)
+    eventos.reserva_servico(db, reserva, "reserva_servico_status", status_anterior)
     db.commit()
     db.refresh(reserva)
 
@@ -1585,6 +2591,7 @@ def cancelar_reserva(cliente_id, reserva_id):
     ).first()
     if horario_disponivel:
         horario_disponivel.is_disponivel = True
+        eventos.horarios(db, reserva.loja_id, reserva.servico_id, "horario_liberado", [horario_disponivel])
         db.commit()
 
     return jsonify(mensagem="Reserva cancelada com sucesso.")
@@ -1601,24 +2608,46 @@ def ver_agenda_cliente(cliente_id):
         in: path
         type: integer
         required: true
+      - name: de
+        in: query
+        type: string
+        required: false
+        description: Início do período (AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS)
+      - name: ate
+        in: query
+        type: string
+        required: false
+        description: Fim do período (exclusivo; só a data inclui o dia inteiro)
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Status separados por vírgula (PENDENTE,ACEITO,...)
+      - name: agrupar
+        in: query
+        type: string
+        enum: [dia, semana]
+        required: false
+        description: Devolve só a contagem por dia/semana (início na segunda) e status
+      - name: incluir_arquivo
+        in: query
+        type: boolean
+        required: false
+        description: Inclui as reservas já arquivadas (arquivamento.py)
     responses:
       200:
-        description: Retorna a lista de reservas do cliente
+        description: Lista de reservas com nome_servico, preco e nome_loja (ou grupos, com agrupar)
+      400:
+        description: Filtros inválidos
     """
     db: Session = next(get_db())
-    reservas = db.query(ReservaServico).filter(ReservaServico.cliente_id == cliente_id).all()
-
-    retorno = []
-    for r in reservas:
-        retorno.append({
-            "reserva_id": r.id,
-            "cliente_id": r.cliente_id,
-            "loja_id": r.loja_id,
-            "servico_id": r.servico_id,
-            "data_horario": r.data_horario,
-            "status": r.status
-        })
-    return jsonify(agenda_cliente=retorno)
+    try:
+        agenda = consultar_agenda(db, "cliente_id", cliente_id)
+    except ValueError as exc:
+        return jsonify(detail=str(exc)), 400
+    if isinstance(agenda, dict):
+        return jsonify(**agenda)
+    return jsonify(agenda_cliente=agenda)
 
 # -------------------------------------------
 #  ATUALIZAR PERFIL CLIENTE (mantido como multipart se enviar foto)
@@ -1698,6 +2727,286 @@ def atualizar_perfil_cliente(cliente_id):
         foto_path=cliente.foto_path
     )
 
+# -------------------------------------------
+#  ANALYTICS (rollups diários)
+# -------------------------------------------
+
+@app.route("/loja/<int:loja_id>/dashboard", methods=["GET"])
+def dashboard_loja(loja_id):
+    """
+    Receita por dia, produtos mais vendidos e taxas de não retirada/cancelamento.
+    ---
+    tags:
+      - Analytics
+    parameters:
+      - name: loja_id
+        in: path
+        type: integer
+        required: true
+      - name: de
+        in: query
+        type: string
+        required: false
+        description: Data inicial AAAA-MM-DD (padrão, 30 dias atrás)
+      - name: ate
+        in: query
+        type: string
+        required: false
+        description: Data final AAAA-MM-DD, inclusiva (padrão, hoje)
+    responses:
+      200:
+        description: Indicadores da loja no período, lidos dos rollups diários
+      400:
+        description: Datas inválidas
+      404:
+        description: Loja não encontrada
+    """
+    db: Session = next(get_db())
+    loja = cache_identidade.lojas.obter(db, loja_id)
+    if not loja:
+        return jsonify(detail="Loja não encontrada."), 404
+
+    try:
+        ate = date.fromisoformat(request.args["ate"]) if request.args.get("ate") else datetime.utcnow().date()
+        de = date.fromisoformat(request.args["de"]) if request.args.get("de") else ate - timedelta(days=30)
+    except ValueError:
+        return jsonify(detail="Datas devem estar no formato AAAA-MM-DD."), 400
+
+    resultado = analytics.dashboard(db, loja_id, de, ate + timedelta(days=1))
+    return jsonify(loja_id=loja_id, de=de.isoformat(), ate=ate.isoformat(), **resultado)
+
+# -------------------------------------------
+#  EXPORTAÇÃO (streaming NDJSON / CSV)
+# -------------------------------------------
+
+def ler_filtros_periodo():
+    """
+    Lê os filtros de/ate (ISO 8601) e status (separados por vírgula) da query
+    string. Um 'ate' só com a data inclui o dia inteiro.
+    """
+    de = request.args.get("de")
+    ate = request.args.get("ate")
+    de = datetime.fromisoformat(de) if de else None
+    if ate:
+        ate_dt = datetime.fromisoformat(ate)
+        ate = ate_dt + timedelta(days=1) if len(ate) == 10 else ate_dt
+    status = [s for s in request.args.get("status", "").split(",") if s]
+    return de, ate, status or None
+
+def resposta_exportacao(loja_id, nome, colunas, consulta):
+    """Monta a resposta em streaming; a sessão vive enquanto o gerador é consumido."""
+    db: Session = next(get_db())
+    loja = cache_identidade.lojas.obter(db, loja_id)
+    db.close()
+    if not loja:
+        return jsonify(detail="Loja não encontrada."), 404
+
+    formato = request.args.get("formato", "ndjson")
+    if formato not in ("ndjson", "csv"):
+        return jsonify(detail="Formato deve ser ndjson ou csv."), 400
+    try:
+        de, ate, status = ler_filtros_periodo()
+    except ValueError:
+        return jsonify(detail="Datas devem estar no formato ISO (AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS)."), 400
+
+    gerar_formato = exportacao.gerar_csv if formato == "csv" else exportacao.gerar_ndjson
+    incluir_arquivo = incluir_arquivo_pedido()
+
+    fabrica = fabrica_sessao()
+
+    def gerar():
+        sessao = fabrica()
+        try:
+            yield from gerar_formato(colunas, consulta(sessao, loja_id, de, ate, status, incluir_arquivo))
+        finally:
+            sessao.close()
+
+    return Response(
+        stream_with_context(gerar()),
+        mimetype="text/csv" if formato == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename=loja_{loja_id}_{nome}.{formato}"}
+    )
+
+@app.route("/loja/<int:loja_id>/exportar/agenda", methods=["GET"])
+def exportar_agenda(loja_id):
+    """
+    Exporta as reservas de serviço da loja em streaming.
+    ---
+    tags:
+      - Exportação
+    parameters:
+      - name: loja_id
+        in: path
+        type: integer
+        required: true
+      - name: formato
+        in: query
+        type: string
+        enum: [ndjson, csv]
+        required: false
+      - name: de
+        in: query
+        type: string
+        required: false
+        description: Data/hora inicial (ISO 8601)
+      - name: ate
+        in: query
+        type: string
+        required: false
+        description: Data/hora final (ISO 8601, exclusiva; só a data inclui o dia)
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Status separados por vírgula (ex. ACEITO,PENDENTE)
+      - name: incluir_arquivo
+        in: query
+        type: boolean
+        required: false
+        description: Inclui as reservas já arquivadas (arquivamento.py)
+    responses:
+      200:
+        description: Linhas da agenda em NDJSON ou CSV
+      400:
+        description: Formato ou datas inválidos
+      404:
+        description: Loja não encontrada
+    """
+    return resposta_exportacao(loja_id, "agenda", exportacao.COLUNAS_AGENDA, exportacao.linhas_agenda)
+
+@app.route("/loja/<int:loja_id>/exportar/reservas_produtos", methods=["GET"])
+def exportar_reservas_produtos(loja_id):
+    """
+    Exporta as reservas de produto da loja (uma linha por item) em streaming.
+    ---
+    tags:
+      - Exportação
+    parameters:
+      - name: loja_id
+        in: path
+        type: integer
+        required: true
+      - name: formato
+        in: query
+        type: string
+        enum: [ndjson, csv]
+        required: false
+      - name: de
+        in: query
+        type: string
+        required: false
+      - name: ate
+        in: query
+        type: string
+        required: false
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Status separados por vírgula (ex. RETIRADO,CANCELADO)
+      - name: incluir_arquivo
+        in: query
+        type: boolean
+        required: false
+        description: Inclui as reservas já arquivadas (arquivamento.py)
+    responses:
+      200:
+        description: Itens reservados em NDJSON ou CSV
+      400:
+        description: Formato ou datas inválidos
+      404:
+        description: Loja não encontrada
+    """
+    return resposta_exportacao(
+        loja_id, "reservas_produtos", exportacao.COLUNAS_RESERVAS_PRODUTOS, exportacao.linhas_reservas_produtos
+    )
+
+# -------------------------------------------
+#  DIAGNÓSTICO (protegido por DIAGNOSTICO_TOKEN)
+# -------------------------------------------
+
+def diagnostico_autorizado() -> bool:
+    """Verifica o header X-Diagnostico-Token contra a variável DIAGNOSTICO_TOKEN."""
+    token = os.environ.get("DIAGNOSTICO_TOKEN")
+    enviado = request.headers.get("X-Diagnostico-Token", "")
+    return bool(token) and hmac.compare_digest(enviado, token)
+
+@app.route("/diagnostico/consultas_lentas", methods=["GET"])
+def relatorio_consultas_lentas():
+    """
+    Relatório das consultas SQL mais lentas, com EXPLAIN QUERY PLAN.
+    ---
+    tags:
+      - Diagnóstico
+    parameters:
+      - name: X-Diagnostico-Token
+        in: header
+        type: string
+        required: true
+    responses:
+      200:
+        description: Consultas agregadas por instrução e SCANs por tabela
+      403:
+        description: Token de diagnóstico ausente ou inválido
+    """
+    if not diagnostico_autorizado():
+        return jsonify(detail="Acesso ao diagnóstico não autorizado."), 403
+    return jsonify(slow_queries.relatorio())
+
+@app.route("/diagnostico/relatorio_rede", methods=["GET"])
+def relatorio_rede():
+    """
+    Relatório da rede inteira calculado sobre os snapshots colunares (colunar.py).
+    O snapshot é atualizado incrementalmente antes do cálculo.
+    ---
+    tags:
+      - Diagnóstico
+    parameters:
+      - name: X-Diagnostico-Token
+        in: header
+        type: string
+        required: true
+      - name: de
+        in: query
+        type: string
+        format: date
+      - name: ate
+        in: query
+        type: string
+        format: date
+        description: Data final (exclusiva)
+      - name: status
+        in: query
+        type: string
+        enum: [RESERVADO, RETIRADO, CANCELADO, TODOS]
+        default: RETIRADO
+    responses:
+      200:
+        description: Percentis de receita por loja, tamanho das cestas e elasticidade por região
+      400:
+        description: Parâmetros inválidos
+      403:
+        description: Token de diagnóstico ausente ou inválido
+      503:
+        description: Indisponível com SHARDS ligado (o snapshot só lê o banco principal)
+    """
+    if not diagnostico_autorizado():
+        return jsonify(detail="Acesso ao diagnóstico não autorizado."), 403
+    if shards.ativo():
+        # Um relatório sem as lojas dos shards pareceria completo
+        return jsonify(detail="Relatório da rede indisponível com SHARDS ligado."), 503
+    try:
+        de = date.fromisoformat(request.args["de"]) if request.args.get("de") else None
+        ate = date.fromisoformat(request.args["ate"]) if request.args.get("ate") else None
+    except ValueError:
+        return jsonify(detail="Datas devem estar no formato AAAA-MM-DD."), 400
+    status = request.args.get("status", "RETIRADO").upper()
+    if status != "TODOS" and status not in colunar.STATUS:
+        return jsonify(detail="Status inválido."), 400
+
+    colunar.atualizar(engine)
+    return jsonify(colunar.relatorio_rede(colunar.carregar(), de, ate, None if status == "TODOS" else status))
+
 if __name__ == "__main__":
     # Executar a aplicação Flask
     # Você pode configurar host='0.0.0.0' se quiser expor em rede
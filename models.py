@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Boolean, Index, LargeBinary, text
+from sqlalchemy.orm import column_property, relationship
 from datetime import datetime
 from database import Base
 
@@ -36,10 +36,25 @@ class Loja(Base):
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
 
+    # Shard com os dados da loja (shards.py); NULL = dados neste banco (lojas anteriores ao sharding)
+    shard = Column(Integer, nullable=True)
+    em_movimento = Column(Boolean, nullable=False, default=False, server_default="0")
+
+    # Contadores mantidos pelas rotas (contadores.py); NULL = ainda não contados (bancos antigos)
+    total_produtos = Column(Integer, nullable=True, default=0)
+    produtos_em_estoque = Column(Integer, nullable=True, default=0)
+    total_servicos = Column(Integer, nullable=True, default=0)
+    reservas_pendentes = Column(Integer, nullable=True, default=0)
+
     produtos = relationship("Produto", back_populates="loja")
     servicos = relationship("Servico", back_populates="loja")
     reservas = relationship("ReservaServico", back_populates="loja")
 
+    __table_args__ = (
+        # Caixa de latitude/longitude da busca por proximidade (geo.py)
+        Index("ix_lojas_lat_lon", "latitude", "longitude"),
+    )
+
 
 class Produto(Base):
     __tablename__ = "produtos"
@@ -52,8 +67,35 @@ class Produto(Base):
     image_path = Column(String, nullable=True)
     quantidade_estoque = Column(Integer, default=0)
 
+    # Código do produto no sistema da loja, usado como chave na importação em massa
+    sku = Column(String, nullable=True)
+
+    # Remoção lógica: produtos que aparecem em reservas saem das listagens mas ficam no banco
+    removido_em = Column(DateTime, nullable=True)
+
+    # Soma das retenções ativas dos carrinhos (retencao.py), mantida junto com elas
+    quantidade_retida = Column(Integer, nullable=False, default=0, server_default="0")
+    quantidade_disponivel = column_property(quantidade_estoque - quantidade_retida)
+
     loja = relationship("Loja", back_populates="produtos")
 
+    __table_args__ = (
+        Index("ix_produtos_loja_sku", "loja_id", "sku", unique=True),
+        # Filtros e ordenações de /produtos. Parciais: só produtos ativos (e, no
+        # último, com disponível), que é o que a listagem sempre filtra.
+        # loja/proximidade + faixa ou ordem de preço
+        Index("ix_produtos_ativos_loja_preco", "loja_id", "preco", sqlite_where=text("removido_em IS NULL")),
+        # loja/proximidade + ordem por nome
+        Index("ix_produtos_ativos_loja_nome", "loja_id", "nome_produto", sqlite_where=text("removido_em IS NULL")),
+        # catálogo inteiro: faixa ou ordem de preço
+        Index("ix_produtos_ativos_preco", "preco", sqlite_where=text("removido_em IS NULL")),
+        # catálogo inteiro, só em estoque: faixa ou ordem de preço
+        Index(
+            "ix_produtos_em_estoque_preco", "preco",
+            sqlite_where=text("removido_em IS NULL AND quantidade_estoque > quantidade_retida")
+        ),
+    )
+
 
 class ReservaProduto(Base):
     __tablename__ = "reservas_produtos"
@@ -71,13 +113,20 @@ class ReservaProduto(Base):
     loja = relationship("Loja")
     itens = relationship("ItemReserva", back_populates="reserva", cascade="all, delete-orphan")
 
+    # Exportação da loja em ordem de data: o índice entrega as linhas já ordenadas
+    __table_args__ = (
+        Index("ix_reservas_produtos_loja_data", "loja_id", "data_reserva"),
+    )
+
 
 class ItemReserva(Base):
     __tablename__ = "itens_reserva"
 
     id = Column(Integer, primary_key=True, index=True)
-    reserva_id = Column(Integer, ForeignKey("reservas_produtos.id"), nullable=False)
-    produto_id = Column(Integer, ForeignKey("produtos.id"), nullable=False)
+    # Indexado para a junção com a reserva (exportação, relatórios), como no arquivo
+    reserva_id = Column(Integer, ForeignKey("reservas_produtos.id"), nullable=False, index=True)
+    # Indexado para a remoção de produto saber se ele aparece em alguma reserva
+    produto_id = Column(Integer, ForeignKey("produtos.id"), nullable=False, index=True)
     quantidade = Column(Integer, default=1)
     preco_unitario = Column(Float, default=0.0)
 
@@ -103,6 +152,10 @@ class Servico(Base):
         passive_deletes=True
     )
 
+    __table_args__ = (
+        Index("ix_servicos_loja_id", "loja_id"),
+    )
+
 
 class ServicoHorario(Base):
     __tablename__ = "servicos_horarios"
@@ -118,6 +171,13 @@ class ServicoHorario(Base):
 
     servico = relationship("Servico", back_populates="horarios")
 
+    __table_args__ = (
+        # Próximo horário livre de um serviço: uma busca por (servico_id, horario >= x)
+        Index(
+            "ix_servicos_horarios_livres", "servico_id", "horario", sqlite_where=text("is_disponivel = 1")
+        ),
+    )
+
 class ReservaServico(Base):
     __tablename__ = "reservas_servicos"
 
@@ -132,6 +192,12 @@ class ReservaServico(Base):
     loja = relationship("Loja", back_populates="reservas")
     servico = relationship("Servico")
 
+    # Agendas da loja e do cliente filtradas por período
+    __table_args__ = (
+        Index("ix_reservas_servicos_loja_data", "loja_id", "data_horario"),
+        Index("ix_reservas_servicos_cliente_data", "cliente_id", "data_horario"),
+    )
+
 
 class Carrinho(Base):
     __tablename__ = "carrinho"
@@ -141,5 +207,97 @@ class Carrinho(Base):
     produto_id = Column(Integer, ForeignKey("produtos.id"))
     quantidade = Column(Integer, default=1)
 
+    # Estoque retido por este item e até quando (retencao.py); o índice serve à varredura das vencidas
+    quantidade_retida = Column(Integer, nullable=False, default=0, server_default="0")
+    retido_ate = Column(DateTime, nullable=True, index=True)
+
     cliente = relationship("Cliente", back_populates="cart_items")
     produto = relationship("Produto")
+
+
+# -------------------------------------------
+#  ROLLUPS DIÁRIOS (analytics.py)
+# -------------------------------------------
+
+class RollupVendasDiarias(Base):
+    """Totais por loja, dia da reserva e produto, mantidos incrementalmente."""
+    __tablename__ = "rollup_vendas_diarias"
+
+    loja_id = Column(Integer, primary_key=True)
+    dia = Column(Date, primary_key=True)
+    produto_id = Column(Integer, primary_key=True)
+
+    unidades_reservadas = Column(Integer, nullable=False, server_default="0")
+    receita_reservada = Column(Float, nullable=False, server_default="0")
+    unidades_retiradas = Column(Integer, nullable=False, server_default="0")
+    receita_retirada = Column(Float, nullable=False, server_default="0")
+    unidades_canceladas = Column(Integer, nullable=False, server_default="0")
+    receita_cancelada = Column(Float, nullable=False, server_default="0")
+
+
+class RollupReservasServicoDiarias(Base):
+    """Quantidade de reservas de serviço por loja, dia, serviço e status atual."""
+    __tablename__ = "rollup_reservas_servico_diarias"
+
+    loja_id = Column(Integer, primary_key=True)
+    dia = Column(Date, primary_key=True)
+    servico_id = Column(Integer, primary_key=True)
+    status = Column(String, primary_key=True)
+
+    quantidade = Column(Integer, nullable=False, server_default="0")
+
+
+# -------------------------------------------
+#  IDEMPOTÊNCIA (idempotencia.py)
+# -------------------------------------------
+
+class ChaveIdempotencia(Base):
+    """Resultado de uma requisição com Idempotency-Key, guardado até expira_em."""
+    __tablename__ = "chaves_idempotencia"
+
+    # endpoint|dono|Idempotency-Key
+    chave = Column(String, primary_key=True)
+    hash_requisicao = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="EM_ANDAMENTO")  # ou CONCLUIDA
+    codigo_resposta = Column(Integer, nullable=True)
+    tipo_resposta = Column(String, nullable=True)
+    corpo_resposta = Column(LargeBinary, nullable=True)
+    criado_em = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expira_em = Column(DateTime, nullable=False, index=True)
+
+
+# -------------------------------------------
+#  FEED DE MUDANÇAS (eventos.py)
+# -------------------------------------------
+
+class EventoMudanca(Base):
+    """Log append-only das mudanças de agenda e horários, lido pelos feeds SSE."""
+    __tablename__ = "eventos_mudanca"
+
+    id = Column(Integer, primary_key=True)
+    loja_id = Column(Integer, nullable=False)
+    # Só preenchido nos eventos de horário, que vão também para o feed público do serviço
+    servico_id = Column(Integer, nullable=True)
+    tipo = Column(String, nullable=False)
+    dados = Column(String, nullable=False)  # JSON
+    criado_em = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_eventos_mudanca_loja_id", "loja_id", "id"),
+        Index("ix_eventos_mudanca_servico_id", "servico_id", "id"),
+    )
+
+
+# -------------------------------------------
+#  SHARDING (shards.py)
+# -------------------------------------------
+
+class MovimentoShard(Base):
+    """Lojas já levadas de um shard para outro: ids nascidos na origem podem estar no destino."""
+    __tablename__ = "movimentos_shard"
+
+    id = Column(Integer, primary_key=True)
+    loja_id = Column(Integer, nullable=False)
+    origem = Column(Integer, nullable=True)  # NULL = banco principal
+    destino = Column(Integer, nullable=False)
+    movido_em = Column(DateTime, nullable=False, default=datetime.utcnow)
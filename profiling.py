@@ -0,0 +1,145 @@
+"""
+Profiling sob demanda de requisições reais.
+
+Uma requisição é perfilada quando traz o header X-Profile com o valor de
+PROFILE_TOKEN, ou quando cai na fração PROFILE_SAMPLE_RATE das rotas listadas
+em PROFILE_ROUTES (nomes de endpoint separados por vírgula, vazio = todas).
+
+O profiler é por amostragem: uma thread auxiliar lê a pilha da thread da
+requisição a cada PROFILE_INTERVALO_MS, sem instrumentar chamadas, então o
+custo fica fora do caminho da requisição. O resultado é gravado em
+PROFILE_DIR no formato "collapsed stack" (aceito pelo speedscope e pelo
+flamegraph.pl), com a categoria de cada amostra (SQLAlchemy, bcrypt, JSON,
+E/S de arquivo ou Python) como primeiro quadro da pilha.
+"""
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ROUTES = {r for r in os.environ.get("PROFILE_ROUTES", "").split(",") if r}
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVALO_MS = float(os.environ.get("PROFILE_INTERVALO_MS", "2"))
+
+logger = logging.getLogger("profiling")
+
+# Prefixos de módulo -> categoria. A primeira categoria encontrada a partir
+# do topo da pilha é a que recebe a amostra.
+CATEGORIAS = (
+    ("sqlalchemy", "SQLAlchemy"),
+    ("sqlite3", "SQLAlchemy"),
+    ("passlib", "bcrypt"),
+    ("bcrypt", "bcrypt"),
+    ("json", "JSON"),
+    ("flask.json", "JSON"),
+    ("shutil", "E/S de arquivo"),
+    ("tempfile", "E/S de arquivo"),
+    ("werkzeug.formparser", "E/S de arquivo"),
+    ("werkzeug.datastructures", "E/S de arquivo"),
+    ("werkzeug.utils", "E/S de arquivo"),
+)
+
+
+def _categoria(modulo):
+    for prefixo, categoria in CATEGORIAS:
+        if modulo == prefixo or modulo.startswith(prefixo + "."):
+            return categoria
+    return None
+
+
+class AmostradorPilha:
+    """Amostra periodicamente a pilha de uma thread e acumula em Counter."""
+
+    def __init__(self, thread_id, intervalo_ms=PROFILE_INTERVALO_MS):
+        self.thread_id = thread_id
+        self.intervalo = intervalo_ms / 1000
+        self.pilhas = Counter()
+        self.por_categoria = Counter()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._executar, daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+        self._thread.join()
+
+    def _executar(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            quadros = []
+            categoria = None
+            while frame is not None:
+                modulo = frame.f_globals.get("__name__", "?")
+                if categoria is None:
+                    categoria = _categoria(modulo)
+                quadros.append(f"{modulo}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            categoria = categoria or "Python"
+            quadros.append(f"[{categoria}]")
+            quadros.reverse()
+            self.pilhas[";".join(quadros)] += 1
+            self.por_categoria[categoria] += 1
+
+    def gravar(self, caminho):
+        with open(caminho, "w") as arquivo:
+            for pilha, contagem in self.pilhas.most_common():
+                arquivo.write(f"{pilha} {contagem}\n")
+
+
+def _deve_perfilar():
+    enviado = request.headers.get("X-Profile")
+    if enviado is not None:
+        return bool(PROFILE_TOKEN) and hmac.compare_digest(enviado, PROFILE_TOKEN)
+    if PROFILE_SAMPLE_RATE <= 0:
+        return False
+    if PROFILE_ROUTES and request.endpoint not in PROFILE_ROUTES:
+        return False
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+def instalar_profiler(app):
+    """Registra os hooks de início e fim do profiling no app Flask."""
+    if not os.path.exists(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+
+    @app.before_request
+    def _iniciar_profiling():
+        if not _deve_perfilar():
+            return
+        g.profiler = AmostradorPilha(threading.get_ident())
+        g.profiler_inicio = time.perf_counter()
+        g.profiler.iniciar()
+
+    @app.teardown_request
+    def _finalizar_profiling(exc):
+        amostrador = g.pop("profiler", None)
+        if amostrador is None:
+            return
+        amostrador.parar()
+        duracao_ms = (time.perf_counter() - g.pop("profiler_inicio")) * 1000
+
+        nome = (
+            f"{request.endpoint or 'desconhecido'}_{duracao_ms:.0f}ms_"
+            f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}.collapsed"
+        )
+        caminho = os.path.join(PROFILE_DIR, nome)
+        amostrador.gravar(caminho)
+
+        total = sum(amostrador.por_categoria.values()) or 1
+        resumo = ", ".join(
+            f"{categoria} {100 * n / total:.0f}%"
+            for categoria, n in amostrador.por_categoria.most_common()
+        )
+        logger.info("Profile de %s (%.1f ms) em %s: %s", request.endpoint, duracao_ms, caminho, resumo)
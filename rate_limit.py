@@ -0,0 +1,131 @@
+"""
+Rate limiting por token bucket nas rotas caras (bcrypt, finalização de
+carrinho, criação de horários, uploads).
+
+Cada combinação rota + cliente/loja da URL + IP tem um balde com
+`capacidade` fichas que se recompõe a `capacidade / janela` fichas por
+segundo. Os baldes ficam numa tabela de um arquivo SQLite próprio
+(RATE_LIMIT_DB), compartilhado entre os workers do gunicorn. A verificação é
+um único upsert com RETURNING, atômico no SQLite, e acessa só uma linha pela
+chave primária.
+
+Orçamentos padrão em LIMITES; RATE_LIMITS sobrescreve no formato
+"endpoint=capacidade/segundos,..." e RATE_LIMIT_ATIVO=0 desliga tudo.
+"""
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from flask import jsonify, request
+
+RATE_LIMIT_ATIVO = os.environ.get("RATE_LIMIT_ATIVO", "1") != "0"
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", "rate_limit.db")
+
+# endpoint -> (capacidade, janela em segundos)
+LIMITES = {
+    "login_cliente": (10, 60),
+    "login_loja": (10, 60),
+    "registrar_cliente": (5, 60),
+    "registrar_loja": (5, 60),
+    "finalizar_carrinho": (10, 60),
+    "criar_horarios_servico": (20, 60),
+    "cadastrar_produto_com_imagem": (30, 60),
+    "importar_produtos_loja": (5, 300),
+    "atualizar_perfil_loja": (10, 60),
+    "atualizar_perfil_cliente": (10, 60),
+}
+
+# Baldes sem uso há mais que isso são apagados de vez em quando
+EXPIRACAO_BALDE = 3600
+
+logger = logging.getLogger("rate_limit")
+
+CONSUMIR = """
+    INSERT INTO baldes (chave, fichas, atualizado) VALUES (:chave, :capacidade - 1, :agora)
+    ON CONFLICT (chave) DO UPDATE SET
+        fichas = MIN(:capacidade, fichas + (:agora - atualizado) * :taxa) - 1,
+        atualizado = :agora
+    WHERE MIN(:capacidade, fichas + (:agora - atualizado) * :taxa) >= 1
+    RETURNING fichas
+"""
+
+
+def ler_limites(texto):
+    limites = dict(LIMITES)
+    for item in filter(None, (t.strip() for t in texto.split(","))):
+        endpoint, _, orcamento = item.partition("=")
+        capacidade, _, janela = orcamento.partition("/")
+        limites[endpoint.strip()] = (int(capacidade), float(janela))
+    return limites
+
+
+limites = ler_limites(os.environ.get("RATE_LIMITS", ""))
+_local = threading.local()
+
+
+def _conexao():
+    conexao = getattr(_local, "conexao", None)
+    # Conexões SQLite não sobrevivem a fork (gunicorn --preload)
+    if conexao is None or _local.pid != os.getpid():
+        # isolation_level=None: cada instrução é sua própria transação
+        conexao = sqlite3.connect(RATE_LIMIT_DB, timeout=1.0, isolation_level=None)
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.execute("PRAGMA synchronous=OFF")
+        conexao.execute(
+            "CREATE TABLE IF NOT EXISTS baldes (chave TEXT PRIMARY KEY, fichas REAL NOT NULL, atualizado REAL NOT NULL)"
+        )
+        _local.conexao = conexao
+        _local.pid = os.getpid()
+    return conexao
+
+
+def consumir(chave, capacidade, janela):
+    """
+    Tenta gastar uma ficha do balde. Devolve (permitido, fichas_restantes,
+    segundos_ate_proxima_ficha).
+    """
+    conexao = _conexao()
+    agora = time.time()
+    taxa = capacidade / janela
+    linha = conexao.execute(
+        CONSUMIR, {"chave": chave, "capacidade": capacidade, "agora": agora, "taxa": taxa}
+    ).fetchone()
+    if random.random() < 0.001:
+        conexao.execute("DELETE FROM baldes WHERE atualizado < ?", (agora - EXPIRACAO_BALDE,))
+    if linha is not None:
+        return True, linha[0], 0.0
+    fichas, atualizado = conexao.execute(
+        "SELECT fichas, atualizado FROM baldes WHERE chave = ?", (chave,)
+    ).fetchone()
+    fichas = min(capacidade, fichas + (agora - atualizado) * taxa)
+    return False, fichas, (1 - fichas) / taxa
+
+
+def verificar_limite():
+    if not RATE_LIMIT_ATIVO or request.endpoint not in limites:
+        return None
+    capacidade, janela = limites[request.endpoint]
+    args = request.view_args or {}
+    dono = args.get("cliente_id") or args.get("loja_id") or "-"
+    chave = f"{request.endpoint}|{dono}|{request.remote_addr}"
+    try:
+        permitido, restantes, espera = consumir(chave, capacidade, janela)
+    except sqlite3.Error:
+        # Sem o contador a requisição segue: melhor que derrubar a rota
+        logger.exception("Falha ao consultar o rate limit")
+        return None
+    if permitido:
+        return None
+    segundos = max(1, math.ceil(espera))
+    resposta = jsonify(detail=f"Muitas requisições. Tente novamente em {segundos} segundos.")
+    resposta.status_code = 429
+    resposta.headers["Retry-After"] = str(segundos)
+    return resposta
+
+
+def instalar_rate_limit(app):
+    app.before_request(verificar_limite)
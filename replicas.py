@@ -0,0 +1,82 @@
+"""
+Leitura em réplicas somente-leitura nas rotas GET.
+
+REPLICAS lista arquivos SQLite separados por vírgula: cópias replicadas do
+banco principal (litestream, rsync, ...) ou o próprio arquivo principal, que
+assim ganha conexões só de leitura num pool separado. Cada arquivo é aberto
+com mode=ro e query_only, e as sessões de leitura se revezam entre eles.
+Sem REPLICAS, ou com SHARDS, tudo continua no banco principal.
+
+Leia-o-que-escreveu: toda resposta de sucesso a um POST/PUT/DELETE leva o
+cookie ultima_escrita (e o header X-Ultima-Escrita, para clientes sem
+cookies, que podem reenviá-lo). Um GET que traz uma marca de menos de
+REPLICA_ATRASO_S atrás é servido pelo principal, que já tem a escrita; depois
+disso a réplica também tem.
+"""
+import itertools
+import math
+import os
+import time
+
+from flask import request
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database import SHARDS, anexar_arquivo
+from slow_queries import instalar_log_consultas_lentas
+
+REPLICAS = [c.strip() for c in os.environ.get("REPLICAS", "").split(",") if c.strip()]
+# Atraso máximo esperado da replicação; leituras do cliente que escreveu há menos que isso vão ao principal
+REPLICA_ATRASO_S = float(os.environ.get("REPLICA_ATRASO_S", "2"))
+COOKIE_ESCRITA = "ultima_escrita"
+HEADER_ESCRITA = "X-Ultima-Escrita"
+METODOS_LEITURA = ("GET", "HEAD", "OPTIONS")
+
+
+def _somente_leitura(dbapi_conn, connection_record):
+    dbapi_conn.execute("PRAGMA query_only = ON")
+
+
+def _criar_motor(caminho):
+    motor = create_engine(
+        f"sqlite:///file:{caminho}?mode=ro&uri=true", connect_args={"check_same_thread": False}
+    )
+    event.listen(motor, "connect", _somente_leitura)
+    event.listen(motor, "connect", anexar_arquivo)
+    instalar_log_consultas_lentas(motor)
+    return motor
+
+
+motores = [] if SHARDS else [_criar_motor(caminho) for caminho in REPLICAS]
+SessionLeitura = sessionmaker(autocommit=False, autoflush=False)
+_proxima = itertools.count()
+
+
+def sessao_leitura():
+    return SessionLeitura(bind=motores[next(_proxima) % len(motores)])
+
+
+def ler_em_replica():
+    """Se a requisição atual pode ser servida por uma réplica."""
+    if not motores or request.method not in METODOS_LEITURA:
+        return False
+    marca = request.headers.get(HEADER_ESCRITA) or request.cookies.get(COOKIE_ESCRITA)
+    try:
+        ultima_escrita = float(marca) if marca else 0.0
+    except ValueError:
+        ultima_escrita = 0.0
+    return time.time() - ultima_escrita >= REPLICA_ATRASO_S
+
+
+def marcar_escrita(response):
+    if motores and request.method not in METODOS_LEITURA and response.status_code < 400:
+        agora = f"{time.time():.3f}"
+        response.set_cookie(
+            COOKIE_ESCRITA, agora, max_age=math.ceil(REPLICA_ATRASO_S), httponly=True, samesite="Lax"
+        )
+        response.headers[HEADER_ESCRITA] = agora
+    return response
+
+
+def instalar_replicas(app):
+    app.after_request(marcar_escrita)
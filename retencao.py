@@ -0,0 +1,160 @@
+"""
+Retenção temporária de estoque pelos itens do carrinho.
+
+Com RETENCAO_CARRINHO_MIN > 0, pôr um produto no carrinho segura a
+quantidade por esse tempo. O item guarda quanto retém (quantidade_retida) e
+até quando (retido_ate); o produto guarda o total retido em
+Produto.quantidade_retida, atualizado na mesma transação. O disponível do
+catálogo é quantidade_estoque - quantidade_retida, lido da própria linha do
+produto, sem somar carrinhos a cada requisição.
+
+O aumento de uma retenção é um UPDATE condicional no produto, então dois
+carrinhos não seguram a mesma unidade. Mexer no item renova o prazo. As
+retenções vencidas voltam ao disponível pela varredura, que acha os itens
+pelo índice em carrinho.retido_ate e roda junto com as rotas de carrinho (no
+máximo a cada RETENCAO_VARREDURA_S por processo) e com as leituras do
+catálogo (listagens de produtos e página da loja), ou pela linha de comando:
+    python retencao.py --varrer
+    python retencao.py --recalcular   # refaz os totais a partir dos carrinhos
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from models import Carrinho, Produto
+
+RETENCAO_CARRINHO_MIN = float(os.environ.get("RETENCAO_CARRINHO_MIN", "0"))
+RETENCAO_VARREDURA_S = float(os.environ.get("RETENCAO_VARREDURA_S", "10"))
+
+_ultima_varredura = 0.0
+_trava = threading.Lock()
+
+
+def ativa():
+    return RETENCAO_CARRINHO_MIN > 0
+
+
+def reter(db, item, quantidade):
+    """
+    Ajusta a retenção do item do carrinho para `quantidade` e renova o prazo.
+    Devolve False, sem mudar nada, se não há disponível para o aumento.
+    Com a retenção desligada só libera o que o item ainda segurava.
+    """
+    if quantidade < 0:
+        raise ValueError("A quantidade retida não pode ser negativa.")
+    if not ativa():
+        quantidade = 0
+    delta = quantidade - (item.quantidade_retida or 0)
+    if delta > 0:
+        ok = db.query(Produto).filter(
+            Produto.id == item.produto_id,
+            Produto.quantidade_estoque - Produto.quantidade_retida >= delta
+        ).update({Produto.quantidade_retida: Produto.quantidade_retida + delta}, synchronize_session=False)
+        if not ok:
+            return False
+    elif delta < 0:
+        db.query(Produto).filter(Produto.id == item.produto_id).update(
+            {Produto.quantidade_retida: Produto.quantidade_retida + delta}, synchronize_session=False
+        )
+    item.quantidade_retida = quantidade
+    item.retido_ate = datetime.utcnow() + timedelta(minutes=RETENCAO_CARRINHO_MIN) if quantidade else None
+    return True
+
+
+def soltar(db, item):
+    """Devolve ao disponível o que o item segura (antes de apagá-lo)."""
+    reter(db, item, 0)
+
+
+def varrer(db):
+    """Libera as retenções vencidas. Devolve quantos itens foram liberados."""
+    agora = datetime.utcnow()
+    # Sondagem pelo índice: sem nada vencido, nem abre transação de escrita
+    if db.query(Carrinho.id).filter(Carrinho.retido_ate < agora).first() is None:
+        return 0
+    vencidas = Carrinho.retido_ate < agora
+    soma = select(func.sum(Carrinho.quantidade_retida)).where(
+        Carrinho.produto_id == Produto.id, vencidas
+    ).scalar_subquery()
+    db.query(Produto).filter(
+        Produto.id.in_(select(Carrinho.produto_id).where(vencidas))
+    ).update({Produto.quantidade_retida: Produto.quantidade_retida - soma}, synchronize_session=False)
+    liberados = db.query(Carrinho).filter(vencidas).update(
+        {Carrinho.quantidade_retida: 0, Carrinho.retido_ate: None}, synchronize_session=False
+    )
+    db.commit()
+    return liberados
+
+
+def _na_vez():
+    global _ultima_varredura
+    agora = time.monotonic()
+    with _trava:
+        if agora - _ultima_varredura < RETENCAO_VARREDURA_S:
+            return False
+        _ultima_varredura = agora
+        return True
+
+
+def varrer_se_preciso(db):
+    """Chamada no começo das rotas de carrinho, antes de carregar os itens."""
+    if _na_vez():
+        varrer(db)
+
+
+def varrer_antes_de_ler(fabrica):
+    """
+    Chamada antes das leituras do catálogo (disponível = estoque - retenções
+    ativas mesmo sem tráfego de carrinho). A sessão da requisição pode ser de
+    réplica, então a varredura abre uma sessão de escrita de fabrica(), só
+    quando é a vez.
+    """
+    if ativa() and _na_vez():
+        with fabrica() as db:
+            varrer(db)
+
+
+def recalcular(db):
+    """Refaz Produto.quantidade_retida a partir das retenções dos carrinhos."""
+    soma = select(func.coalesce(func.sum(Carrinho.quantidade_retida), 0)).where(
+        Carrinho.produto_id == Produto.id
+    ).scalar_subquery()
+    corrigidos = db.query(Produto).filter(Produto.quantidade_retida != soma).update(
+        {Produto.quantidade_retida: soma}, synchronize_session=False
+    )
+    db.commit()
+    return corrigidos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    grupo = parser.add_mutually_exclusive_group(required=True)
+    grupo.add_argument("--varrer", action="store_true", help="libera as retenções vencidas")
+    grupo.add_argument("--recalcular", action="store_true", help="refaz o total retido de cada produto")
+    args = parser.parse_args()
+
+    # Carrinhos e produtos de uma loja ficam no mesmo banco: cada shard (e o
+    # catálogo, com as lojas anteriores ao sharding) é varrido sozinho
+    from sqlalchemy.orm import Session
+    import shards
+    if shards.ativo():
+        shards.preparar()
+        motores = [shards.motor(shard) for shard in shards.todos()]
+    else:
+        from database import engine
+        motores = [engine]
+    total = 0
+    for motor in motores:
+        with Session(bind=motor) as db:
+            total += varrer(db) if args.varrer else recalcular(db)
+    print(f"{total} itens liberados." if args.varrer else f"{total} produtos corrigidos.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
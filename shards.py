@@ -0,0 +1,438 @@
+"""
+Sharding opcional dos dados das lojas em vários arquivos SQLite.
+
+Com SHARDS=N, produtos, serviços, horários, reservas e carrinhos de cada loja
+ficam em SHARD_DIR/shard_<k>.db, o shard indicado em Loja.shard. Clientes, o
+diretório de lojas e as tabelas de apoio (eventos, idempotência, rollups)
+continuam no banco principal, o catálogo. Cada arquivo tem seu próprio lock
+de escrita, então o checkout de uma loja não espera pelo de lojas de outros
+shards. Lojas sem Loja.shard (anteriores ao sharding) seguem no catálogo até
+serem movidas.
+
+get_db devolve uma ShardedSession do SQLAlchemy que roteia:
+  - inserções pela loja_id da linha ou pelo pai (horário -> serviço,
+    item -> reserva, item de carrinho -> produto);
+  - consultas pela loja_id ou pelo id filtrado; sem nenhum dos dois, vão a
+    todos os bancos e os resultados são concatenados (sem ordem global).
+O catálogo é anexado como "catalogo" em toda conexão de shard, então uma
+consulta que junta lojas ou clientes com tabelas do shard roda no shard.
+
+Os ids são únicos entre bancos: com SHARDS ligado, cada inserção nas tabelas
+de loja pega o próximo id da tabela contadores_ids do banco onde é feita, e o
+shard k começa em (k + 1) * FAIXA_IDS. O id diz onde a linha nasceu; quando a
+loja muda de shard os ids vão junto, o movimento fica em movimentos_shard e as
+buscas por id passam a olhar também os destinos.
+
+Para mover uma loja (inclusive do catálogo para um shard):
+    python shards.py --mover 12 --para 3
+Durante a cópia a loja fica em_movimento e as rotas dela devolvem 503.
+
+Transações entre arquivos: a ShardedSession faz commit de cada banco
+separadamente, sem two-phase commit. Os rollups (analytics), o log de eventos
+(eventos), as chaves de idempotência e os contadores das lojas são gravados no
+catálogo, enquanto a mudança que descrevem vai para o shard. Uma falha entre
+os dois commits deixa um lado sem o outro:
+  - rollups e contadores: corrigidos por python analytics.py --reconstruir e
+    python contadores.py --recalcular, que leem o catálogo e todos os shards;
+  - eventos: um evento a mais ou a menos no feed SSE (a agenda lida pelas
+    rotas continua correta); o log é só notificação e não é reconstruído;
+  - idempotência: a chave é gravada depois do commit da rota, então uma falha
+    nela deixa a repetição executar a rota de novo (como sem a chave).
+
+Fora do roteamento: o arquivamento fica desligado com SHARDS
+(database.ARQUIVO_DB), e o relatório da rede (colunar) responde 503.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, create_engine, event, insert, inspect, select, text
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.expression import TableClause
+
+from database import SHARDS, SQLALCHEMY_DATABASE_URL, engine, migrar_esquema
+from models import (
+    Carrinho, ItemReserva, Loja, MovimentoShard, Produto, ReservaProduto, ReservaServico, Servico, ServicoHorario
+)
+from slow_queries import instalar_log_consultas_lentas
+
+SHARD_DIR = os.environ.get("SHARD_DIR", "shards")
+# Por quanto tempo cada processo reaproveita o diretório de lojas -> shard
+SHARD_DIRETORIO_TTL_S = float(os.environ.get("SHARD_DIRETORIO_TTL_S", "5"))
+FAIXA_IDS = 10 ** 12
+CATALOGO = "catalogo"
+TAMANHO_LOTE = 1000
+
+MODELOS_SHARD = (Produto, Servico, ServicoHorario, ReservaProduto, ItemReserva, ReservaServico, Carrinho)
+MODELO_DA_TABELA = {m.__tablename__: m for m in MODELOS_SHARD}
+# Filhos sem loja_id: o shard é o do pai
+PAIS = {ServicoHorario: ("servico_id", Servico), ItemReserva: ("reserva_id", ReservaProduto), Carrinho: ("produto_id", Produto)}
+# Colunas de filtro que apontam para uma linha de loja pelo id
+COLUNAS_ID = {"servico_id": Servico, "produto_id": Produto, "reserva_id": ReservaProduto}
+
+metadata_shard = MetaData()
+
+
+def _tabela_shard(modelo):
+    # Sem as chaves estrangeiras: lojas e clientes não existem no arquivo do shard
+    tabela = modelo.__table__
+    return Table(
+        tabela.name, metadata_shard,
+        *(Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, server_default=c.server_default)
+          for c in tabela.columns),
+        *(Index(i.name, *(c.name for c in i.columns), unique=i.unique, **i.dialect_kwargs) for i in tabela.indexes)
+    )
+
+
+for _modelo in MODELOS_SHARD:
+    _tabela_shard(_modelo)
+
+contadores_ids = Table(
+    "contadores_ids", metadata_shard,
+    Column("tabela", String, primary_key=True),
+    Column("ultimo", Integer, nullable=False),
+)
+
+ALOCAR_IDS = text("UPDATE contadores_ids SET ultimo = ultimo + :n WHERE tabela = :tabela RETURNING ultimo")
+
+
+def ativo():
+    return SHARDS > 0
+
+
+def _anexar_catalogo(dbapi_conn, connection_record):
+    dbapi_conn.execute("ATTACH DATABASE ? AS catalogo", (SQLALCHEMY_DATABASE_URL[len("sqlite:///"):],))
+
+
+def _criar_motor(k):
+    motor = create_engine(
+        f"sqlite:///{os.path.join(SHARD_DIR, f'shard_{k}.db')}", connect_args={"check_same_thread": False}
+    )
+    event.listen(motor, "connect", _anexar_catalogo)
+    instalar_log_consultas_lentas(motor)
+    return motor
+
+
+motores = {}
+if ativo():
+    if not SQLALCHEMY_DATABASE_URL.startswith("sqlite:///"):
+        raise RuntimeError("SHARDS exige um DATABASE_URL de arquivo SQLite.")
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    motores = {k: _criar_motor(k) for k in range(SHARDS)}
+
+
+def motor(shard):
+    return engine if shard == CATALOGO else motores[shard]
+
+
+def todos():
+    return [CATALOGO, *range(SHARDS)]
+
+
+def preparar():
+    """
+    Cria as tabelas dos shards e os contadores de id (no catálogo também).
+    A cada chamada o contador sobe até o maior id da faixa do banco: linhas
+    gravadas com SHARDS desligado (id do autoincremento) não são repetidas.
+    """
+    contadores_ids.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        _acertar_contadores(conn, 0)
+    for k, motor_shard in motores.items():
+        migrar_esquema(motor_shard, metadata_shard)
+        with motor_shard.begin() as conn:
+            _acertar_contadores(conn, (k + 1) * FAIXA_IDS)
+
+
+def _acertar_contadores(conn, base):
+    for tabela in MODELO_DA_TABELA:
+        conn.execute(text(f"""
+            INSERT INTO contadores_ids (tabela, ultimo)
+            SELECT :tabela, COALESCE(MAX(id), :base) FROM {tabela} WHERE id > :base AND id < :base + :faixa
+            ON CONFLICT (tabela) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)
+        """), {"tabela": tabela, "base": base, "faixa": FAIXA_IDS})
+
+
+def alocar_ids(conn, tabela, n=1):
+    """Reserva n ids seguidos no banco da conexão e devolve o primeiro."""
+    ultimo = conn.execute(ALOCAR_IDS, {"n": n, "tabela": tabela}).scalar_one()
+    return ultimo - n + 1
+
+
+def _atribuir_id(mapper, connection, alvo):
+    if alvo.id is None and ativo():
+        alvo.id = alocar_ids(connection, mapper.local_table.name)
+
+
+for _modelo in MODELOS_SHARD:
+    event.listen(_modelo, "before_insert", _atribuir_id)
+
+
+# -------------------------------------------
+#  DIRETÓRIO (loja -> shard)
+# -------------------------------------------
+
+class LojaEmMovimento(Exception):
+    pass
+
+
+_diretorio = {"carregado": 0.0, "lojas": {}, "destinos": {}}
+_trava = threading.Lock()
+
+
+def _carregar_diretorio():
+    with engine.connect() as conn:
+        lojas = {
+            loja_id: (CATALOGO if shard is None else shard, bool(em_movimento))
+            for loja_id, shard, em_movimento in conn.execute(select(Loja.id, Loja.shard, Loja.em_movimento))
+        }
+        movimentos = conn.execute(select(MovimentoShard.origem, MovimentoShard.destino)).all()
+    saidas = {}
+    for origem, destino in movimentos:
+        saidas.setdefault(CATALOGO if origem is None else origem, set()).add(destino)
+    # Uma loja pode ter passado por vários shards: os destinos valem por transitividade
+    destinos = {}
+    for origem in saidas:
+        alcancados, pendentes = set(), list(saidas[origem])
+        while pendentes:
+            shard = pendentes.pop()
+            if shard not in alcancados:
+                alcancados.add(shard)
+                pendentes.extend(saidas.get(shard, ()))
+        alcancados.discard(origem)
+        destinos[origem] = sorted(alcancados)
+    return {"lojas": lojas, "destinos": destinos}
+
+
+def _diretorio_atual(forcar=False):
+    with _trava:
+        idade = time.monotonic() - _diretorio["carregado"]
+        # A recarga forçada (loja nova) também respeita um intervalo mínimo
+        if idade >= SHARD_DIRETORIO_TTL_S or (forcar and idade >= 1.0):
+            _diretorio.update(_carregar_diretorio(), carregado=time.monotonic())
+        return _diretorio
+
+
+def shard_da_loja(loja_id):
+    diretorio = _diretorio_atual()
+    if loja_id not in diretorio["lojas"]:
+        diretorio = _diretorio_atual(forcar=True)
+    shard, em_movimento = diretorio["lojas"].get(loja_id, (CATALOGO, False))
+    if em_movimento:
+        raise LojaEmMovimento(loja_id)
+    return shard
+
+
+def shard_para_loja_nova():
+    """Shard com menos lojas, para o cadastro."""
+    ocupacao = {k: 0 for k in range(SHARDS)}
+    for shard, _ in _diretorio_atual()["lojas"].values():
+        if shard in ocupacao:
+            ocupacao[shard] += 1
+    return min(ocupacao, key=ocupacao.get)
+
+
+def candidatos_do_id(id_):
+    """Bancos onde a linha com este id pode estar, a origem primeiro."""
+    origem = CATALOGO if id_ < FAIXA_IDS else id_ // FAIXA_IDS - 1
+    return [origem, *_diretorio_atual()["destinos"].get(origem, ())]
+
+
+def _localizar(sessao, modelo, id_):
+    candidatos = candidatos_do_id(id_)
+    if len(candidatos) == 1:
+        return candidatos[0]
+    for shard in candidatos:
+        if sessao is not None and sessao.identity_key(modelo, id_, identity_token=shard) in sessao.identity_map:
+            return shard
+    for shard in candidatos:
+        with motor(shard).connect() as conn:
+            if conn.execute(select(modelo.id).where(modelo.id == id_)).first():
+                return shard
+    return candidatos[0]
+
+
+# -------------------------------------------
+#  ROTEAMENTO DA SESSÃO
+# -------------------------------------------
+
+def _ordem(shard):
+    return -1 if shard == CATALOGO else shard
+
+
+def _escolher_shard(mapper, instance, clause=None):
+    if mapper is None or instance is None or mapper.class_ not in MODELOS_SHARD:
+        return CATALOGO
+    if mapper.class_ in PAIS:
+        coluna, pai = PAIS[mapper.class_]
+        return _localizar(inspect(instance).session, pai, getattr(instance, coluna))
+    return shard_da_loja(instance.loja_id)
+
+
+def _escolher_por_id(query, identidade):
+    modelo = query.column_descriptions[0]["entity"]
+    if modelo not in MODELOS_SHARD:
+        return [CATALOGO]
+    return candidatos_do_id(identidade[0])
+
+
+def _valores(comparacao):
+    """(coluna, valores) de `coluna = :valor` ou `coluna IN (...)`; senão None."""
+    coluna, valor = comparacao.left, comparacao.right
+    if not isinstance(valor, BindParameter) or not hasattr(coluna, "table"):
+        return None
+    if comparacao.operator is operators.eq:
+        valores = [valor.effective_value]
+    elif comparacao.operator is operators.in_op:
+        valores = list(valor.effective_value or ())
+    else:
+        return None
+    if any(not isinstance(v, int) for v in valores):
+        return None
+    return coluna, valores
+
+
+def _escolher_shards_consulta(contexto):
+    tabelas, lojas, por_id = set(), set(), set()
+    for elemento in visitors.iterate(contexto.statement):
+        if isinstance(elemento, TableClause):
+            tabelas.add(elemento.name)
+        elif isinstance(elemento, BinaryExpression):
+            achado = _valores(elemento)
+            if achado is None:
+                continue
+            coluna, valores = achado
+            tabela = getattr(coluna.table, "name", None)
+            if tabela == Loja.__tablename__ and coluna.name == "id":
+                lojas.update(valores)
+            elif tabela in MODELO_DA_TABELA:
+                if coluna.name == "loja_id":
+                    lojas.update(valores)
+                elif coluna.name == "id":
+                    por_id.update((MODELO_DA_TABELA[tabela], v) for v in valores)
+                elif coluna.name in COLUNAS_ID:
+                    por_id.update((COLUNAS_ID[coluna.name], v) for v in valores)
+
+    if not tabelas & MODELO_DA_TABELA.keys():
+        return [CATALOGO]
+    if contexto.is_select and contexto.lazy_loaded_from is not None and contexto.lazy_loaded_from.identity_token is not None:
+        return [contexto.lazy_loaded_from.identity_token]
+    if lojas:
+        escolhidos = {shard_da_loja(loja_id) for loja_id in lojas}
+    elif por_id:
+        escolhidos = {shard for _, id_ in por_id for shard in candidatos_do_id(id_)}
+    else:
+        escolhidos = set(todos())
+    return sorted(escolhidos, key=_ordem)
+
+
+SessaoShards = sessionmaker(
+    class_=ShardedSession, autocommit=False, autoflush=False,
+    shard_chooser=_escolher_shard, id_chooser=_escolher_por_id, execute_chooser=_escolher_shards_consulta,
+    shards={shard: motor(shard) for shard in todos()} if ativo() else {},
+)
+
+_executor = None
+
+
+def coletar(consulta):
+    """
+    Roda consulta(sessao) em todos os bancos em paralelo, cada um com sua
+    sessão, e concatena as listas devolvidas.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SHARDS + 1, thread_name_prefix="shards")
+
+    def rodar(shard):
+        with Session(bind=motor(shard)) as sessao:
+            return consulta(sessao)
+    return [linha for parte in _executor.map(rodar, todos()) for linha in parte]
+
+
+# -------------------------------------------
+#  REBALANCEAMENTO
+# -------------------------------------------
+
+def _linhas_da_loja(loja_id):
+    """(tabela, condição) das linhas da loja, pais antes dos filhos."""
+    produtos = select(Produto.id).where(Produto.loja_id == loja_id)
+    servicos = select(Servico.id).where(Servico.loja_id == loja_id)
+    reservas = select(ReservaProduto.id).where(ReservaProduto.loja_id == loja_id)
+    return [
+        (Produto.__table__, Produto.loja_id == loja_id),
+        (Servico.__table__, Servico.loja_id == loja_id),
+        (ReservaProduto.__table__, ReservaProduto.loja_id == loja_id),
+        (ReservaServico.__table__, ReservaServico.loja_id == loja_id),
+        (ServicoHorario.__table__, ServicoHorario.servico_id.in_(servicos)),
+        (ItemReserva.__table__, ItemReserva.reserva_id.in_(reservas)),
+        (Carrinho.__table__, Carrinho.produto_id.in_(produtos)),
+    ]
+
+
+def mover(loja_id, destino, espera=None):
+    """
+    Copia os dados da loja para o shard `destino`, troca o diretório e apaga
+    a origem. Devolve as linhas copiadas por tabela.
+    """
+    if destino not in motores:
+        raise ValueError(f"Shard {destino} não existe (SHARDS={SHARDS}).")
+    with engine.begin() as conn:
+        linha = conn.execute(select(Loja.shard, Loja.em_movimento).where(Loja.id == loja_id)).first()
+        if linha is None:
+            raise ValueError(f"Loja {loja_id} não encontrada.")
+        if linha.em_movimento:
+            raise ValueError(f"Loja {loja_id} já está em movimento.")
+        origem = CATALOGO if linha.shard is None else linha.shard
+        if origem == destino:
+            return {}
+        conn.execute(Loja.__table__.update().where(Loja.id == loja_id).values(em_movimento=True))
+
+    copiadas = {}
+    try:
+        # Os workers enxergam em_movimento na próxima recarga do diretório
+        time.sleep(SHARD_DIRETORIO_TTL_S + 1 if espera is None else espera)
+        linhas = _linhas_da_loja(loja_id)
+        with motor(origem).connect() as conn_origem, motor(destino).begin() as conn_destino:
+            for tabela, condicao in linhas:
+                resultado = conn_origem.execute(select(tabela).where(condicao))
+                copiadas[tabela.name] = 0
+                while lote := resultado.fetchmany(TAMANHO_LOTE):
+                    conn_destino.execute(insert(tabela), [dict(r._mapping) for r in lote])
+                    copiadas[tabela.name] += len(lote)
+        with engine.begin() as conn:
+            conn.execute(Loja.__table__.update().where(Loja.id == loja_id).values(shard=destino))
+            conn.execute(insert(MovimentoShard.__table__).values(
+                loja_id=loja_id, origem=None if origem == CATALOGO else origem, destino=destino
+            ))
+        with motor(origem).begin() as conn_origem:
+            for tabela, condicao in reversed(linhas):
+                conn_origem.execute(tabela.delete().where(condicao))
+    finally:
+        with engine.begin() as conn:
+            conn.execute(Loja.__table__.update().where(Loja.id == loja_id).values(em_movimento=False))
+    return copiadas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mover", type=int, required=True, metavar="LOJA_ID")
+    parser.add_argument("--para", type=int, required=True, metavar="SHARD")
+    args = parser.parse_args()
+
+    if not ativo():
+        print("SHARDS não configurado; nada a fazer.", file=sys.stderr)
+        return 1
+    preparar()
+    print(mover(args.mover, args.para))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Log de consultas lentas para o engine do SQLAlchemy.
+
+Cada instrução que passa do limite configurado (SLOW_QUERY_MS) é registrada
+com o SQL, o formato dos parâmetros (apenas tipos, nunca valores), a duração
+e a rota de origem. Para essas instruções também capturamos o
+EXPLAIN QUERY PLAN do SQLite, e tudo fica num relatório circular que destaca
+varreduras completas (SCAN) nas tabelas mais quentes.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import event
+
+LIMITE_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+TAMANHO_RELATORIO = int(os.environ.get("SLOW_QUERY_REPORT_SIZE", "500"))
+
+# Tabelas em que um SCAN costuma indicar índice faltando
+TABELAS_MONITORADAS = ("produtos", "servicos_horarios", "reservas_servicos", "carrinho")
+
+logger = logging.getLogger("slow_queries")
+
+_registros = deque(maxlen=TAMANHO_RELATORIO)
+_lock = threading.Lock()
+
+_RE_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+_EXPLICAVEIS = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+
+def _rota_atual():
+    """Retorna 'METODO endpoint' da requisição Flask em andamento, se houver."""
+    try:
+        from flask import has_request_context, request
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    return f"{request.method} {request.endpoint or request.path}"
+
+
+def _formato_parametros(parametros, executemany):
+    """Descreve os parâmetros apenas pelos tipos, para não vazar dados."""
+    if executemany:
+        lote = list(parametros or [])
+        return {
+            "executemany": len(lote),
+            "linha": _formato_parametros(lote[0], False) if lote else None,
+        }
+    if isinstance(parametros, dict):
+        return {k: type(v).__name__ for k, v in parametros.items()}
+    if isinstance(parametros, (list, tuple)):
+        return [type(v).__name__ for v in parametros]
+    return type(parametros).__name__
+
+
+def _explain(conn, statement, parametros, executemany):
+    """Executa EXPLAIN QUERY PLAN num cursor separado do DBAPI."""
+    if not statement.lstrip().upper().startswith(_EXPLICAVEIS):
+        return []
+    if executemany:
+        parametros = parametros[0] if parametros else ()
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parametros or ())
+        return [linha[3] for linha in cursor.fetchall()]
+    except Exception as exc:  # o plano é informativo, nunca derruba a requisição
+        return [f"falha ao obter plano: {exc}"]
+    finally:
+        cursor.close()
+
+
+def _scans(plano):
+    tabelas = []
+    for detalhe in plano:
+        m = _RE_SCAN.match(detalhe)
+        if m and m.group(1) in TABELAS_MONITORADAS:
+            tabelas.append(m.group(1))
+    return tabelas
+
+
+def instalar_log_consultas_lentas(engine):
+    """Registra os listeners de tempo de execução no engine informado."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_inicio", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _depois(conn, cursor, statement, parameters, context, executemany):
+        inicio = conn.info["slow_query_inicio"].pop()
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+        if LIMITE_MS <= 0 or duracao_ms < LIMITE_MS:
+            return
+
+        plano = _explain(conn, statement, parameters, executemany)
+        registro = {
+            "quando": datetime.utcnow().isoformat(),
+            "rota": _rota_atual(),
+            "duracao_ms": round(duracao_ms, 3),
+            "sql": statement,
+            "parametros": _formato_parametros(parameters, executemany),
+            "plano": plano,
+            "scans": _scans(plano),
+        }
+        with _lock:
+            _registros.append(registro)
+        logger.warning(
+            "Consulta lenta (%.1f ms) em %s: %s | plano: %s",
+            duracao_ms, registro["rota"], statement, "; ".join(plano)
+        )
+
+
+def relatorio():
+    """Agrega os registros recentes por instrução e destaca SCANs."""
+    with _lock:
+        registros = list(_registros)
+
+    por_sql = {}
+    scans_por_tabela = {t: 0 for t in TABELAS_MONITORADAS}
+    for r in registros:
+        agregado = por_sql.setdefault(r["sql"], {
+            "sql": r["sql"],
+            "ocorrencias": 0,
+            "duracao_total_ms": 0.0,
+            "duracao_max_ms": 0.0,
+            "rotas": set(),
+            "plano": r["plano"],
+            "scans": r["scans"],
+        })
+        agregado["ocorrencias"] += 1
+        agregado["duracao_total_ms"] += r["duracao_ms"]
+        agregado["duracao_max_ms"] = max(agregado["duracao_max_ms"], r["duracao_ms"])
+        if r["rota"]:
+            agregado["rotas"].add(r["rota"])
+        for tabela in r["scans"]:
+            scans_por_tabela[tabela] += 1
+
+    consultas = sorted(por_sql.values(), key=lambda a: a["duracao_total_ms"], reverse=True)
+    for a in consultas:
+        a["duracao_media_ms"] = round(a["duracao_total_ms"] / a["ocorrencias"], 3)
+        a["duracao_total_ms"] = round(a["duracao_total_ms"], 3)
+        a["rotas"] = sorted(a["rotas"])
+
+    return {
+        "limite_ms": LIMITE_MS,
+        "registros": len(registros),
+        "scans_por_tabela": scans_por_tabela,
+        "consultas_com_scan": [a for a in consultas if a["scans"]],
+        "consultas": consultas,
+        "recentes": registros[-20:],
+    }
+
+
+def limpar():
+    with _lock:
+        _registros.clear()
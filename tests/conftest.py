@@ -0,0 +1,86 @@
+"""
+Banco temporário com SHARDS=2 e retenção de carrinho ligada. As variáveis
+são lidas na importação dos módulos da aplicação, então precisam estar
+definidas antes de qualquer import deles. Rodar com: python -m pytest tests
+"""
+import io
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+_DIRETORIO = tempfile.mkdtemp(prefix="teste_ciclismo_")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_DIRETORIO, 'teste.db')}",
+    "SHARDS": "2",
+    "SHARD_DIR": os.path.join(_DIRETORIO, "shards"),
+    "SHARD_DIRETORIO_TTL_S": "0",
+    "RETENCAO_CARRINHO_MIN": "10",
+    "RETENCAO_VARREDURA_S": "0",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402  (cria as tabelas e prepara os shards)
+import shards  # noqa: E402
+from database import SessionLocal  # noqa: E402
+from models import Cliente, Loja, Produto  # noqa: E402
+
+_sequencia = itertools.count(1)
+
+
+@pytest.fixture
+def cliente_http():
+    return main.app.test_client()
+
+
+@pytest.fixture
+def nova_loja():
+    """nova_loja(shard) cria uma loja no shard (None = catálogo) e devolve o id."""
+    def criar(shard=None):
+        n = next(_sequencia)
+        with SessionLocal() as db:
+            loja = Loja(nome_loja=f"Loja {n}", cnpj=f"cnpj-{n}", cep="00000-000", endereco="Rua", senha_hash="x",
+                        shard=shard)
+            db.add(loja)
+            db.commit()
+            return loja.id
+    return criar
+
+
+@pytest.fixture
+def novo_cliente():
+    def criar():
+        n = next(_sequencia)
+        with SessionLocal() as db:
+            cliente = Cliente(nome=f"Cliente {n}", idade=30, cpf=f"cpf-{n}", senha_hash="x")
+            db.add(cliente)
+            db.commit()
+            return cliente.id
+    return criar
+
+
+@pytest.fixture
+def importar(cliente_http):
+    """importar(loja_id, [(sku, estoque), ...]) -> {sku: produto_id}, pela rota de importação."""
+    def criar(loja_id, produtos):
+        csv = "sku,nome_produto,preco,quantidade_estoque\n" + "".join(
+            f"{sku},Produto {sku},10.0,{estoque}\n" for sku, estoque in produtos
+        )
+        r = cliente_http.post(f"/loja/{loja_id}/produtos/importar",
+                              data={"arquivo": (io.BytesIO(csv.encode()), "produtos.csv")})
+        assert r.status_code == 200, r.get_json()
+        with shards.SessaoShards() as db:
+            return dict(db.query(Produto.sku, Produto.id).filter(Produto.loja_id == loja_id).all())
+    return criar
+
+
+@pytest.fixture
+def estoque():
+    """estoque(produto_id) -> (quantidade_estoque, quantidade_retida) lidos do banco."""
+    def ler(produto_id):
+        with shards.SessaoShards() as db:
+            p = db.get(Produto, produto_id)
+            return p.quantidade_estoque, p.quantidade_retida
+    return ler
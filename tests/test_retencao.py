@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import retencao
+import shards
+from models import Carrinho
+
+
+def vencer_retencoes(cliente_id):
+    with shards.SessaoShards() as db:
+        db.query(Carrinho).filter(Carrinho.cliente_id == cliente_id).update(
+            {Carrinho.retido_ate: datetime.utcnow() - timedelta(minutes=1)}, synchronize_session=False
+        )
+        db.commit()
+
+
+@pytest.mark.parametrize("quantidade", [-5, 0, "2", 1.5, True, None])
+def test_quantidade_invalida_nao_retem(cliente_http, nova_loja, novo_cliente, importar, estoque, quantidade):
+    produto_id = importar(nova_loja(0), [("A", 2)])["A"]
+    cliente_id = novo_cliente()
+
+    r = cliente_http.post(f"/cliente/{cliente_id}/carrinho", json={"produto_id": produto_id, "quantidade": quantidade})
+
+    assert r.status_code == 400
+    assert estoque(produto_id) == (2, 0)
+
+
+def test_reter_recusa_quantidade_negativa():
+    with pytest.raises(ValueError):
+        retencao.reter(None, Carrinho(produto_id=1, quantidade_retida=0), -1)
+
+
+def test_retencao_segura_o_estoque_dos_outros(cliente_http, nova_loja, novo_cliente, importar, estoque):
+    produto_id = importar(nova_loja(1), [("A", 2)])["A"]
+    primeiro, segundo = novo_cliente(), novo_cliente()
+
+    assert cliente_http.post(f"/cliente/{primeiro}/carrinho", json={"produto_id": produto_id, "quantidade": 2}).status_code == 200
+    assert estoque(produto_id) == (2, 2)
+    r = cliente_http.post(f"/cliente/{segundo}/carrinho", json={"produto_id": produto_id, "quantidade": 1})
+    assert r.status_code == 400
+
+
+def test_retencao_vencida_volta_ao_disponivel_e_finaliza(cliente_http, nova_loja, novo_cliente, importar, estoque):
+    produto_id = importar(nova_loja(None), [("A", 5)])["A"]
+    cliente_id = novo_cliente()
+    cliente_http.post(f"/cliente/{cliente_id}/carrinho", json={"produto_id": produto_id, "quantidade": 3})
+    assert estoque(produto_id) == (5, 3)
+
+    vencer_retencoes(cliente_id)
+    with shards.SessaoShards() as db:
+        assert retencao.varrer(db) >= 1
+    assert estoque(produto_id) == (5, 0)
+
+    # Finalizar depois da varredura não solta de novo o que já foi solto
+    r = cliente_http.post(f"/cliente/{cliente_id}/finalizar_carrinho")
+    assert r.status_code == 200, r.get_json()
+    assert estoque(produto_id) == (2, 0)
+    assert cliente_http.get(f"/cliente/{cliente_id}/carrinho").get_json()["itens_carrinho"] == []
+
+
+def test_finalizar_converte_a_retencao_em_reserva(cliente_http, nova_loja, novo_cliente, importar, estoque):
+    produto_id = importar(nova_loja(0), [("A", 4)])["A"]
+    cliente_id = novo_cliente()
+    cliente_http.post(f"/cliente/{cliente_id}/carrinho", json={"produto_id": produto_id, "quantidade": 3})
+
+    r = cliente_http.post(f"/cliente/{cliente_id}/finalizar_carrinho")
+
+    assert r.status_code == 200, r.get_json()
+    assert estoque(produto_id) == (1, 0)
+
+
+def test_retencao_vencida_nao_varrida_e_solta_ao_finalizar(cliente_http, nova_loja, novo_cliente, importar, estoque):
+    produto_id = importar(nova_loja(1), [("A", 4)])["A"]
+    cliente_id = novo_cliente()
+    cliente_http.post(f"/cliente/{cliente_id}/carrinho", json={"produto_id": produto_id, "quantidade": 2})
+    vencer_retencoes(cliente_id)
+
+    # Sem varredura entre o vencimento e o checkout, a retenção do item ainda conta no produto
+    retencao_original = retencao.RETENCAO_VARREDURA_S
+    retencao.RETENCAO_VARREDURA_S = 3600
+    retencao._ultima_varredura = float("inf")
+    try:
+        r = cliente_http.post(f"/cliente/{cliente_id}/finalizar_carrinho")
+    finally:
+        retencao.RETENCAO_VARREDURA_S = retencao_original
+        retencao._ultima_varredura = 0.0
+
+    assert r.status_code == 200, r.get_json()
+    assert estoque(produto_id) == (2, 0)
+
+
+def test_finalizar_sem_estoque_nao_abate_nada(cliente_http, nova_loja, novo_cliente, importar, estoque):
+    produto_id = importar(nova_loja(0), [("A", 3)])["A"]
+    primeiro, segundo = novo_cliente(), novo_cliente()
+    cliente_http.post(f"/cliente/{primeiro}/carrinho", json={"produto_id": produto_id, "quantidade": 2})
+    vencer_retencoes(primeiro)
+    # Com a retenção do primeiro vencida, o segundo segura todo o estoque
+    assert cliente_http.post(f"/cliente/{segundo}/carrinho", json={"produto_id": produto_id, "quantidade": 3}).status_code == 200
+
+    r = cliente_http.post(f"/cliente/{primeiro}/finalizar_carrinho")
+
+    assert r.status_code == 400
+    assert estoque(produto_id) == (3, 3)
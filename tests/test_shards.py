@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+from sqlalchemy import select, text
+
+import shards
+from database import engine
+from models import Carrinho, Loja, Produto, Servico
+
+
+def escolhidos(consulta):
+    return shards._escolher_shards_consulta(SimpleNamespace(statement=consulta, is_select=True, lazy_loaded_from=None))
+
+
+def test_ids_nascem_na_faixa_do_banco(nova_loja, importar):
+    do_catalogo = importar(nova_loja(None), [("A", 1)])["A"]
+    do_shard_1 = importar(nova_loja(1), [("A", 1)])["A"]
+
+    assert do_catalogo < shards.FAIXA_IDS
+    assert 2 * shards.FAIXA_IDS < do_shard_1 < 3 * shards.FAIXA_IDS
+    assert shards.candidatos_do_id(do_catalogo) == [shards.CATALOGO]
+    assert shards.candidatos_do_id(do_shard_1) == [1]
+
+
+def test_roteamento_por_loja_id(nova_loja):
+    loja_0, loja_1, loja_catalogo = nova_loja(0), nova_loja(1), nova_loja(None)
+
+    assert escolhidos(select(Produto).where(Produto.loja_id == loja_0)) == [0]
+    assert escolhidos(select(Servico).where(Servico.loja_id == loja_catalogo)) == [shards.CATALOGO]
+    assert escolhidos(select(Produto).where(Produto.loja_id.in_([loja_0, loja_1]))) == [0, 1]
+
+
+def test_roteamento_por_id(nova_loja, importar):
+    produto_0 = importar(nova_loja(0), [("A", 1)])["A"]
+    produto_1 = importar(nova_loja(1), [("A", 1)])["A"]
+
+    assert escolhidos(select(Produto).where(Produto.id == produto_1)) == [1]
+    assert escolhidos(select(Produto).where(Produto.id.in_([produto_0, produto_1]))) == [0, 1]
+    # Filhos sem loja_id seguem o id do pai
+    assert escolhidos(select(Carrinho).where(Carrinho.produto_id == produto_0)) == [0]
+
+
+def test_roteamento_sem_filtro_e_tabelas_do_catalogo():
+    assert escolhidos(select(Produto).where(Produto.preco > 1)) == shards.todos()
+    assert escolhidos(select(Loja).where(Loja.id == 1)) == [shards.CATALOGO]
+
+
+def test_mover_mantem_as_buscas_por_id(cliente_http, nova_loja, novo_cliente, importar, estoque):
+    loja_id = nova_loja(None)
+    produto_id = importar(loja_id, [("A", 4)])["A"]
+    cliente_id = novo_cliente()
+
+    copiadas = shards.mover(loja_id, 1, espera=0)
+
+    assert copiadas["produtos"] == 1
+    assert shards.shard_da_loja(loja_id) == 1
+    assert shards.candidatos_do_id(produto_id) == [shards.CATALOGO, 1]
+    with shards.SessaoShards() as db:
+        assert db.get(Produto, produto_id).loja_id == loja_id
+        assert db.query(Produto.id).filter(Produto.id == produto_id).all() == [(produto_id,)]
+    with shards.motor(shards.CATALOGO).connect() as conn:
+        assert conn.execute(select(Produto.id).where(Produto.id == produto_id)).first() is None
+
+    # As rotas acham o produto pelo id depois do movimento
+    assert cliente_http.post(f"/cliente/{cliente_id}/carrinho", json={"produto_id": produto_id, "quantidade": 1}).status_code == 200
+    assert cliente_http.post(f"/cliente/{cliente_id}/finalizar_carrinho").status_code == 200
+    assert estoque(produto_id) == (3, 0)
+
+
+def test_mover_entre_shards(nova_loja, importar):
+    loja_id = nova_loja(0)
+    produto_id = importar(loja_id, [("A", 1)])["A"]
+
+    shards.mover(loja_id, 1, espera=0)
+
+    assert escolhidos(select(Produto).where(Produto.id == produto_id)) == [0, 1]
+    with shards.SessaoShards() as db:
+        assert db.get(Produto, produto_id).loja_id == loja_id
+
+
+def test_preparar_sobe_contador_acima_dos_ids_existentes(nova_loja, importar):
+    loja_id = nova_loja(None)
+    importar(loja_id, [("A", 1)])
+    # Linha gravada com SHARDS desligado: id do autoincremento, sem passar pelo contador
+    with engine.begin() as conn:
+        maior = conn.execute(text("SELECT MAX(id) FROM produtos")).scalar()
+        conn.execute(text(
+            "INSERT INTO produtos (id, loja_id, sku, nome_produto, preco, quantidade_estoque) "
+            "VALUES (:id, :loja, 'sem-shards', 'x', 1, 1)"
+        ), {"id": maior + 10, "loja": loja_id})
+
+    shards.preparar()
+
+    with engine.begin() as conn:
+        assert shards.alocar_ids(conn, "produtos") == maior + 11